@@ -9,115 +9,114 @@ Works on both Windows and Linux with simple UI
 import os
 import sys
 import socket
-import subprocess
-import platform
+import io
+import signal
+import stat
 import time
 import threading
+import logging
+import re
+import argparse
+import binascii
+import hashlib
+import json
+from array import array
+from collections import OrderedDict, deque
+
+# The wire protocol and the chat client are plain modules shared with the
+# scripts generated for the VM (see bundle_source)
+from copy_paste_protocol import (
+    CHUNK_INDEX, CLIPBOARD_MAX_SIZE, CompressionStats, Connection,
+    ENTRY_HEADER, FILE_CHUNK_SIZE, FLAG_COMPRESSED, FRAME_DEDUP_CHUNK, FRAME_DEDUP_COMMIT,
+    FRAME_DEDUP_MISSING, FRAME_DEDUP_QUERY, FRAME_DEDUP_STATUS, FRAME_DIR_BEGIN,
+    FRAME_DIR_DATA, FRAME_DIR_END, FRAME_DIR_STATUS, FRAME_FILE_ACCEPT, FRAME_FILE_CHUNK,
+    FRAME_FILE_END, FRAME_FILE_OFFER, FRAME_FILE_STATUS, HistoryStore, METRICS, ProtocolError,
+    SEQ, TEXT_TYPES, THROUGHPUT_BUCKETS, clip_digest, decode_json, enable_metrics, encode_json,
+    file_manifest, sendfile, text_decoder, to_bytes)
+from copy_paste_client import CLIENT_PORT, ChatClient, stream_input
+
+# Modules only one feature needs (subprocess, tempfile, logging.handlers,
+# concurrent.futures, ...) are imported where they are used, so the import
+# and the command line start in tens of milliseconds (see
+# benchmarks/bench_startup.py).
+
+# tkinter is imported by load_gui() when the GUI starts and Pillow by
+# load_pil() when a feature first needs it, so the command line
+# (auto_installer.py send ...) runs without either. Neither ever prompts.
+HAS_GUI = False
+HAS_PIL = False
+_gui_loaded = False
+_pil_loaded = False
 
-try:
-    import tkinter as tk
-    from tkinter import ttk, scrolledtext, messagebox
-
-    HAS_GUI = True
-except ImportError:
-    HAS_GUI = False
 
-# Check and install Pillow if needed
-HAS_PIL = False
-try:
-    from PIL import Image, ImageTk, ImageDraw, ImageFont
-
-    HAS_PIL = True
-except ImportError:
-    if HAS_GUI:
-        print("\n" + "=" * 60)
-        print("Pillow (PIL) is not installed.")
-        print("Pillow is needed for the background image feature.")
-        print("=" * 60)
-        choice = input("\nDo you want to install Pillow now? (yes/no/skip): ").strip().lower()
+def load_gui():
+    """Import tkinter; True if the GUI can run"""
+    global tk, ttk, scrolledtext, messagebox, filedialog, HAS_GUI, _gui_loaded
+    if _gui_loaded:
+        return HAS_GUI
+    _gui_loaded = True
+    try:
+        import tkinter as tk
+        from tkinter import ttk, scrolledtext, messagebox, filedialog
+
+        HAS_GUI = True
+    except ImportError:
+        HAS_GUI = False
+    return HAS_GUI
+
+
+def load_pil():
+    """Import Pillow; True if the background image, clipboard images and
+    thumbnails are available (install it with: pip install Pillow)"""
+    global Image, ImageTk, HAS_PIL, _pil_loaded
+    if _pil_loaded:
+        return HAS_PIL
+    _pil_loaded = True
+    try:
+        from PIL import Image, ImageTk
 
-        if choice in ['yes', 'y']:
-            print("\nInstalling Pillow...")
-            try:
-                subprocess.check_call([sys.executable, "-m", "pip", "install", "Pillow"])
-                print("✓ Pillow installed successfully!")
-                print("Please restart the application to use the background feature.\n")
-                from PIL import Image, ImageTk, ImageDraw, ImageFont
+        HAS_PIL = True
+    except ImportError:
+        HAS_PIL = False
+    return HAS_PIL
 
-                HAS_PIL = True
-            except Exception as e:
-                print(f"✗ Failed to install Pillow: {e}")
-                print("The application will run without background image.\n")
-                HAS_PIL = False
-        elif choice == 'skip':
-            print("\nSkipping Pillow installation.")
-            print("The application will run without background image.\n")
-            HAS_PIL = False
-        else:
-            print("\nPillow installation cancelled.")
-            print("The application will run without background image.\n")
-            HAS_PIL = False
 
 # ============================================
 # FILE TEMPLATES
 # ============================================
 
-VM_SERVER_CODE = """# vm_server.py
-# Run this on the VM - Python 2.2.6 compatible
-# Real-time bidirectional clipboard sync server
+def bundle_source(*names):
+    """Source of the named modules joined into one script. The protocol
+    import block of each module is dropped, as copy_paste_protocol comes
+    first in the script."""
+    from importlib.util import find_spec
 
-import socket
-import sys
-import select
-
-HOST = '0.0.0.0'
-PORT = 4444
+    parts = []
+    for name in names:
+        with open(find_spec(name).origin, encoding="utf-8") as f:
+            source = f.read()
+        parts.append(re.sub(r"(?ms)^# ---- protocol import ----$.*?"
+                            r"^# ---- end of protocol import ----\n", "", source))
+    return "\n".join(parts)
 
-def main():
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.bind((HOST, PORT))
-    s.listen(1)
 
-    print 'Waiting for connection on %s:%d...' % (HOST, PORT)
-    conn, addr = s.accept()
-    print 'Connected from', addr
-    print 'Type anything and press Enter to send to Windows.'
-    print 'Incoming text from Windows will appear automatically.\\n'
+def get_vm_server_code():
+    return ("# vm_server.py\n"
+            "# Run this on the VM - Python 2.7 and 3.x compatible\n"
+            "# Real-time bidirectional clipboard sync server for many concurrent peers\n"
+            + bundle_source("copy_paste_protocol", "copy_paste_server"))
 
-    try:
-        while True:
-            readable, _, _ = select.select([conn, sys.stdin], [], [], 0.1)
-
-            for r in readable:
-                if r is conn:
-                    data = conn.recv(4096)
-                    if not data:
-                        print '\\nConnection closed by Windows host.'
-                        return
-                    sys.stdout.write(data)
-                    sys.stdout.flush()
-
-                elif r is sys.stdin:
-                    line = sys.stdin.readline()
-                    if not line:
-                        return
-                    conn.sendall(line)
-
-    except KeyboardInterrupt:
-        print '\\nShutting down.'
-    except Exception, e:
-        print 'Error:', e
-    finally:
-        try:
-            conn.close()
-            s.close()
-        except:
-            pass
 
-if __name__ == '__main__':
-    main()
-"""
+def get_python_client_code(vm_ip, port):
+    return ("#!/usr/bin/env python\n"
+            "# chat_client.py\n"
+            "# Run this on the host - Python 2.7 and 3.x compatible\n"
+            "# Headless, event-driven replacement for windows_client.ps1:\n"
+            "#     python chat_client.py [host] [port] < lines.txt\n"
+            + bundle_source("copy_paste_protocol", "copy_paste_client") +
+            f"\nCLIENT_HOST = {vm_ip!r}\nCLIENT_PORT = {int(port)}\n\n"
+            "if __name__ == '__main__':\n"
+            "    sys.exit(client_main())\n")
 
 
 def get_windows_client_code(vm_ip, port):
@@ -146,6 +145,7 @@ try {{
             while ($true) {{
                 $line = $reader.ReadLine()
                 if ($line -eq $null) {{ break }}
+                if ($line.StartsWith("#copy-paste/")) {{ continue }}
                 Write-Output $line
             }}
         }} catch {{}}
@@ -201,12 +201,107 @@ def get_local_ip():
 def create_vm_server():
     """Create vm_server.py"""
     with open('vm_server.py', 'w') as f:
-        f.write(VM_SERVER_CODE)
+        f.write(get_vm_server_code())
     if os.name != 'nt':
         os.chmod('vm_server.py', 0o755)
     return True
 
 
+class ServerProcessManager:
+    """Runs vm_server.py as a child process and keeps it alive
+
+    stdout and stderr are merged and read on a reader thread; each line is
+    passed to on_output and each exit code to on_exit(code, restart_delay),
+    both from that thread. A server that exits on its own is restarted after
+    a backoff that doubles from 1 s up to max_backoff, and resets once a run
+    has lasted stable_after seconds.
+    """
+
+    def __init__(self, script='vm_server.py', args=('--no-stdin',), on_output=print,
+                 on_exit=None, auto_restart=True, max_backoff=30.0, stable_after=10.0):
+        self.script = script
+        self.args = list(args)
+        self.on_output = on_output
+        self.on_exit = on_exit
+        self.auto_restart = auto_restart
+        self.max_backoff = max_backoff
+        self.stable_after = stable_after
+        self.proc = None
+        self.restarts = 0
+        self._backoff = 1.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        with self._lock:
+            if self.running:
+                return
+            self._stop.clear()
+            self._spawn()
+
+    def _spawn(self):
+        import subprocess
+
+        self.proc = subprocess.Popen([sys.executable, '-u', self.script] + self.args,
+                                     stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT)
+        threading.Thread(target=self._watch, args=(self.proc,), daemon=True).start()
+
+    def _watch(self, proc):
+        started = time.monotonic()
+        decoder = text_decoder()
+        for line in iter(proc.stdout.readline, b""):
+            self.on_output(decoder.decode(line).rstrip("\r\n"))
+        code = proc.wait()
+        proc.stdout.close()
+
+        with self._lock:
+            if proc is not self.proc:
+                return
+            delay = None
+            if self.auto_restart and not self._stop.is_set():
+                if time.monotonic() - started >= self.stable_after:
+                    self._backoff = 1.0
+                delay = self._backoff
+                self._backoff = min(self._backoff * 2, self.max_backoff)
+        if self.on_exit:
+            self.on_exit(code, delay)
+        if delay is not None and not self._stop.wait(delay):
+            with self._lock:
+                if proc is self.proc and not self._stop.is_set():
+                    self.restarts += 1
+                    METRICS.inc("server_restarts_total")
+                    self._spawn()
+
+    def stop(self, timeout=5.0):
+        """Stop the server (Ctrl+C first, so it can shut down cleanly)"""
+        self._stop.set()
+        with self._lock:
+            proc = self.proc
+        if proc is None or proc.poll() is not None:
+            return
+        import subprocess
+
+        if os.name == 'nt':
+            proc.terminate()
+        else:
+            proc.send_signal(signal.SIGINT)
+        try:
+            proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+    def restart(self):
+        self.stop()
+        self._backoff = 1.0
+        self.start()
+
+
 def create_windows_client(vm_ip, port):
     """Create windows_client.ps1"""
     os.makedirs('.venv', exist_ok=True)
@@ -215,24 +310,452 @@ def create_windows_client(vm_ip, port):
     return True
 
 
-def send_file_to_vm(vm_ip, port, filename):
-    """Send file to VM via TCP"""
-    try:
-        with open(filename, 'rb') as f:
-            content = f.read()
+def create_python_client(vm_ip, port):
+    """Create chat_client.py, the headless client that replaces the .ps1"""
+    os.makedirs('.venv', exist_ok=True)
+    with open('.venv/chat_client.py', 'w') as f:
+        f.write(get_python_client_code(vm_ip, port))
+    if os.name != 'nt':
+        os.chmod('.venv/chat_client.py', 0o755)
+    return True
 
+
+def send_file_to_vm(vm_ip, port, filename, chunked=False, progress=None, streams=1,
+                    dedup=False):
+    """Send file to VM via TCP
+
+    The default raw mode is for bootstrapping through `nc -l`; chunked mode
+    needs a running vm_server.py and is the one to use for large files.
+    dedup mode also needs vm_server.py and only sends chunks the VM lacks.
+    """
+    if os.path.isdir(filename):
+        return send_directory(vm_ip, port, filename, progress=progress)
+    if dedup:
+        return send_file_dedup(vm_ip, port, filename, progress=progress)
+    if chunked or streams > 1:
+        return send_file_chunked(vm_ip, port, filename, progress=progress, streams=streams)
+    try:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.settimeout(10)
         sock.connect((vm_ip, port))
-        sock.sendall(content)
+        with open(filename, 'rb') as f:
+            sendfile(sock, f, 0, os.fstat(f.fileno()).st_size)
         sock.close()
         return True, "Success"
     except Exception as e:
         return False, str(e)
 
 
-def create_gradient_background(width, height):
-    """Create background from image, focusing on bottom 50%"""
+class TransferProgress:
+    """Thread-safe, throttled progress reporting for file transfers"""
+
+    def __init__(self, name, total, callback, interval=0.5):
+        self.name = name
+        self.total = total
+        self.callback = callback
+        self.interval = interval
+        self.done = 0
+        self.sent = 0
+        self.started = time.monotonic()
+        self._last_report = 0.0
+        self._lock = threading.Lock()
+
+    def rate(self):
+        elapsed = time.monotonic() - self.started
+        return self.sent / elapsed / (1024 * 1024) if elapsed > 0 else 0.0
+
+    def skip(self, nbytes):
+        """Count bytes the receiver already had (resume) without affecting MB/s"""
+        with self._lock:
+            self.done += nbytes
+
+    def advance(self, nbytes, force=False):
+        with self._lock:
+            self.done += nbytes
+            self.sent += nbytes
+            now = time.monotonic()
+            if not self.callback or not (force or now - self._last_report >= self.interval):
+                return
+            self._last_report = now
+            percent = 100.0 * self.done / self.total if self.total else 100.0
+            line = (f"{self.name}: {percent:5.1f}% "
+                    f"({self.done / (1024 * 1024):.1f} MB, {self.rate():.1f} MB/s)")
+        self.callback(line)
+
+    def finish(self):
+        """Report the final line and record the transfer rate"""
+        self.advance(0, force=True)
+        METRICS.inc("transfers_total")
+        METRICS.inc("transfer_bytes_total", self.sent)
+        METRICS.observe("transfer_mbps", self.rate(), THROUGHPUT_BUCKETS)
+
+
+def _range_bytes(manifest, ranges):
+    chunk_size, size = manifest['chunk_size'], manifest['size']
+    return sum(min(end * chunk_size, size) - start * chunk_size for start, end in ranges)
+
+
+def _send_chunk_range(vm_ip, port, filename, manifest, stripe, tracker, retries, stats):
+    """Deliver chunks stripe[0]..stripe[1]-1 over one connection, resuming on errors"""
+    chunk_size = manifest['chunk_size']
+    offer = dict(manifest, range=list(stripe))
+    stripe_bytes = _range_bytes(manifest, [stripe])
+    counted = 0
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    last_error = "no attempt made"
+
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(min(0.5 * 2 ** (attempt - 1), 5.0))
+        conn = None
+        try:
+            sock = socket.create_connection((vm_ip, port), timeout=10)
+            sock.settimeout(30)
+            conn = Connection(sock, framing="frame", compress_level=1, stats=stats)
+            conn.handshake(hello={'client': 'auto_installer', 'role': 'transfer'})
+            conn.send_payload(FRAME_FILE_OFFER, [encode_json(offer)])
+            accept = conn.expect(FRAME_FILE_ACCEPT)
+            if 'error' in accept:
+                return False, accept['error']
+
+            missing = accept['missing']
+            already = stripe_bytes - _range_bytes(manifest, missing)
+            tracker.skip(already - counted)
+            counted = already
+            # Chunks go out with sendfile() when there is no codec, or once
+            # the data has proved incompressible a few chunks in a row
+            use_sendfile = conn.compressor.codec == 'none'
+            incompressible = 0
+            with open(filename, 'rb') as f:
+                for start, end in missing:
+                    for index in range(start, end):
+                        offset = index * chunk_size
+                        n = min(chunk_size, manifest['size'] - offset)
+                        if use_sendfile:
+                            conn.send_frame_file(FRAME_FILE_CHUNK, CHUNK_INDEX.pack(index), f, offset, n)
+                        else:
+                            f.seek(offset)
+                            f.readinto(view[:n])
+                            flags = conn.send_payload(FRAME_FILE_CHUNK, [CHUNK_INDEX.pack(index), view[:n]])
+                            incompressible = 0 if flags & FLAG_COMPRESSED else incompressible + 1
+                            use_sendfile = incompressible >= 4
+                        tracker.advance(n)
+                        counted += n
+            conn.send_frame(FRAME_FILE_END, encode_json({'id': manifest['id']}))
+            status = conn.expect(FRAME_FILE_STATUS)
+            if 'error' in status:
+                return False, status['error']
+            if not status['missing']:
+                return True, "Success"
+            last_error = f"{len(status['missing'])} chunk range(s) failed verification"
+        except (OSError, ProtocolError, ValueError) as e:
+            last_error = str(e)
+            if tracker.callback:
+                tracker.callback(f"{manifest['name']}: link lost ({e}), resuming...")
+        finally:
+            if conn:
+                conn.close()
+
+    return False, last_error
+
+
+def send_file_chunked(vm_ip, port, filename, chunk_size=FILE_CHUNK_SIZE,
+                      progress=None, retries=5, streams=1):
+    """Stream a file to vm_server.py in verified chunks
+
+    Memory use is one chunk per stream regardless of file size. If a link
+    drops, that stream reconnects and the server only asks for chunks it
+    does not have. With streams > 1 the chunks are split into contiguous
+    stripes sent over parallel connections, which helps fill high-latency
+    links. progress, if given, is called with a human-readable status line.
+    """
+    try:
+        manifest = file_manifest(filename, chunk_size)
+    except OSError as e:
+        return False, str(e)
+
+    count = len(manifest['hashes'])
+    streams = max(1, min(streams, count or 1))
+    stripes = [(count * i // streams, count * (i + 1) // streams) for i in range(streams)]
+    tracker = TransferProgress(manifest['name'], manifest['size'], progress)
+    stats = CompressionStats()
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=streams) as pool:
+        futures = [pool.submit(_send_chunk_range, vm_ip, port, filename, manifest,
+                               stripe, tracker, retries, stats)
+                   for stripe in stripes]
+        results = [future.result() for future in futures]
+
+    failures = [msg for success, msg in results if not success]
+    if failures:
+        return False, failures[0]
+    tracker.finish()
+    summary = stats.summary()
+    if progress and summary['compressed']:
+        progress(f"{manifest['name']}: compressed {summary['raw_bytes'] / (1024 * 1024):.1f} MB "
+                 f"to {summary['wire_bytes'] / (1024 * 1024):.1f} MB "
+                 f"({summary['cpu_seconds']:.2f}s CPU)")
+    return True, "Success"
+
+
+def _walk_tree(root):
+    """List (relative path, lstat) for everything under root, parents first"""
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        rel_dir = os.path.relpath(dirpath, root)
+        for name in dirnames + sorted(filenames):
+            path = os.path.join(dirpath, name)
+            rel = name if rel_dir == os.curdir else os.path.join(rel_dir, name)
+            entries.append((rel.replace(os.sep, '/'), os.lstat(path)))
+    return entries
+
+
+class ArchiveStream:
+    """Packs tar-like entries into DIR_DATA frames of about batch_size bytes
+
+    Thousands of small files end up in a handful of frames on one
+    connection; big files are streamed through a reused read buffer.
+    """
+
+    def __init__(self, conn, batch_size=256 * 1024):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.batch = bytearray()
+        self.read_buf = bytearray(FILE_CHUNK_SIZE)
+
+    def add_entry(self, entry):
+        header = encode_json(entry)
+        self.batch += ENTRY_HEADER.pack(len(header))
+        self.batch += header
+
+    def add_file(self, f, size, tracker):
+        view = memoryview(self.read_buf)
+        remaining = size
+        while remaining:
+            n = f.readinto(view[:min(remaining, len(self.read_buf))])
+            if not n:
+                # File shrank since it was listed: pad to the announced size
+                n = min(remaining, len(self.read_buf))
+                view[:n] = bytes(n)
+            if len(self.batch) + n <= self.batch_size:
+                self.batch += view[:n]
+            else:
+                self.flush()
+                self.conn.send_payload(FRAME_DIR_DATA, [view[:n]])
+            remaining -= n
+            tracker.advance(n)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.conn.send_payload(FRAME_DIR_DATA, [self.batch])
+            self.batch = bytearray()
+
+
+def send_directory(vm_ip, port, dirname, progress=None):
+    """Stream a directory tree to vm_server.py as one tar-like archive
+
+    Uses a single connection, keeps file modes and mtimes, and the VM
+    extracts entries as they arrive.
+    """
+    root = os.path.abspath(dirname)
+    name = os.path.basename(root.rstrip(os.sep))
+    try:
+        entries = _walk_tree(root)
+    except OSError as e:
+        return False, str(e)
+
+    total = sum(st.st_size for _, st in entries if stat.S_ISREG(st.st_mode))
+    tracker = TransferProgress(name, total, progress)
+    conn = None
+    try:
+        sock = socket.create_connection((vm_ip, port), timeout=10)
+        sock.settimeout(30)
+        conn = Connection(sock, framing="frame", compress_level=1)
+        conn.handshake(hello={'client': 'auto_installer', 'role': 'transfer'})
+        conn.send_frame(FRAME_DIR_BEGIN, encode_json({'name': name}))
+        stream = ArchiveStream(conn)
+        skipped = 0
+
+        for rel, st in entries:
+            meta = {'path': rel, 'mode': stat.S_IMODE(st.st_mode), 'mtime': st.st_mtime}
+            if stat.S_ISDIR(st.st_mode):
+                stream.add_entry(dict(meta, type='dir'))
+            elif stat.S_ISLNK(st.st_mode):
+                target = os.readlink(os.path.join(root, rel))
+                stream.add_entry(dict(meta, type='symlink', target=target))
+            elif stat.S_ISREG(st.st_mode):
+                try:
+                    f = open(os.path.join(root, rel), 'rb')
+                except OSError:
+                    skipped += 1
+                    continue
+                with f:
+                    stream.add_entry(dict(meta, type='file', size=st.st_size))
+                    stream.add_file(f, st.st_size, tracker)
+
+        stream.flush()
+        conn.send_frame(FRAME_DIR_END)
+        status = conn.expect(FRAME_DIR_STATUS)
+    except (OSError, ProtocolError, ValueError) as e:
+        return False, str(e)
+    finally:
+        if conn:
+            conn.close()
+
+    if 'error' in status:
+        return False, status['error']
+    tracker.finish()
+    errors = status['errors'] + [f"{skipped} unreadable file(s) skipped"] * bool(skipped)
+    msg = f"{status['files']} files, {status['dirs']} folders in {status['root']}"
+    if errors:
+        if progress:
+            for error in errors:
+                progress(f"{name}: {error}")
+        return False, f"{msg}, {len(errors)} error(s)"
+    return True, msg
+
+
+# Gear table for content-defined chunking: one pseudo-random 64-bit value
+# per byte value, derived from sha256 so it never changes between releases
+_GEAR = [int.from_bytes(hashlib.sha256(bytes([b])).digest()[:8], 'big') for b in range(256)]
+_GEAR_WINDOW = 64
+_GEAR_MASK = (1 << 64) - 1
+
+
+def cdc_chunks(f, min_size=896 * 1024, avg_size=1024 * 1024, max_size=4 * 1024 * 1024,
+               block_size=8 * 1024 * 1024):
+    """Split a file into content-defined chunks, yielding (offset, length, sha256)
+
+    Boundaries come from a gear rolling hash over the last 64 bytes, so an
+    insert or delete only changes the chunks around the edit. No chunk may
+    end inside its first min_size bytes, so hashing starts just before that
+    point and only the remaining stretch goes through the Python loop.
+    """
+    bits = max(1, (avg_size - min_size).bit_length() - 1)
+    mask = ((1 << bits) - 1) << (64 - bits)
+    gear = _GEAR
+    buf = b""
+    pos = offset = 0
+    eof = False
+    while True:
+        if not eof and len(buf) - pos < max_size:
+            data = f.read(block_size)
+            eof = not data
+            buf = buf[pos:] + data
+            pos = 0
+            continue
+        if pos == len(buf):
+            return
+        end = min(pos + max_size, len(buf))
+        start = pos + min_size
+        cut = end
+        if end > start:
+            h = 0
+            for b in buf[start - _GEAR_WINDOW:start]:
+                h = ((h << 1) + gear[b]) & _GEAR_MASK
+            for i, b in enumerate(memoryview(buf)[start:end], start + 1):
+                h = ((h << 1) + gear[b]) & _GEAR_MASK
+                if not h & mask:
+                    cut = i
+                    break
+        yield offset, cut - pos, hashlib.sha256(buf[pos:cut]).digest()
+        offset += cut - pos
+        pos = cut
+
+
+def send_file_dedup(vm_ip, port, filename, progress=None):
+    """Push a file to vm_server.py, sending only chunks the VM does not have
+
+    The VM keeps every chunk it has received in a store keyed by sha256, so
+    re-pushing a file with a small edit only transfers the few chunks around
+    the edit. Chunks shared with any earlier push are reused too.
+    """
+    name = os.path.basename(filename)
+    if progress:
+        progress(f"{name}: looking for changed chunks...")
+    try:
+        st = os.stat(filename)
+        with open(filename, 'rb') as f:
+            recipe = list(cdc_chunks(f))
+    except OSError as e:
+        return False, str(e)
+
+    tracker = TransferProgress(name, st.st_size, progress)
+    conn = None
+    try:
+        sock = socket.create_connection((vm_ip, port), timeout=10)
+        sock.settimeout(60)
+        conn = Connection(sock, framing="frame", compress_level=1)
+        conn.handshake(hello={'client': 'auto_installer', 'role': 'transfer'})
+
+        unique = {}
+        for offset, length, digest in recipe:
+            unique.setdefault(digest, (offset, length))
+        digests = list(unique)
+        conn.send_payload(FRAME_DEDUP_QUERY, [b"".join(digests)])
+        missing = conn.expect_frame(FRAME_DEDUP_MISSING)
+        if len(missing) != len(digests):
+            raise ProtocolError("bad reply to chunk query")
+
+        wanted = [d for d, flag in zip(digests, missing) if flag]
+        tracker.skip(st.st_size - sum(unique[d][1] for d in wanted))
+        with open(filename, 'rb') as f:
+            for digest in wanted:
+                offset, length = unique[digest]
+                f.seek(offset)
+                conn.send_payload(FRAME_DEDUP_CHUNK, [digest, f.read(length)])
+                tracker.advance(length)
+
+        header = encode_json({'name': name, 'size': st.st_size,
+                              'mode': stat.S_IMODE(st.st_mode), 'mtime': st.st_mtime})
+        conn.send_payload(FRAME_DEDUP_COMMIT, [ENTRY_HEADER.pack(len(header)), header] +
+                          [digest for _, _, digest in recipe])
+        status = conn.expect(FRAME_DEDUP_STATUS)
+    except (OSError, ProtocolError, ValueError) as e:
+        return False, str(e)
+    finally:
+        if conn:
+            conn.close()
+
+    if 'error' in status:
+        return False, status['error']
+    tracker.finish()
+    if progress:
+        sent = sum(unique[d][1] for d in wanted)
+        progress(f"{name}: sent {len(wanted)} of {len(recipe)} chunks "
+                 f"({sent / (1024 * 1024):.1f} of {st.st_size / (1024 * 1024):.1f} MB)")
+    return True, "Success"
+
+
+def edge_color(img):
+    """Average colour of the border of an RGB image
+
+    Samples the same points as the original getpixel loop (about 20 per
+    side), so the cost does not grow with the image, but reads them
+    through the pixel access object, which skips getpixel's per-call checks.
+    """
+    w, h = img.size
+    step = max(1, w // 20)
+    pixels = img.load()
+    points = [(x, y) for x in range(0, w, step) for y in (0, h - 1)]
+    points += [(x, y) for y in range(0, h, step) for x in (0, w - 1)]
+    colors = [pixels[point] for point in points]
+    return tuple(sum(c[i] for c in colors) // len(colors) for i in range(3))
+
+
+def load_background_source(max_size=None):
+    """Decode the background image once: (cropped image, edge colour) or None
+
+    max_size is the largest (width, height) it will be drawn at, normally
+    the screen size. JPEGs are then decoded at the smallest 1/2, 1/4 or 1/8
+    scale that still covers it, which is far quicker for camera photos.
+    """
     background_files = ['rass_wajih.jpg', 'background.jpg', 'background.png', 'bg.jpg', 'bg.png']
 
     for bg_file in background_files:
@@ -241,91 +764,495 @@ def create_gradient_background(width, height):
                 print(f"Loading background image: {bg_file}")
                 img = Image.open(bg_file)
 
+                img_width, img_height = img.size
+                print(f"Image size: {img_width}x{img_height}")
+                portrait = img_height > img_width * 1.3
+
+                if max_size:
+                    # Portrait images lose their top 40% below, so ask for more height
+                    need_height = max_size[1] / 0.6 if portrait else max_size[1]
+                    img.draft('RGB', (max_size[0], int(need_height) + 1))
+
                 if img.mode != 'RGB':
                     img = img.convert('RGB')
-
                 img_width, img_height = img.size
-                print(f"Image size: {img_width}x{img_height}")
 
                 # Focus on bottom 50% of image for portrait images
-                if img_height > img_width * 1.3:  # Portrait orientation
+                if portrait:
                     # Crop to bottom 60%
                     crop_start = int(img_height * 0.4)
                     img = img.crop((0, crop_start, img_width, img_height))
-                    img_width, img_height = img.size
-
-                # Get edge colors for filling
-                edge_colors = []
-                step = max(1, img.width // 20)
-                for x in range(0, img.width, step):
-                    edge_colors.append(img.getpixel((x, 0)))
-                    edge_colors.append(img.getpixel((x, img.height - 1)))
-                for y in range(0, img.height, step):
-                    edge_colors.append(img.getpixel((0, y)))
-                    edge_colors.append(img.getpixel((img.width - 1, y)))
-
-                avg_r = sum(c[0] for c in edge_colors) // len(edge_colors)
-                avg_g = sum(c[1] for c in edge_colors) // len(edge_colors)
-                avg_b = sum(c[2] for c in edge_colors) // len(edge_colors)
-                bg_color = (avg_r, avg_g, avg_b)
-
-                # Calculate scaling
-                img_aspect = img_width / img_height
-                window_aspect = width / height
-
-                if window_aspect > img_aspect:
-                    new_height = height
-                    new_width = int(height * img_aspect)
-                else:
-                    new_width = width
-                    new_height = int(width / img_aspect)
-
-                img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-
-                canvas = Image.new('RGB', (width, height), bg_color)
-
-                x_offset = (width - new_width) // 2
-                y_offset = (height - new_height) // 2
-
-                canvas.paste(img, (x_offset, y_offset))
 
+                img.load()
                 print(f"✓ Background loaded from {bg_file}")
-                return canvas
+                return img, edge_color(img)
             except Exception as e:
                 print(f"✗ Failed to load {bg_file}: {e}")
                 continue
 
-    # Fallback gradient
     print("No background image found, using gradient")
-    image = Image.new('RGB', (width, height))
-    draw = ImageDraw.Draw(image)
+    return None
+
+
+def render_background(source, width, height):
+    """Fit a loaded background source into width x height"""
+    if source is None:
+        return _gradient(width, height)
+
+    img, bg_color = source
+    img_width, img_height = img.size
+
+    # Calculate scaling
+    img_aspect = img_width / img_height
+    window_aspect = width / height
+
+    if window_aspect > img_aspect:
+        new_height = height
+        new_width = int(height * img_aspect)
+    else:
+        new_width = width
+        new_height = int(width / img_aspect)
+
+    # reducing_gap lets Pillow shrink by whole factors first, then LANCZOS
+    img = img.resize((new_width, new_height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+    canvas = Image.new('RGB', (width, height), bg_color)
+
+    x_offset = (width - new_width) // 2
+    y_offset = (height - new_height) // 2
+
+    canvas.paste(img, (x_offset, y_offset))
+    return canvas
+
+
+GRADIENT_TOP = (44, 62, 80)
+GRADIENT_BOTTOM = (52, 152, 219)
+
+
+def _gradient(width, height):
+    """Fallback gradient, built as one column and stretched in C"""
+    ramp = Image.linear_gradient('L').resize((1, height), Image.Resampling.BILINEAR)
+    bands = [ramp.point([int(top + (bottom - top) * v / 255) for v in range(256)])
+             for top, bottom in zip(GRADIENT_TOP, GRADIENT_BOTTOM)]
+    return Image.merge('RGB', bands).resize((width, height), Image.Resampling.NEAREST)
 
-    for y in range(height):
-        ratio = y / height
-        r = int(44 + (52 - 44) * ratio)
-        g = int(62 + (152 - 62) * ratio)
-        b = int(80 + (219 - 80) * ratio)
-        draw.line([(0, y), (width, y)], fill=(r, g, b))
 
-    return image
+def create_gradient_background(width, height):
+    """Create background from image, focusing on bottom 50%"""
+    return render_background(load_background_source((width, height)), width, height)
+
+
+class BackgroundRenderer:
+    """Renders window backgrounds on a worker thread
+
+    The source image is decoded, cropped and its edge colour measured once.
+    Finished sizes are kept as PhotoImages in a small LRU, so returning to
+    an earlier size is instant. The Tk thread only builds the PhotoImage
+    and hands it to on_ready; it never decodes or resizes. Every request
+    gets a generation number, and only a render for the newest one is
+    shown; older renders still go into the cache.
+    """
+
+    def __init__(self, widget, on_ready, cache_size=4, poll_ms=16):
+        self.widget = widget
+        self.max_size = (widget.winfo_screenwidth(), widget.winfo_screenheight())
+        self.on_ready = on_ready
+        self.cache_size = cache_size
+        self.poll_ms = poll_ms
+        self._photos = OrderedDict()  # (width, height) -> PhotoImage, Tk thread only
+        self._generation = 0  # of the newest request, Tk thread only
+        self._wanted = None  # (generation, size) the worker has not picked up yet
+        self._waiting = False  # the newest request still waits for a render
+        self._cond = threading.Condition()
+        self._results = deque()  # (generation, size, image), newest last
+        threading.Thread(target=self._work, daemon=True).start()
+
+    def request(self, width, height):
+        """Show a background for this size as soon as one is ready"""
+        size = (width, height)
+        self._generation += 1
+        photo = self._photos.get(size)
+        if photo is not None:
+            self._photos.move_to_end(size)
+            self._waiting = False
+            self.on_ready(photo)
+            return
+        polling = self._waiting
+        self._waiting = True
+        with self._cond:
+            # Only the newest size matters; sizes a drag passed through are dropped
+            self._wanted = (self._generation, size)
+            self._cond.notify()
+        if not polling:
+            self.widget.after(self.poll_ms, self._poll)
+
+    def _work(self):
+        source = load_background_source(self.max_size)
+        while True:
+            with self._cond:
+                while self._wanted is None:
+                    self._cond.wait()
+                (generation, size), self._wanted = self._wanted, None
+            try:
+                self._results.append((generation, size, render_background(source, *size)))
+            except Exception as e:
+                print(f"✗ Failed to render background: {e}")
+                self._results.append((generation, size, None))
+
+    def _poll(self):
+        if not self._waiting:
+            return
+        while self._results:
+            generation, size, image = self._results.popleft()
+            photo = None
+            if image is not None:
+                photo = ImageTk.PhotoImage(image)
+                self._photos[size] = photo
+                while len(self._photos) > self.cache_size:
+                    self._photos.popitem(last=False)
+            if generation == self._generation:
+                # Older generations only fill the cache: the window moved on
+                self._waiting = False
+                if photo is not None:
+                    self.on_ready(photo)
+                return
+        self.widget.after(self.poll_ms, self._poll)
 
 
 # ============================================
 # LIVE CHAT CLIENT
 # ============================================
 
+class ScrollbackStore:
+    """Append-only chat history kept off the Tk widget
+
+    Messages are JSON lines in an anonymous temporary file. Their start
+    offsets sit in an array('Q'), so any page is one seek and one read,
+    and memory grows by only 8 bytes per message.
+    """
+
+    def __init__(self):
+        import tempfile
+
+        self._file = tempfile.TemporaryFile()
+        self._offsets = array('Q')
+        self._end = 0
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def extend(self, timestamp, messages):
+        """Append (sender, text[, image id]) tuples with one write"""
+        start = self._end
+        records = []
+        for message in messages:
+            record = encode_json([timestamp, *message]) + b"\n"
+            records.append(record)
+            self._offsets.append(self._end)
+            self._end += len(record)
+        self._file.seek(start)
+        self._file.write(b"".join(records))
+
+    def page(self, start, end):
+        """Messages start..end-1 as (timestamp, sender, text[, image id]) tuples"""
+        start, end = max(0, start), min(end, len(self._offsets))
+        if start >= end:
+            return []
+        stop = self._offsets[end] if end < len(self._offsets) else self._end
+        self._file.seek(self._offsets[start])
+        data = self._file.read(stop - self._offsets[start])
+        return [tuple(decode_json(line)) for line in data.splitlines()]
+
+    def clear(self):
+        self._file.seek(0)
+        self._file.truncate()
+        self._offsets = array('Q')
+        self._end = 0
+
+    def close(self):
+        self._file.close()
+
+
+def encode_clipboard_image(image, fmt="png"):
+    """Re-encode a Pillow image for sending; returns (bytes, content type)
+
+    png is lossless; webp and jpeg trade a little quality for much smaller
+    screenshots on slow links.
+    """
+    buf = io.BytesIO()
+    if fmt == "webp":
+        image.save(buf, "WEBP", quality=90, method=4)
+    elif fmt == "jpeg":
+        image.convert("RGB").save(buf, "JPEG", quality=90, optimize=True)
+    else:
+        fmt = "png"
+        image.save(buf, "PNG", compress_level=6)
+    return buf.getvalue(), f"image/{fmt}"
+
+
+class TkClipboard:
+    """Clipboard access through a Tk widget
+
+    change_count() returns the Windows clipboard sequence number, which
+    costs nothing to read, so the watcher only fetches the content when it
+    changed. Elsewhere it returns None: other hosts can only be polled, by
+    fetching the content and comparing it.
+    Images (Windows with Pillow) are read with ImageGrab and written as a
+    DIB; both work from any thread. Any object with the same methods can
+    be used as a backend instead.
+    """
+
+    def __init__(self, widget):
+        self.widget = widget
+        self._sequence = None
+        if sys.platform == "win32":
+            try:
+                import ctypes
+                self._sequence = ctypes.windll.user32.GetClipboardSequenceNumber
+            except (ImportError, AttributeError, OSError):
+                pass
+        self.images = self._sequence is not None and load_pil()
+
+    def change_count(self):
+        return self._sequence() if self._sequence else None
+
+    def get(self):
+        try:
+            return self.widget.clipboard_get()
+        except tk.TclError:
+            return None  # empty, or not text
+
+    def set(self, text):
+        self.widget.clipboard_clear()
+        self.widget.clipboard_append(text)
+
+    def grab_image(self):
+        from PIL import ImageGrab
+        image = ImageGrab.grabclipboard()
+        return image if isinstance(image, Image.Image) else None
+
+    def set_image(self, data):
+        import ctypes
+        from ctypes import wintypes
+        buf = io.BytesIO()
+        Image.open(io.BytesIO(data)).convert("RGB").save(buf, "BMP")
+        dib = buf.getvalue()[14:]  # a DIB is a BMP without its file header
+        kernel32, user32 = ctypes.windll.kernel32, ctypes.windll.user32
+        kernel32.GlobalAlloc.restype = ctypes.c_void_p
+        kernel32.GlobalAlloc.argtypes = [wintypes.UINT, ctypes.c_size_t]
+        kernel32.GlobalLock.restype = ctypes.c_void_p
+        kernel32.GlobalLock.argtypes = [ctypes.c_void_p]
+        kernel32.GlobalUnlock.argtypes = [ctypes.c_void_p]
+        user32.SetClipboardData.argtypes = [wintypes.UINT, ctypes.c_void_p]
+        handle = kernel32.GlobalAlloc(0x0002, len(dib))  # GMEM_MOVEABLE
+        ctypes.memmove(kernel32.GlobalLock(handle), dib, len(dib))
+        kernel32.GlobalUnlock(handle)
+        if not user32.OpenClipboard(None):
+            raise OSError("clipboard is busy")
+        try:
+            user32.EmptyClipboard()
+            user32.SetClipboardData(8, handle)  # CF_DIB; the clipboard owns it now
+        finally:
+            user32.CloseClipboard()
+
+
+class ClipboardWatcher:
+    """Reports clipboard changes on the Tk thread
+
+    Runs on widget.after() every interval_ms. Without a change count
+    (anything but Windows) each poll fetches the whole clipboard, so while
+    it stays unchanged the interval doubles up to max_interval_ms, and
+    drops back to interval_ms on the next change. New text goes to
+    on_text(text). When the clipboard changed but holds no text,
+    on_image() is called so the caller can grab the image off the Tk
+    thread; that needs change_count(), as grabbing on every poll would be
+    too slow. Text that set() put there is not reported back, so remote
+    updates do not echo.
+    """
+
+    def __init__(self, widget, on_text, on_image=None, backend=None, interval_ms=50,
+                 max_interval_ms=1000):
+        self.widget = widget
+        self.on_text = on_text
+        self.on_image = on_image
+        self.backend = backend or TkClipboard(widget)
+        self.interval_ms = interval_ms
+        self.max_interval_ms = max_interval_ms
+        self.delay_ms = interval_ms
+        self._count = self.backend.change_count()
+        self._last = self.backend.get()  # what is there already is not a change
+        widget.after(interval_ms, self.poll)
+
+    def poll(self):
+        if not self.widget.winfo_exists():
+            return
+        count = self.backend.change_count()
+        changed = False
+        if count is None or count != self._count:
+            self._count = count
+            text = self.backend.get()
+            if text is not None:
+                if text != self._last:
+                    self._last = text
+                    changed = True
+                    self.on_text(text)
+            elif count is not None and self.on_image and getattr(self.backend, "images", False):
+                self._last = None
+                self.on_image()
+        if count is None and not changed:
+            self.delay_ms = min(self.delay_ms * 2, self.max_interval_ms)
+        else:
+            self.delay_ms = self.interval_ms
+        self.widget.after(self.delay_ms, self.poll)
+
+    def set(self, text):
+        self._last = text
+        self.backend.set(text)
+        self._count = self.backend.change_count()
+        self.delay_ms = self.interval_ms
+
+
+def format_bytes(n):
+    for unit in ("B", "KB", "MB"):
+        if n < 1024:
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} GB"
+
+
+class LinkMonitor:
+    """Heartbeat bookkeeping for one chat link
+
+    Keeps the last `samples` PING round trips for p50/p99 and the byte
+    counters of the previous readout, so throughput is reported per
+    interval rather than per session.
+    """
+
+    def __init__(self, samples=200):
+        self.rtts = deque(maxlen=samples)  # milliseconds
+        self.remote_backlog = 0
+        self._conn = None
+        self._counters = (0, 0, time.monotonic())
+
+    def pong(self, payload):
+        token = SEQ.unpack_from(payload)[0]
+        self.rtts.append(max(0.0, time.time() * 1e6 - token) / 1000)
+        METRICS.observe("rtt_seconds", self.rtts[-1] / 1000)
+        if len(payload) >= 2 * SEQ.size:
+            self.remote_backlog = SEQ.unpack_from(payload, SEQ.size)[0]
+
+    def percentile(self, q):
+        if not self.rtts:
+            return None
+        ordered = sorted(self.rtts)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def rates(self, conn):
+        """(sent, received) bytes per second since the previous call"""
+        now = time.monotonic()
+        sent, received = conn.bytes_out, conn.bytes_in
+        if conn is not self._conn:
+            self._conn, self._counters = conn, (sent, received, now)
+            return 0.0, 0.0
+        last_sent, last_received, then = self._counters
+        self._counters = (sent, received, now)
+        elapsed = max(now - then, 1e-6)
+        return (sent - last_sent) / elapsed, (received - last_received) / elapsed
+
+    def summary(self, conn, queued):
+        up, down = self.rates(conn)
+        p50, p99 = self.percentile(0.5), self.percentile(0.99)
+        rtt = f"RTT {p50:.1f}/{p99:.1f} ms (p50/p99)" if p50 is not None else "RTT -"
+        return (f"{rtt} | \u2191 {format_bytes(up)}/s \u2193 {format_bytes(down)}/s | "
+                f"queued {format_bytes(queued)} here, {format_bytes(self.remote_backlog)} on VM")
+
+
 class LiveChatClient:
     """Live chat client"""
 
-    def __init__(self, parent, vm_ip, port, on_close_callback):
+    def __init__(self, parent, vm_ip, port, on_close_callback, framing="auto",
+                 scrollback=2000, page_size=500, flush_ms=25, max_per_flush=2000,
+                 backoff_min=0.05, backoff_max=2.0, heartbeat_interval=1.0,
+                 heartbeat_timeout=5.0, clipboard_sync=True, image_format="png",
+                 thumbnail_size=240, thumbnails=100, history_file=None, search_delay_ms=60):
         self.parent = parent
         self.vm_ip = vm_ip
         self.port = port
         self.on_close_callback = on_close_callback
-        self.connected = False
-        self.sock = None
-        self.reader_thread = None
-        self.running = False
+        self.status = None  # (text, colour) for the next flush
+
+        # The link itself is a ChatClient: it resumes the session after a
+        # dropped link, reconnecting with jittered exponential backoff, and
+        # pings every heartbeat_interval. A link on which nothing arrives for
+        # heartbeat_timeout is treated as dead and reconnected. Its callbacks
+        # run on its reader thread and only queue work for the next flush.
+        self.monitor = LinkMonitor()
+        self.heartbeat_interval = heartbeat_interval
+        self.vm_line = []  # pieces of a long VM line, until its last one
+        self.client = ChatClient(vm_ip, port, on_text=self.on_vm_text,
+                                 on_status=self.on_link_status, on_closed=self.disconnect,
+                                 on_clipboard=self.receive_clipboard, on_pong=self.monitor.pong,
+                                 heartbeat=heartbeat_timeout, ping_interval=heartbeat_interval,
+                                 backoff_min=backoff_min, backoff_max=backoff_max,
+                                 framing=framing, hello={"client": "auto_installer"})
+
+        # Clipboard sync: items are sent piece by piece from clip_worker so
+        # big images never block the Tk thread, and the newest item received
+        # from the VM waits in remote_clip for the next flush. The client's
+        # ClipboardState already records what came from the VM, so local
+        # copies are checked against it to avoid echoing those back.
+        self.clip = self.client.clip
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.clip_worker = ThreadPoolExecutor(max_workers=1)
+        self.remote_clip = None
+        self.own_image_count = None  # change count after we set an image
+        self.clipboard_sync = clipboard_sync
+        self.image_format = image_format
+
+        # Image thumbnails are decoded on thumb_worker; the Tk thread only
+        # wraps the finished thumbnail in a PhotoImage. The newest are kept.
+        self.thumbnail_size = thumbnail_size
+        self.max_thumbnails = thumbnails
+        self.thumb_worker = ThreadPoolExecutor(max_workers=1)
+        self.thumbs_ready = deque()
+        self.thumbnails = OrderedDict()  # image id -> PhotoImage
+        self.image_ids = 0
+
+        METRICS.gauge("chat_incoming_queue", lambda: len(self.incoming))
+        METRICS.gauge("chat_replay_bytes", self.client.replay.pending_bytes)
+
+        # The widget only holds messages first..last-1 of the history; older
+        # or newer pages are loaded from the store as the user scrolls
+        self.history = ScrollbackStore()
+        self.scrollback = scrollback
+        self.page_size = page_size
+        self.shown_first = self.shown_last = 0
+        self.shown_lines = deque()  # widget lines per shown message
+        self._paging = False
+
+        # Messages from any thread wait here until the next Tk-side flush,
+        # and so do widget calls made from the reader and connect threads
+        self.incoming = deque()
+        self.tk_calls = deque()
+        self.flush_ms = flush_ms
+        self.max_per_flush = max_per_flush
+
+        # Everything sent and received is logged to a HistoryStore (its own
+        # writer thread, so nothing here waits for the disk). Searches run
+        # on search_worker as the user types; the newest result list waits
+        # in search_results for the next flush.
+        self.store = None
+        if history_file:
+            try:
+                self.store = HistoryStore(history_file)
+            except Exception as e:
+                self.add_message(f"History is off: cannot open {history_file} ({e})")
+        self.search_worker = ThreadPoolExecutor(max_workers=1)
+        self.search_delay_ms = search_delay_ms
+        self.search_pending = None  # after() id of the debounced search
+        self.search_serial = 0
+        self.search_results = None  # (serial, rows)
 
         self.window = tk.Toplevel(parent)
         self.window.title(f"Live Chat - {vm_ip}:{port} | by mouones (vibecoding)")
@@ -334,6 +1261,10 @@ class LiveChatClient:
         self.window.protocol("WM_DELETE_WINDOW", self.close)
 
         self.create_widgets()
+        self.clipboard_watcher = ClipboardWatcher(self.window, self.on_clipboard_text,
+                                                  self.on_clipboard_image)
+        self.window.after(self.flush_ms, self.flush_messages)
+        self.window.after(int(self.heartbeat_interval * 1000), self.refresh_stats)
         self.connect()
 
     def create_widgets(self):
@@ -344,7 +1275,11 @@ class LiveChatClient:
 
         self.status_label = tk.Label(status_frame, text="Connecting...",
                                      font=("Arial", 11, "bold"), fg="white", bg="#27ae60")
-        self.status_label.pack(pady=10)
+        self.status_label.pack(side=tk.LEFT, padx=10, pady=10)
+
+        self.stats_label = tk.Label(status_frame, text="", font=("Consolas", 9),
+                                    fg="white", bg="#27ae60")
+        self.stats_label.pack(side=tk.RIGHT, padx=10, pady=10)
 
         main_container = tk.Frame(self.window)
         main_container.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
@@ -352,6 +1287,26 @@ class LiveChatClient:
         chat_frame = tk.Frame(main_container)
         chat_frame.pack(fill=tk.BOTH, expand=True, side=tk.TOP)
 
+        search_frame = tk.Frame(chat_frame)
+        search_frame.pack(fill=tk.X, pady=(0, 5))
+        tk.Label(search_frame, text="Search history:", font=("Arial", 10, "bold")).pack(side=tk.LEFT)
+        self.search_var = tk.StringVar()
+        self.search_entry = tk.Entry(search_frame, textvariable=self.search_var, font=("Arial", 10),
+                                     state=tk.NORMAL if self.store else tk.DISABLED)
+        self.search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(5, 0))
+        self.search_entry.bind("<KeyRelease>", self.on_search_key)
+        self.search_entry.bind("<Escape>", lambda event: (self.search_var.set(""), self.run_search()))
+
+        # Shown only while there is a query; a click on "re-send" sends that item again
+        self.results = tk.Text(chat_frame, height=8, font=("Consolas", 9), bg="#fdfefe",
+                               wrap=tk.NONE, state=tk.DISABLED, cursor="arrow")
+        self.results.tag_config("meta", foreground="#7f8c8d")
+        self.results.tag_config("resend", foreground="#2980b9", underline=True)
+        self.results.tag_bind("resend", "<Button-1>", self.on_resend_click)
+        self.results.tag_bind("resend", "<Enter>", lambda e: self.results.config(cursor="hand2"))
+        self.results.tag_bind("resend", "<Leave>", lambda e: self.results.config(cursor="arrow"))
+        self.search_frame = search_frame
+
         tk.Label(chat_frame, text="Conversation", font=("Arial", 10, "bold")).pack(anchor=tk.W)
 
         self.chat_display = scrolledtext.ScrolledText(chat_frame,
@@ -359,6 +1314,7 @@ class LiveChatClient:
                                                       bg="#ecf0f1", fg="#2c3e50",
                                                       wrap=tk.WORD, state=tk.DISABLED)
         self.chat_display.pack(fill=tk.BOTH, expand=True, pady=5)
+        self.chat_display.configure(yscrollcommand=self.on_chat_scroll)
 
         self.chat_display.tag_config("you", foreground="#2980b9", font=("Consolas", 10, "bold"))
         self.chat_display.tag_config("vm", foreground="#27ae60", font=("Consolas", 10, "bold"))
@@ -392,6 +1348,11 @@ class LiveChatClient:
                               width=15, height=2)
         clear_btn.pack(side=tk.LEFT)
 
+        self.clipboard_var = tk.BooleanVar(value=self.clipboard_sync)
+        tk.Checkbutton(button_frame, text="Sync clipboard", variable=self.clipboard_var,
+                       command=lambda: setattr(self, "clipboard_sync", self.clipboard_var.get()),
+                       font=("Arial", 10)).pack(side=tk.LEFT, padx=(10, 0))
+
         info_label = tk.Label(input_frame, text="Ctrl+V to paste | Enter to send",
                               font=("Arial", 9, "italic"), fg="#7f8c8d", bg="white")
         info_label.pack(pady=(5, 0))
@@ -404,36 +1365,212 @@ class LiveChatClient:
             self.send_message()
             return "break"
 
-    def add_message(self, text, sender="system"):
-        if not self.window.winfo_exists():
-            return
+    def add_message(self, text, sender="system", image=None):
+        """Queue a message for the next flush; safe to call from any thread
 
-        def gui_update():
-            if not self.window.winfo_exists():
-                return
+        image is the id of a thumbnail shown at the end of the message.
+        """
+        self.incoming.append((sender, text) if image is None else (sender, text, image))
 
-            self.chat_display.config(state=tk.NORMAL)
-            timestamp = time.strftime("%H:%M:%S")
+    def add_image(self, ctype, data, sender):
+        """Show a clipboard image as a message with a thumbnail; any thread"""
+        self.image_ids += 1
+        image_id = self.image_ids
+        self.add_message(f"Clipboard image ({ctype}, {format_bytes(len(data))})", sender, image_id)
+        if load_pil():
+            self.thumb_worker.submit(self.decode_thumbnail, image_id, data)
 
-            if sender == "you":
-                self.chat_display.insert(tk.END, f"[{timestamp}] You: ", "you")
-                self.chat_display.insert(tk.END, f"{text}\n")
-            elif sender == "vm":
-                self.chat_display.insert(tk.END, f"[{timestamp}] VM: ", "vm")
-                self.chat_display.insert(tk.END, f"{text}\n")
-            else:
-                self.chat_display.insert(tk.END, f"[{timestamp}] {text}\n", "system")
+    def decode_thumbnail(self, image_id, data):
+        """Runs on thumb_worker: decode and shrink, leaving Tk the cheap part"""
+        try:
+            image = Image.open(io.BytesIO(data))
+            image.thumbnail((self.thumbnail_size, self.thumbnail_size))
+            image = image.convert("RGBA")
+        except Exception:
+            return  # not an image Pillow can read; the message stays text-only
+        self.thumbs_ready.append((image_id, image))
+
+    def show_thumbnail(self, image_id, image=None):
+        """Put a decoded thumbnail into the view, if its message is shown"""
+        if image is not None:
+            self.thumbnails[image_id] = ImageTk.PhotoImage(image)
+            while len(self.thumbnails) > self.max_thumbnails:
+                self.thumbnails.popitem(last=False)
+        photo = self.thumbnails.get(image_id)
+        ranges = self.chat_display.tag_ranges(f"thumb-{image_id}")
+        if photo is None or not ranges:
+            return
+        self.chat_display.config(state=tk.NORMAL)
+        self.chat_display.image_create(ranges[0], image=photo)
+        self.chat_display.config(state=tk.DISABLED)
 
-            self.chat_display.config(state=tk.DISABLED)
-            self.chat_display.see(tk.END)
+    def flush_messages(self):
+        """Move queued messages into the history and the widget, once per frame
 
-        self.chat_display.after(0, gui_update)
+        At most max_per_flush messages are handled per tick, so a flood
+        arriving from the network cannot stall the Tk thread.
+        """
+        if not self.window.winfo_exists():
+            return
+
+        while self.tk_calls:
+            func, args = self.tk_calls.popleft()
+            func(*args)
+            if not self.window.winfo_exists():
+                return  # the call closed the window
+
+        if self.status:
+            text, colour = self.status
+            self.status = None
+            self.status_label.config(text=text, bg=colour)
+            self.stats_label.config(bg=colour)
+            self.status_label.master.config(bg=colour)
+
+        if self.remote_clip is not None:
+            (ctype, data), self.remote_clip = self.remote_clip, None
+            if self.clipboard_sync:
+                self.apply_clipboard(ctype, data)
+        if self.clip.pending is not None:
+            item = self.clip.due()
+            if item is not None:
+                self.clip_worker.submit(self.send_clipboard, *item)
+        while self.thumbs_ready:
+            self.show_thumbnail(*self.thumbs_ready.popleft())
+        if self.search_results is not None:
+            (serial, rows), self.search_results = self.search_results, None
+            if serial == self.search_serial:
+                self.show_results(rows)
+
+        if self.incoming:
+            started = time.perf_counter()
+            count = min(len(self.incoming), self.max_per_flush)
+            tail_shown = self.shown_last == len(self.history)
+            self.history.extend(time.strftime("%H:%M:%S"),
+                                [self.incoming.popleft() for _ in range(count)])
+            if tail_shown:
+                # Only follow new output while the newest page is on screen
+                follow = self.chat_display.yview()[1] >= 1.0
+                top = self.chat_display.index("@0,0")
+                if count >= self.scrollback:
+                    # The flood alone fills the view: redraw rather than trim
+                    self.chat_display.config(state=tk.NORMAL)
+                    self.chat_display.delete("1.0", tk.END)
+                    self.chat_display.config(state=tk.DISABLED)
+                    self.shown_lines.clear()
+                    self.shown_first = self.shown_last = len(self.history) - self.scrollback
+                self.show_messages(self.history.page(self.shown_last, len(self.history)), tk.END)
+                removed = self.trim_scrollback(keep_end=True)
+                if follow:
+                    self.chat_display.see(tk.END)
+                elif removed:
+                    self.chat_display.yview(f"{max(1, int(top.split('.')[0]) - removed)}.0")
+            METRICS.observe("chat_flush_seconds", time.perf_counter() - started)
+
+        self.window.after(1 if self.incoming else self.flush_ms, self.flush_messages)
+
+    @staticmethod
+    def format_message(timestamp, sender, text, image=None):
+        """Text/tag pairs for one message, ending in a newline"""
+        if image is not None:
+            # The thumbnail goes in front of the tagged space, on the same line
+            end = [f"{text} ", (), " ", (f"thumb-{image}",), "\n", ()]
+        else:
+            end = [f"{text}\n", ()]
+        if sender == "you":
+            return [f"[{timestamp}] You: ", "you", *end]
+        elif sender == "vm":
+            return [f"[{timestamp}] VM: ", "vm", *end]
+        return [f"[{timestamp}] {text}\n", "system"]
+
+    def show_messages(self, messages, where):
+        """Insert messages at tk.END or "1.0" in one widget call"""
+        if not messages:
+            return
+        args = []
+        lines = []
+        for message in messages:
+            args += self.format_message(*message)
+            lines.append(message[2].count("\n") + 1)
+        self.chat_display.config(state=tk.NORMAL)
+        self.chat_display.insert(where, *args)
+        self.chat_display.config(state=tk.DISABLED)
+        for message in messages:
+            if len(message) > 3 and message[3] in self.thumbnails:
+                self.show_thumbnail(message[3])
+        if where == tk.END:
+            self.shown_lines.extend(lines)
+            self.shown_last += len(messages)
+        else:
+            self.shown_lines.extendleft(reversed(lines))
+            self.shown_first -= len(messages)
+
+    def trim_scrollback(self, keep_end):
+        """Drop a whole page from the far side once over the scrollback limit
+
+        Returns the number of widget lines removed.
+        """
+        excess = len(self.shown_lines) - self.scrollback
+        if excess < max(1, min(self.page_size, self.scrollback // 4)):
+            return 0
+        lines = 0
+        self.chat_display.config(state=tk.NORMAL)
+        if keep_end:
+            for _ in range(excess):
+                lines += self.shown_lines.popleft()
+            self.chat_display.delete("1.0", f"{lines + 1}.0")
+            self.shown_first += excess
+        else:
+            for _ in range(excess):
+                lines += self.shown_lines.pop()
+            self.chat_display.delete(f"end - {lines + 1} lines", "end - 1 chars")
+            self.shown_last -= excess
+        self.chat_display.config(state=tk.DISABLED)
+        return lines
+
+    def on_chat_scroll(self, first, last):
+        """Scrollbar callback; pages history in when either edge is reached"""
+        self.chat_display.vbar.set(first, last)
+        if self._paging:
+            return
+        if float(first) <= 0.0 and self.shown_first > 0:
+            self._paging = True
+            self.chat_display.after_idle(self.load_older)
+        elif float(last) >= 1.0 and self.shown_last < len(self.history):
+            self._paging = True
+            self.chat_display.after_idle(self.load_newer)
+
+    def load_older(self):
+        start = max(0, self.shown_first - self.page_size)
+        page = self.history.page(start, self.shown_first)
+        added = sum(message[2].count("\n") + 1 for message in page)
+        self.show_messages(page, "1.0")
+        self.trim_scrollback(keep_end=False)
+        self.chat_display.yview(f"{added + 1}.0")  # keep the same line on top
+        self._paging = False
+
+    def load_newer(self):
+        top = self.chat_display.index("@0,0")
+        self.show_messages(self.history.page(self.shown_last, self.shown_last + self.page_size), tk.END)
+        removed = self.trim_scrollback(keep_end=True)
+        self.chat_display.yview(f"{max(1, int(top.split('.')[0]) - removed)}.0")
+        self._paging = False
 
     def clear_chat(self):
         """Clear chat"""
         self.chat_display.config(state=tk.NORMAL)
         self.chat_display.delete(1.0, tk.END)
         self.chat_display.config(state=tk.DISABLED)
+        self.history.clear()
+        self.shown_first = self.shown_last = 0
+        self.shown_lines.clear()
+
+    def set_status(self, text, colour="#27ae60"):
+        """Update the status bar on the next flush; safe from any thread"""
+        self.status = (text, colour)
+
+    def on_tk(self, func, *args):
+        """Run func(*args) on the Tk thread at the next flush; safe from any thread"""
+        self.tk_calls.append((func, args))
 
     def connect(self):
         """Connect to VM"""
@@ -441,89 +1578,250 @@ class LiveChatClient:
         def do_connect():
             try:
                 self.add_message(f"Connecting to {self.vm_ip}:{self.port}...")
-                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.sock.settimeout(10)
-                self.sock.connect((self.vm_ip, self.port))
-                self.sock.settimeout(None)
-
-                self.connected = True
-                self.running = True
+                conn = self.client.connect(timeout=10)
+                if conn.framed:
+                    self.add_message(f"Using framed protocol, compression: {conn.compressor.codec}",
+                                     "system")
+                else:
+                    self.add_message("Peer did not greet us, using newline mode", "system")
 
-                self.status_label.config(text=f"Connected to {self.vm_ip}:{self.port}")
-                self.send_btn.config(state=tk.NORMAL)
-                self.message_entry.focus()
+                self.set_status(f"Connected to {self.vm_ip}:{self.port}")
+                self.on_tk(lambda: self.send_btn.config(state=tk.NORMAL))
+                self.on_tk(self.message_entry.focus)
 
                 self.add_message("Connected! Start typing...", "system")
 
-                self.reader_thread = threading.Thread(target=self.receive_messages, daemon=True)
-                self.reader_thread.start()
-
             except Exception as e:
                 self.add_message(f"Connection failed: {e}", "system")
-                self.status_label.config(text="Connection Failed", bg="#e74c3c")
-                messagebox.showerror("Connection Error", f"Could not connect:\n{e}")
-                self.close()
+                self.set_status("Connection Failed", "#e74c3c")
+                self.on_tk(self.connect_failed, e)
 
         threading.Thread(target=do_connect, daemon=True).start()
 
-    def receive_messages(self):
-        """Receive messages"""
-        buffer = ""
-        while self.running and self.connected:
-            try:
-                data = self.sock.recv(4096)
-                if not data:
-                    self.add_message("VM disconnected", "system")
-                    self.disconnect()
-                    break
+    def connect_failed(self, error):
+        messagebox.showerror("Connection Error", f"Could not connect:\n{error}")
+        self.close()
 
-                text = data.decode('utf-8', errors='ignore')
-                buffer += text
+    def refresh_stats(self):
+        """Show RTT, throughput and backlog every heartbeat_interval (Tk thread)"""
+        if not self.window.winfo_exists():
+            return
+        conn = self.client.conn
+        if self.client.connected and conn is not None:
+            self.stats_label.config(
+                text=self.monitor.summary(conn, self.client.replay.pending_bytes()))
+        self.window.after(int(self.heartbeat_interval * 1000), self.refresh_stats)
+
+    def on_vm_text(self, text, partial):
+        """Text from the VM (reader thread)
+
+        A long line arrives in pieces; they are collected and the line is
+        shown and stored once, when its last piece comes in.
+        """
+        self.vm_line.append(text)
+        if partial:
+            return
+        line = "".join(self.vm_line)
+        self.vm_line = []
+        if line.endswith("\n"):
+            line = line[:-1]
+        if line.endswith("\r"):
+            line = line[:-1]
+        if line.strip():
+            self.add_message(line, "vm")
+            if self.store:
+                self.store.add("vm", "chat", line)
+
+    def on_link_status(self, text):
+        """A link event from the client (reader or heartbeat thread)"""
+        self.add_message(text[:1].upper() + text[1:], "system")
+        if self.client.connected:
+            self.set_status(f"Connected to {self.vm_ip}:{self.port}")
+        else:
+            self.set_status("Reconnecting...", "#e67e22")
 
-                while '\n' in buffer:
-                    line, buffer = buffer.split('\n', 1)
-                    if line.strip():
-                        self.add_message(line.strip(), "vm")
+    def on_clipboard_text(self, text):
+        """Send a local copy to the VM, unless unchanged or throttled"""
+        if not self.clipboard_sync or not self.client.connected:
+            return
+        item = self.clip.local("text/plain", to_bytes(text))
+        if item is not None:
+            self.clip_worker.submit(self.send_clipboard, *item)
+
+    def on_clipboard_image(self):
+        if self.clipboard_sync and self.client.connected:
+            self.clip_worker.submit(self.send_clipboard_image)
+
+    def send_clipboard_image(self):
+        """Runs on clip_worker: grab, re-encode and send the clipboard image"""
+        backend = self.clipboard_watcher.backend
+        if backend.change_count() == self.own_image_count:
+            return  # the image we just put there from the VM
+        image = backend.grab_image()
+        if image is None:
+            return
+        data, ctype = encode_clipboard_image(image, self.image_format)
+        if len(data) > CLIPBOARD_MAX_SIZE:
+            self.add_message(f"Clipboard image too large to sync ({format_bytes(len(data))})")
+            return
+        item = self.clip.local(ctype, data)
+        if item is not None:
+            self.add_image(ctype, data, "you")
+            self.send_clipboard(*item)
+
+    def send_clipboard(self, ctype, data):
+        """Runs on clip_worker: stream one item in pieces, so chat can interleave"""
+        if self.store:
+            self.store.add_clipboard("you", ctype, data)
+        self.client.send_clipboard(ctype, data)
+
+    def receive_clipboard(self, header, data):
+        """A complete item from the VM (reader thread)"""
+        ctype = header["type"]
+        if self.store:
+            self.store.add_clipboard("vm", ctype, data)
+        if ctype.startswith("image/"):
+            self.add_image(ctype, data, "vm")
+        elif ctype not in TEXT_TYPES:
+            self.add_message(f"Received {ctype} clipboard ({format_bytes(len(data))}); "
+                             f"it cannot be placed on this clipboard")
+            return
+        self.remote_clip = (ctype, data)
 
-            except Exception as e:
-                if self.running:
-                    self.add_message(f"Error: {e}", "system")
-                break
+    def apply_clipboard(self, ctype, data):
+        """Put an item from the VM on the local clipboard (Tk thread)"""
+        if ctype.startswith("image/"):
+            if getattr(self.clipboard_watcher.backend, "images", False):
+                self.clip_worker.submit(self.set_clipboard_image, data)
+            return
+        text = data.decode("utf-8", "replace")
+        if ctype == "text/html":
+            # Tk only holds plain text: keep the words, drop the markup
+            import html
+
+            text = html.unescape(re.sub(r"<[^>]*>", "", text))
+        self.clipboard_watcher.set(text)
+
+    def set_clipboard_image(self, data):
+        backend = self.clipboard_watcher.backend
+        try:
+            backend.set_image(data)
+        except Exception as e:
+            self.add_message(f"Could not put the image on the clipboard: {e}")
+            return
+        self.own_image_count = backend.change_count()
 
     def send_message(self):
-        """Send message"""
+        """Send message; while reconnecting it is queued for the resend"""
         message = self.message_entry.get("1.0", tk.END).strip()
-        if not message or not self.connected:
+        if not message or not self.client.running:
             return
 
-        try:
-            self.sock.sendall((message + '\n').encode('utf-8'))
-            self.add_message(message, "you")
+        if self.send_chat(message):
             self.message_entry.delete("1.0", tk.END)
             self.message_entry.focus()
-        except Exception as e:
-            self.add_message(f"Error: {e}", "system")
-            self.disconnect()
 
-    def disconnect(self):
-        """Disconnect"""
-        self.running = False
-        self.connected = False
+    def send_chat(self, message):
+        """Send one chat line from any thread; False if there is no link to send it on"""
+        if not self.client.send(message):
+            return False
+        self.add_message(message, "you")
+        if self.store:
+            self.store.add("you", "chat", message)
+        return True
+
+    def on_search_key(self, event=None):
+        """Search as the user types, once typing pauses for search_delay_ms"""
+        if self.search_pending is not None:
+            self.window.after_cancel(self.search_pending)
+        self.search_pending = self.window.after(self.search_delay_ms, self.run_search)
+
+    def run_search(self):
+        self.search_pending = None
+        self.search_serial += 1
+        query = self.search_var.get()
+        if not self.store or not query.strip():
+            self.results.pack_forget()
+            return
+        self.search_worker.submit(self.search, self.search_serial, query)
 
-        if self.sock:
-            try:
-                self.sock.close()
-            except:
-                pass
+    def search(self, serial, query):
+        """Runs on search_worker; results older than the latest query are ignored"""
+        if serial != self.search_serial:
+            return  # the user kept typing
+        try:
+            rows = self.store.search(query)
+        except Exception as e:
+            self.add_message(f"History search failed: {e}")
+            return
+        self.search_results = (serial, rows)
+
+    def show_results(self, rows):
+        """Fill the result list, newest first (Tk thread)"""
+        self.results.config(state=tk.NORMAL)
+        self.results.delete("1.0", tk.END)
+        if not rows:
+            self.results.insert(tk.END, "No matches", "meta")
+        for entry_id, ts, source, kind, ctype, text in rows:
+            stamp = time.strftime("%Y-%m-%d %H:%M", time.localtime(ts))
+            what = kind if ctype == "text/plain" else f"{kind} {ctype}"
+            line = " ".join(text.split())
+            self.results.insert(tk.END, "re-send", ("resend", f"entry-{entry_id}"),
+                                f"  {stamp} {source} ({what}): ", "meta",
+                                f"{line[:200]}\n", ())
+        self.results.config(state=tk.DISABLED)
+        if not self.results.winfo_ismapped():
+            self.results.pack(fill=tk.X, after=self.search_frame, pady=(0, 5))
+
+    def on_resend_click(self, event):
+        for tag in self.results.tag_names(f"@{event.x},{event.y}"):
+            if tag.startswith("entry-"):
+                self.search_worker.submit(self.resend, int(tag[len("entry-"):]))
+                return "break"
+
+    def resend(self, entry_id):
+        """Runs on search_worker: send a history entry to the VM again"""
+        entry = self.store.get(entry_id)
+        if entry is None:
+            return
+        source, kind, ctype, text, data = entry
+        if not self.client.connected:
+            self.add_message("Not connected; nothing was re-sent")
+        elif kind == "chat":
+            self.send_chat(text)
+        else:
+            data = data if data is not None else to_bytes(text)
+            # The VM will hold this item, so it is what both ends now share
+            self.clip.remote(clip_digest(ctype, data))
+            if ctype.startswith("image/"):
+                self.add_image(ctype, data, "you")
+            else:
+                self.add_message(f"Re-sent clipboard {ctype} ({format_bytes(len(data))})")
+            self.clip_worker.submit(self.send_clipboard, ctype, data)
 
-        self.status_label.config(text="Disconnected", bg="#e74c3c")
-        self.send_btn.config(state=tk.DISABLED)
+    def disconnect(self):
+        """Disconnect; safe from any thread, the send button follows at the next flush"""
+        # ChatClient.close() waits for the reader thread, so never on the Tk thread
+        threading.Thread(target=self.client.close, daemon=True).start()
+        self.set_status("Disconnected", "#e74c3c")
+        self.on_tk(lambda: self.send_btn.config(state=tk.DISABLED))
 
     def close(self):
-        self.running = False  # stop background thread
+        # The gauges close over this window; left registered they would
+        # keep it alive and export its last values
+        METRICS.gauge("chat_incoming_queue", None)
+        METRICS.gauge("chat_replay_bytes", None)
         self.disconnect()
+        self.clip_worker.shutdown(wait=False)
+        self.thumb_worker.shutdown(wait=False)
+        self.search_worker.shutdown(wait=False)
         if self.window.winfo_exists():
             self.window.destroy()
+        self.history.close()
+        if self.store:
+            # Queued entries are still written; the store closes once they are,
+            # and the process does not exit before that
+            threading.Thread(target=self.store.close).start()
         if self.on_close_callback:
             self.on_close_callback()
 
@@ -532,9 +1830,86 @@ class LiveChatClient:
 # GUI APPLICATION
 # ============================================
 
+SUCCESS = 25
+logging.addLevelName(SUCCESS, "SUCCESS")
+LOG_LEVELS = {"DEBUG": logging.DEBUG, "INFO": logging.INFO, "SUCCESS": SUCCESS,
+              "WARNING": logging.WARNING, "ERROR": logging.ERROR}
+
+# Lines produced by TransferProgress, e.g. "big.iso:  42.0% (420.0 MB, 95.1 MB/s)"
+PROGRESS_LINE = re.compile(r".*: +\d+\.\d% \(")
+
+
+class TkLogHandler(logging.Handler):
+    """Logging handler that feeds a Tk text widget in batches
+
+    emit() only appends to a deque, so any thread may log without touching
+    Tk. pump() runs on the Tk thread every interval_ms and writes everything
+    queued since the last tick with one insert() call. Records logged with
+    the same `key` (transfer progress) overwrite each other, so a progress
+    line is updated in place instead of scrolling the log.
+    """
+
+    def __init__(self, widget, interval_ms=50, max_lines=5000, max_per_flush=1000):
+        super().__init__()
+        self.widget = widget
+        self.interval_ms = interval_ms
+        self.max_lines = max_lines
+        self.max_per_flush = max_per_flush
+        self.pending = deque()
+        self._lines = 0
+        self._last_key = None  # key of the record on the widget's last line
+        self.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+        METRICS.gauge("log_queue", lambda: len(self.pending))
+        widget.after(interval_ms, self.pump)
+
+    def emit(self, record):
+        self.pending.append(record)
+
+    def pump(self):
+        if not self.widget.winfo_exists():
+            return
+        if self.pending:
+            started = time.perf_counter()
+            self.flush_pending()
+            METRICS.observe("log_flush_seconds", time.perf_counter() - started)
+        self.widget.after(1 if self.pending else self.interval_ms, self.pump)
+
+    def flush_pending(self):
+        batch = [self.pending.popleft() for _ in range(min(len(self.pending), self.max_per_flush))]
+        lines = []
+        keys = []
+        for record in batch:
+            key = getattr(record, "key", None)
+            text = self.format(record)
+            if key is not None and keys and keys[-1] == key:
+                lines[-1] = text
+                continue
+            lines.append(text)
+            keys.append(key)
+
+        if keys[0] is not None and keys[0] == self._last_key:
+            self.widget.delete("end - 2 lines", "end - 1 chars")
+            self._lines -= 1
+        self.widget.insert(tk.END, "".join(line + "\n" for line in lines))
+        self._lines += sum(line.count("\n") + 1 for line in lines)
+        self._last_key = keys[-1]
+
+        if self._lines > self.max_lines + self.max_lines // 10:
+            excess = self._lines - self.max_lines
+            self.widget.delete("1.0", f"{excess + 1}.0")
+            self._lines -= excess
+        self.widget.see(tk.END)
+
+
 class InstallerGUI:
-    def __init__(self):
+    def __init__(self, log_file=None, log_level="INFO", history_file=None):
+        self.log_file = log_file
+        self.log_level = log_level
+        self.history_file = history_file
+        self.server = None
+        self._server_was_running = False
         self.window = tk.Tk()
+        self.window.protocol("WM_DELETE_WINDOW", self.on_close)
         self.window.title("Copy-Paste Tool | by mouones (vibecoding)")
 
         # Calculate window size to match image aspect ratio (bottom 60% of 2256x3680)
@@ -561,11 +1936,18 @@ class InstallerGUI:
         self.window.geometry(f"{win_width}x{win_height}")
         self.window.minsize(600, 400)
 
+        import platform
+
         self.system = platform.system()
         self.is_windows = (self.system == "Windows")
 
         self.vm_ip = tk.StringVar(value="192.168.100.93")
         self.port = tk.StringVar(value="4444")
+        self.streams = tk.StringVar(value="1")
+        self.dedup = tk.BooleanVar(value=False)
+        # Run Server starts vm_server.py --no-stdin; these add to that
+        self.server_clipboard = tk.BooleanVar(value=False)
+        self.server_history = tk.BooleanVar(value=False)
         self.status_text = tk.StringVar(value="Ready")
         self.chat_window = None
         self.menu_open = False
@@ -574,45 +1956,52 @@ class InstallerGUI:
 
         self.bg_label = None
         self.bg_photo = None
+        self.bg_renderer = None
         self.create_background()
 
         self.create_widgets()
+        if not HAS_PIL:
+            self.log("Pillow is not installed: no background image, clipboard images or "
+                     "thumbnails. Install it with: pip install Pillow", "WARNING")
         self.detect_files()
 
     def on_resize(self, event):
         """Handle resize"""
-        if event.widget == self.window and HAS_PIL:
+        if event.widget == self.window and self.bg_renderer:
             if hasattr(self, '_resize_after_id'):
                 self.window.after_cancel(self._resize_after_id)
-            self._resize_after_id = self.window.after(100, self.update_background)
+            self._resize_after_id = self.window.after(30, self.update_background)
 
     def update_background(self):
         """Update background"""
-        if not HAS_PIL or not self.bg_label:
+        if not self.bg_renderer:
             return
 
         width = self.window.winfo_width()
         height = self.window.winfo_height()
 
         if width > 1 and height > 1:
-            bg_image = create_gradient_background(width, height)
-            self.bg_photo = ImageTk.PhotoImage(bg_image)
-            self.bg_label.configure(image=self.bg_photo)
+            self.bg_renderer.request(width, height)
+
+    def set_background(self, photo):
+        """Swap in a rendered background (Tk thread)"""
+        self.bg_photo = photo
+        self.bg_label.configure(image=photo)
 
     def create_background(self):
         """Create background"""
-        if not HAS_PIL:
+        if not load_pil():
             self.window.configure(bg="#2c3e50")
             return
 
+        # The window shows a plain colour until the first render arrives
+        self.bg_label = tk.Label(self.window, bg="#2c3e50")
+        self.bg_label.place(x=0, y=0, relwidth=1, relheight=1)
+        self.bg_renderer = BackgroundRenderer(self.window, self.set_background)
+
         width = self.window.winfo_width() if self.window.winfo_width() > 1 else 800
         height = self.window.winfo_height() if self.window.winfo_height() > 1 else 600
-
-        bg_image = create_gradient_background(width, height)
-        self.bg_photo = ImageTk.PhotoImage(bg_image)
-
-        self.bg_label = tk.Label(self.window, image=self.bg_photo)
-        self.bg_label.place(x=0, y=0, relwidth=1, relheight=1)
+        self.bg_renderer.request(width, height)
 
     def create_widgets(self):
         """Create widgets"""
@@ -665,6 +2054,30 @@ class InstallerGUI:
                                  relief=tk.FLAT, cursor="hand2", padx=10)
             auto_btn.grid(row=0, column=4, padx=(10, 0))
 
+            for column, (text, variable) in enumerate(
+                    (("Sync clipboard", self.server_clipboard),
+                     ("Keep history", self.server_history))):
+                tk.Checkbutton(form_frame, text=text, variable=variable,
+                               font=("Arial", 10), fg="#ffffff", bg="#1a1a1a",
+                               selectcolor="#2d2d2d", activebackground="#1a1a1a",
+                               activeforeground="#ffffff").grid(row=1, column=column * 2,
+                                                                columnspan=2, sticky=tk.W,
+                                                                pady=(10, 0))
+        else:
+            tk.Label(form_frame, text="Streams:", font=("Arial", 11, "bold"),
+                     fg="#ffffff", bg="#1a1a1a").grid(row=1, column=0, padx=(0, 10), pady=(10, 0))
+
+            streams_spin = tk.Spinbox(form_frame, from_=1, to=16, textvariable=self.streams,
+                                      width=5, font=("Arial", 11), bg="#2d2d2d", fg="#ffffff",
+                                      relief=tk.FLAT, insertbackground="#ffffff")
+            streams_spin.grid(row=1, column=1, sticky=tk.W, padx=5, pady=(10, 0), ipady=5)
+
+            tk.Checkbutton(form_frame, text="Only send changed chunks", variable=self.dedup,
+                           font=("Arial", 10), fg="#ffffff", bg="#1a1a1a",
+                           selectcolor="#2d2d2d", activebackground="#1a1a1a",
+                           activeforeground="#ffffff").grid(row=1, column=2, columnspan=3,
+                                                            sticky=tk.W, padx=(20, 0), pady=(10, 0))
+
         # Log frame (hidden by default, shown in menu)
         self.log_frame = tk.Frame(self.window, bg="#1a1a1a")
         self.log_frame.place_forget()
@@ -677,6 +2090,7 @@ class InstallerGUI:
                                                   bg="#0d0d0d", fg="#b0b0b0",
                                                   wrap=tk.WORD, relief=tk.FLAT)
         self.log_text.pack(fill=tk.BOTH, expand=True, padx=10, pady=(0, 10))
+        self.setup_logging()
 
         # Bottom buttons bar
         button_frame = tk.Frame(self.window, bg="#1a1a1a")
@@ -701,6 +2115,16 @@ class InstallerGUI:
                                       command=self.open_chat,
                                       bg="#3498db", fg="white", state=tk.DISABLED, **button_style)
             self.chat_btn.pack(side=tk.LEFT, padx=8)
+
+            self.send_file_btn = tk.Button(button_frame, text="Send File",
+                                           command=self.send_file,
+                                           bg="#8e44ad", fg="white", state=tk.DISABLED, **button_style)
+            self.send_file_btn.pack(side=tk.LEFT, padx=8)
+
+            self.send_folder_btn = tk.Button(button_frame, text="Send Folder",
+                                             command=self.send_folder,
+                                             bg="#8e44ad", fg="white", state=tk.DISABLED, **button_style)
+            self.send_folder_btn.pack(side=tk.LEFT, padx=8)
         else:
             self.install_btn = tk.Button(button_frame, text="Create Server",
                                          command=self.start_linux_install,
@@ -712,17 +2136,21 @@ class InstallerGUI:
                                      bg="#3498db", fg="white", state=tk.DISABLED, **button_style)
             self.run_btn.pack(side=tk.LEFT, padx=8)
 
+            small_style = dict(button_style, width=8)
+            self.stop_btn = tk.Button(button_frame, text="Stop", command=self.stop_linux_server,
+                                      bg="#e74c3c", fg="white", state=tk.DISABLED, **small_style)
+            self.stop_btn.pack(side=tk.LEFT, padx=8)
+
+            self.restart_btn = tk.Button(button_frame, text="Restart",
+                                         command=self.restart_linux_server,
+                                         bg="#f39c12", fg="white", state=tk.DISABLED, **small_style)
+            self.restart_btn.pack(side=tk.LEFT, padx=8)
+
         help_btn = tk.Button(button_frame, text="Help", command=self.show_help,
                              bg="#95a5a6", fg="white", font=("Arial", 11, "bold"),
                              relief=tk.FLAT, cursor="hand2", width=8, height=2, borderwidth=0)
         help_btn.pack(side=tk.LEFT, padx=8)
 
-    def toggle_menu(self):
-        """Toggle menu visibility"""
-        if self.menu_open:
-            self.menu_frame.place_forget()
-            self.log_frame.place_forget()
-
     def toggle_menu(self):
         """Toggle menu visibility"""
         if self.menu_open:
@@ -730,15 +2158,45 @@ class InstallerGUI:
             self.log_frame.place_forget()
             self.menu_open = False
         else:
-            self.menu_frame.place(x=10, y=60, width=500, height=80)
-            self.log_frame.place(x=10, y=150, width=500, height=250)
+            menu_height = 120 if self.is_windows else 80
+            self.menu_frame.place(x=10, y=60, width=500, height=menu_height)
+            self.log_frame.place(x=10, y=70 + menu_height, width=500, height=250)
             self.menu_open = True
 
-    def log(self, message, level="INFO"):
-        """Add message to log"""
-        self.log_text.insert(tk.END, f"[{level}] {message}\n")
-        self.log_text.see(tk.END)
-        self.window.update()
+    def setup_logging(self):
+        """Route self.log through the logging module
+
+        The widget handler honours log_level; the optional log file gets
+        everything and rotates at 1 MB, keeping three old files.
+        """
+        self.logger = logging.getLogger(f"auto_installer.gui.{id(self)}")
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+
+        widget_handler = TkLogHandler(self.log_text)
+        widget_handler.setLevel(LOG_LEVELS.get(self.log_level.upper(), logging.INFO))
+        self.logger.addHandler(widget_handler)
+
+        if self.log_file:
+            import logging.handlers
+
+            file_handler = logging.handlers.RotatingFileHandler(
+                self.log_file, maxBytes=1024 * 1024, backupCount=3, encoding="utf-8")
+            file_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+            self.logger.addHandler(file_handler)
+
+    def log(self, message, level="INFO", key=None):
+        """Add message to log; safe to call from any thread
+
+        Messages sharing a key replace each other on screen (progress lines).
+        """
+        self.logger.log(LOG_LEVELS.get(level, logging.INFO), message, extra={"key": key})
+
+    def progress_logger(self, key):
+        """Progress callback for transfers: progress lines update in place"""
+        def progress(line):
+            self.log(line, key=key if PROGRESS_LINE.match(line) else None)
+        return progress
 
     def update_status(self, message, color="#27ae60"):
         """Update status label"""
@@ -757,6 +2215,8 @@ class InstallerGUI:
             if os.path.exists('.venv/windows_client.ps1') and os.path.exists('vm_server.py'):
                 self.log("Found existing installation files", "SUCCESS")
                 self.chat_btn.config(state=tk.NORMAL)
+                self.send_file_btn.config(state=tk.NORMAL)
+                self.send_folder_btn.config(state=tk.NORMAL)
         else:
             if os.path.exists('vm_server.py'):
                 self.log("Found existing vm_server.py", "SUCCESS")
@@ -772,84 +2232,144 @@ class InstallerGUI:
         port = int(self.port.get().strip())
 
         self.chat_window = LiveChatClient(self.window, vm_ip, port,
-                                          on_close_callback=lambda: setattr(self, 'chat_window', None))
+                                          on_close_callback=lambda: setattr(self, 'chat_window', None),
+                                          history_file=self.history_file)
+
+    def send_file(self):
+        """Push a file to the running VM server in verified chunks"""
+        filename = filedialog.askopenfilename(title="Choose a file to send to the VM")
+        if filename:
+            self.start_transfer(filename)
+
+    def send_folder(self):
+        """Push a whole folder to the running VM server as one stream"""
+        dirname = filedialog.askdirectory(title="Choose a folder to send to the VM")
+        if dirname:
+            self.start_transfer(dirname)
+
+    def start_transfer(self, path):
+        """Send a file or folder in the background, logging progress"""
+        vm_ip = self.vm_ip.get().strip()
+        port = int(self.port.get().strip())
+        streams = max(1, int(self.streams.get().strip() or 1))
+        dedup = self.dedup.get()
+        if os.path.isdir(path):
+            self.log(f"Sending folder {path} to {vm_ip}:{port}...")
+        elif dedup:
+            self.log(f"Sending changed chunks of {path} to {vm_ip}:{port}...")
+        else:
+            self.log(f"Sending {path} to {vm_ip}:{port} over {streams} stream(s)...")
+
+        def transfer():
+            success, msg = send_file_to_vm(vm_ip, port, path, chunked=True,
+                                           progress=self.progress_logger(path),
+                                           streams=streams, dedup=dedup)
+            if success:
+                self.log(f"✓ {os.path.basename(path)} sent", "SUCCESS")
+            else:
+                self.log(f"✗ Transfer failed: {msg}", "ERROR")
+
+        threading.Thread(target=transfer, daemon=True).start()
 
     def start_windows_install(self):
-        """Windows installation process"""
+        """Windows installation process
+
+        The files are created and the user is asked on the Tk thread; only
+        the send runs on a worker, which hands its result back via after().
+        """
         self.install_btn.config(state=tk.DISABLED)
         self.update_status("Installing...", "#f39c12")
 
-        def install():
-            try:
-                vm_ip = self.vm_ip.get().strip()
-                port = int(self.port.get().strip())
-
-                self.log("Starting Windows installation...")
-                self.log(f"Target VM: {vm_ip}:{port}")
-
-                self.log("Creating vm_server.py...")
-                create_vm_server()
-                self.log("✓ vm_server.py created", "SUCCESS")
-
-                self.log("Creating windows_client.ps1...")
-                create_windows_client(vm_ip, port)
-                self.log("✓ windows_client.ps1 created", "SUCCESS")
-
-                self.log("\n" + "=" * 50, "WARNING")
-                self.log("ACTION REQUIRED ON VM:", "WARNING")
-                self.log(f"Run this command on your VM NOW:", "WARNING")
-                self.log(f"    nc -l {vm_ip} {port} > vm_server.py", "WARNING")
-                self.log("=" * 50 + "\n", "WARNING")
-
-                response = messagebox.askyesno(
-                    "VM Setup Required",
-                    f"On your VM, run this command NOW:\n\n"
-                    f"nc -l {vm_ip} {port} > vm_server.py\n\n"
-                    f"Press YES after starting 'nc -l' on VM"
-                )
-
-                if not response:
-                    self.log("Installation cancelled by user", "WARNING")
-                    self.install_btn.config(state=tk.NORMAL)
-                    self.update_status("Cancelled", "#e74c3c")
-                    return
-
-                self.log(f"Sending vm_server.py to {vm_ip}:{port}...")
-                self.update_status("Sending file to VM...", "#3498db")
-
-                success, msg = send_file_to_vm(vm_ip, port, 'vm_server.py')
-
-                if success:
-                    self.log("✓ File sent successfully!", "SUCCESS")
-                    self.log("\n" + "=" * 50, "SUCCESS")
-                    self.log("NEXT STEPS ON VM:", "SUCCESS")
-                    self.log("1. Verify: cat vm_server.py", "SUCCESS")
-                    self.log("2. Run: python vm_server.py", "SUCCESS")
-                    self.log("=" * 50 + "\n", "SUCCESS")
-
-                    self.update_status("✓ Installation Complete!", "#27ae60")
-                    self.chat_btn.config(state=tk.NORMAL)
-
-                    messagebox.showinfo(
-                        "Success",
-                        "Installation complete!\n\n"
-                        "On your VM, run:\n"
-                        "python vm_server.py\n\n"
-                        "Then click 'Open Chat' button"
-                    )
-                else:
-                    self.log(f"✗ Failed to send file: {msg}", "ERROR")
-                    self.update_status("Installation Failed", "#e74c3c")
-                    self.install_btn.config(state=tk.NORMAL)
-                    messagebox.showerror("Error", f"Failed to send file:\n{msg}")
+        try:
+            vm_ip = self.vm_ip.get().strip()
+            port = int(self.port.get().strip())
+
+            self.log("Starting Windows installation...")
+            self.log(f"Target VM: {vm_ip}:{port}")
+
+            self.log("Creating vm_server.py...")
+            create_vm_server()
+            self.log("✓ vm_server.py created", "SUCCESS")
 
+            self.log("Creating windows_client.ps1...")
+            create_windows_client(vm_ip, port)
+            self.log("✓ windows_client.ps1 created", "SUCCESS")
+
+            self.log("Creating chat_client.py...")
+            create_python_client(vm_ip, port)
+            self.log("✓ chat_client.py created (headless client: python .venv/chat_client.py)",
+                     "SUCCESS")
+
+            self.log("\n" + "=" * 50, "WARNING")
+            self.log("ACTION REQUIRED ON VM:", "WARNING")
+            self.log("Run this command on your VM NOW:", "WARNING")
+            self.log(f"    nc -l {vm_ip} {port} > vm_server.py", "WARNING")
+            self.log("=" * 50 + "\n", "WARNING")
+
+            response = messagebox.askyesno(
+                "VM Setup Required",
+                f"On your VM, run this command NOW:\n\n"
+                f"nc -l {vm_ip} {port} > vm_server.py\n\n"
+                f"Press YES after starting 'nc -l' on VM"
+            )
+        except Exception as e:
+            self.install_failed(e)
+            return
+
+        if not response:
+            self.log("Installation cancelled by user", "WARNING")
+            self.install_btn.config(state=tk.NORMAL)
+            self.update_status("Cancelled", "#e74c3c")
+            return
+
+        self.log(f"Sending vm_server.py to {vm_ip}:{port}...")
+        self.update_status("Sending file to VM...", "#3498db")
+
+        def send():
+            try:
+                result = send_file_to_vm(vm_ip, port, 'vm_server.py')
             except Exception as e:
-                self.log(f"✗ Error: {e}", "ERROR")
-                self.update_status("Error", "#e74c3c")
-                self.install_btn.config(state=tk.NORMAL)
-                messagebox.showerror("Error", str(e))
+                self.window.after(0, self.install_failed, e)
+                return
+            self.window.after(0, self.install_sent, *result)
+
+        threading.Thread(target=send, daemon=True).start()
+
+    def install_sent(self, success, msg):
+        """Finish the Windows installation once vm_server.py was sent (Tk thread)"""
+        if not success:
+            self.log(f"✗ Failed to send file: {msg}", "ERROR")
+            self.update_status("Installation Failed", "#e74c3c")
+            self.install_btn.config(state=tk.NORMAL)
+            messagebox.showerror("Error", f"Failed to send file:\n{msg}")
+            return
 
-        threading.Thread(target=install, daemon=True).start()
+        self.log("✓ File sent successfully!", "SUCCESS")
+        self.log("\n" + "=" * 50, "SUCCESS")
+        self.log("NEXT STEPS ON VM:", "SUCCESS")
+        self.log("1. Verify: cat vm_server.py", "SUCCESS")
+        self.log("2. Run: python vm_server.py", "SUCCESS")
+        self.log("=" * 50 + "\n", "SUCCESS")
+
+        self.update_status("✓ Installation Complete!", "#27ae60")
+        self.chat_btn.config(state=tk.NORMAL)
+        self.send_file_btn.config(state=tk.NORMAL)
+        self.send_folder_btn.config(state=tk.NORMAL)
+
+        messagebox.showinfo(
+            "Success",
+            "Installation complete!\n\n"
+            "On your VM, run:\n"
+            "python vm_server.py\n\n"
+            "Then click 'Open Chat' button"
+        )
+
+    def install_failed(self, error):
+        """Report a failed Windows installation (Tk thread)"""
+        self.log(f"✗ Error: {error}", "ERROR")
+        self.update_status("Error", "#e74c3c")
+        self.install_btn.config(state=tk.NORMAL)
+        messagebox.showerror("Error", str(error))
 
     def start_linux_install(self):
         """Linux installation process"""
@@ -887,23 +2407,76 @@ class InstallerGUI:
             messagebox.showerror("Error", str(e))
 
     def run_linux_server(self):
-        """Run Linux server"""
+        """Start vm_server.py as a managed child process"""
         if not os.path.exists('vm_server.py'):
             messagebox.showerror("Error", "vm_server.py not found!")
             return
 
+        if self.server is None:
+            self.server = ServerProcessManager(
+                on_output=lambda line: self.log(f"[server] {line}"),
+                on_exit=self.on_server_exit)
+            self.refresh_server_state()
+        self.server.args = self.server_args()
         self.log("Starting server...")
-        self.log("Server will run in terminal. Press Ctrl+C to stop.")
-        self.update_status("Server running in terminal...", "#27ae60")
-
         try:
-            subprocess.call(['python', 'vm_server.py'])
-        except KeyboardInterrupt:
-            self.log("Server stopped", "WARNING")
-        except Exception as e:
+            self.server.start()
+        except OSError as e:
             self.log(f"Error: {e}", "ERROR")
             messagebox.showerror("Error", str(e))
 
+    def server_args(self):
+        """vm_server.py options for Run Server: --no-stdin plus what is ticked"""
+        args = ["--no-stdin"]
+        if self.server_clipboard.get():
+            args.append("--clipboard")
+        if self.server_history.get():
+            args += ["--history", "vm_history.sqlite3"]
+        return args
+
+    def stop_linux_server(self):
+        """Stop the managed server without blocking the GUI"""
+        if self.server:
+            self.log("Stopping server...")
+            threading.Thread(target=self.server.stop, daemon=True).start()
+
+    def restart_linux_server(self):
+        """Restart the managed server"""
+        if self.server:
+            self.log("Restarting server...")
+            threading.Thread(target=self.server.restart, daemon=True).start()
+
+    def on_server_exit(self, code, restart_delay):
+        """Called from the server's reader thread"""
+        level = "WARNING" if code else "INFO"
+        if restart_delay is None:
+            self.log(f"Server exited with code {code}", level)
+        else:
+            self.log(f"Server exited with code {code}, restarting in {restart_delay:.0f}s", "ERROR")
+
+    def refresh_server_state(self):
+        """Keep the server buttons and status in step with the process"""
+        if not self.window.winfo_exists():
+            return
+        running = self.server is not None and self.server.running
+        if running != self._server_was_running:
+            self._server_was_running = running
+            self.run_btn.config(state=tk.DISABLED if running else tk.NORMAL)
+            self.stop_btn.config(state=tk.NORMAL if running else tk.DISABLED)
+            self.restart_btn.config(state=tk.NORMAL if running else tk.DISABLED)
+            if running:
+                self.update_status("Server running", "#27ae60")
+            else:
+                self.update_status("Server stopped", "#e74c3c")
+        self.window.after(250, self.refresh_server_state)
+
+    def on_close(self):
+        """Stop the managed server, if any, and quit"""
+        if self.server:
+            self.server.auto_restart = False
+            self.server.stop()
+        self.window.destroy()
+
     def show_help(self):
         """Show help dialog"""
         if self.is_windows:
@@ -918,6 +2491,13 @@ class InstallerGUI:
 
 FEATURES:
 - Type directly in the chat window
+- 'Send File' pushes large files in verified,
+  resumable chunks to the running vm_server.py
+  (raise 'Streams' in the menu for slow links)
+- 'Only send changed chunks' re-pushes an edited
+  file by sending just the parts the VM lacks
+- 'Send Folder' streams a whole tree over one
+  connection, keeping file modes and times
 - Real-time bidirectional communication
 - Resizable interface
 
@@ -932,7 +2512,9 @@ TROUBLESHOOTING:
 1. Click 'Create Server File'
 2. Note your VM IP address
 3. Give IP to Windows host
-4. Click 'Run Server'
+4. Click 'Run Server' (output shows in the log;
+   Stop/Restart control it, and it restarts by
+   itself with backoff if it crashes)
 5. On Windows, run auto_installer.py
 6. Windows user can type in GUI!
 
@@ -961,6 +2543,8 @@ def console_mode():
     print("    by mouones (vibecoding)")
     print("=" * 60 + "\n")
 
+    import platform
+
     system = platform.system()
     print(f"Detected OS: {system}\n")
 
@@ -973,6 +2557,7 @@ def console_mode():
         print("\nCreating files...")
         create_vm_server()
         create_windows_client(vm_ip, port)
+        create_python_client(vm_ip, port)
         print("✓ Files created\n")
 
         print("=" * 60)
@@ -990,6 +2575,19 @@ def console_mode():
             print("Then run GUI again and click 'Open Chat' button")
         else:
             print(f"✗ Error: {msg}")
+            return
+
+        print("\nOnce vm_server.py is running you can push files to it.")
+        streams = input("Parallel streams for large files [1]: ").strip() or "1"
+        streams = max(1, int(streams))
+        dedup = input("Only send changed chunks on re-push? (y/n) [n]: ").strip().lower() in ('y', 'yes')
+        while True:
+            path = input("File or folder to send (blank to finish): ").strip().strip('"')
+            if not path:
+                break
+            success, msg = send_file_to_vm(vm_ip, port, path, chunked=True,
+                                           progress=print, streams=streams, dedup=dedup)
+            print("✓ File sent" if success else f"✗ Error: {msg}")
 
     elif system == "Linux":
         print("Linux/VM Setup\n")
@@ -1006,15 +2604,309 @@ def console_mode():
         print(f"Unsupported OS: {system}")
 
 
+# ============================================
+# COMMAND LINE
+# ============================================
+
+EXIT_OK = 0
+EXIT_FAILED = 1  # no connection, a failed transfer, a lost link or unconfirmed lines
+EXIT_USAGE = 2  # bad arguments (argparse)
+EXIT_INTERRUPTED = 130
+
+
+class CliOutput:
+    """Where the subcommands report to
+
+    Status goes to stderr so stdout only carries data. With --json every
+    event is a JSON object on its own line on stdout instead.
+    """
+
+    def __init__(self, json_lines=False, quiet=False):
+        self.json_lines = json_lines
+        self.quiet = quiet
+        self.lock = threading.Lock()
+
+    def write(self, stream, text):
+        with self.lock:
+            stream.write(text)
+            stream.flush()
+
+    def emit(self, event, **fields):
+        """A machine-readable event; only written in --json mode"""
+        if self.json_lines:
+            self.write(sys.stdout, json.dumps({"event": event, "time": round(time.time(), 3),
+                                               **fields}) + "\n")
+
+    def status(self, message):
+        if self.quiet:
+            return
+        if self.json_lines:
+            self.emit("status", message=message)
+        else:
+            self.write(sys.stderr, f"[*] {message}\n")
+
+    def error(self, message):
+        if self.json_lines:
+            self.emit("error", message=message)
+        else:
+            self.write(sys.stderr, f"Error: {message}\n")
+
+
+def parse_target(text):
+    """"host" or "host:port" -> (host, port)"""
+    host, sep, port = text.rpartition(":")
+    if not sep:
+        return text, CLIENT_PORT
+    try:
+        return host, int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"bad port in {text!r}")
+
+
+def cli_send(args, out, echo=False):
+    """send: stdin (or the words given) to the VM; chat: the VM's text to stdout too"""
+    host, port = args.target
+    done = threading.Event()
+    if not echo:
+        on_text = lambda text, partial: None  # noqa: E731
+    elif out.json_lines:
+        on_text = lambda text, partial: out.emit("text", text=text, partial=partial)  # noqa: E731
+    else:
+        on_text = lambda text, partial: out.write(sys.stdout, text if partial else text + "\n")  # noqa: E731
+    client = ChatClient(host, port, on_text=on_text, on_status=out.status, on_closed=done.set,
+                        heartbeat=args.heartbeat,
+                        hello={"client": "auto_installer", "role": "chat" if echo else "sender"})
+    try:
+        client.connect()
+    except (OSError, ProtocolError) as e:
+        out.error(f"could not connect to {host}:{port}: {e}")
+        return EXIT_FAILED
+    out.status(f"connected to {host}:{port}")
+    started = time.monotonic()
+    try:
+        if args.text:
+            ok = client.send(" ".join(args.text)) and client.flush(args.linger)
+        else:
+            ok = stream_input(client, done, linger=args.linger)
+    except KeyboardInterrupt:
+        client.close()
+        return EXIT_INTERRUPTED
+    client.close()
+    out.emit("sent", messages=client.sent, bytes=client.sent_bytes, acknowledged=ok,
+             seconds=round(time.monotonic() - started, 3))
+    if not ok:
+        out.error("the VM did not confirm everything that was sent")
+        return EXIT_FAILED
+    return EXIT_OK
+
+
+def cli_push_file(args, out):
+    host, port = args.target
+    failed = 0
+    for path in args.paths:
+        name = os.path.basename(os.path.normpath(path))
+        started = time.monotonic()
+        ok, message = send_file_to_vm(
+            host, port, path, chunked=not args.raw, streams=args.streams, dedup=args.dedup,
+            progress=lambda line, path=path: (out.emit("progress", path=path, message=line)
+                                              if out.json_lines else out.status(line)))
+        out.emit("pushed", path=path, ok=ok, message=message,
+                 bytes=os.path.getsize(path) if os.path.isfile(path) else None,
+                 seconds=round(time.monotonic() - started, 3))
+        if ok:
+            out.status(f"{name}: {message}")
+        else:
+            out.error(f"{name}: {message}")
+            failed += 1
+    return EXIT_FAILED if failed else EXIT_OK
+
+
+def cli_watch_clipboard(args, out):
+    """Report clipboard items from the VM; with --sync also exchange them with this clipboard"""
+    host, port = args.target
+    backend = None
+    if args.sync:
+        # Imported here so the server (selectors, subprocess) is only loaded when used
+        from copy_paste_server import detect_clipboard
+
+        backend = detect_clipboard()
+        if backend is None:
+            out.error("no clipboard tool found (wl-clipboard, xclip, xsel or pbcopy)")
+            return EXIT_FAILED
+        out.status(f"syncing the clipboard through {backend.name}")
+    if args.save_dir:
+        os.makedirs(args.save_dir, exist_ok=True)
+
+    def received(header, data):
+        # Reader thread
+        ctype = header["type"]
+        fields = {"source": "vm", "type": ctype, "size": len(data), "sha256": header["sha256"]}
+        if ctype in TEXT_TYPES:
+            fields["text"] = data.decode("utf-8", "replace")
+        elif args.save_dir:
+            extension = ctype.rpartition("/")[2].split("+")[0] or "bin"
+            fields["path"] = os.path.join(args.save_dir, f"{header['sha256'][:16]}.{extension}")
+            with open(fields["path"], "wb") as f:
+                f.write(data)
+        if out.json_lines:
+            out.emit("clipboard", **fields)
+        elif ctype in TEXT_TYPES:
+            out.write(sys.stdout, fields["text"] + "\n")
+        else:
+            out.status(f"received {ctype} ({format_bytes(len(data))})" +
+                       (f" -> {fields['path']}" if "path" in fields else ""))
+        if backend is not None:
+            try:
+                backend.write(ctype, data)
+            except (OSError, ValueError) as e:
+                out.error(f"could not set the clipboard: {e}")
+
+    done = threading.Event()
+    client = ChatClient(host, port, on_text=lambda text, partial: None, on_clipboard=received,
+                        on_status=out.status, on_closed=done.set, heartbeat=args.heartbeat,
+                        hello={"client": "auto_installer", "role": "clipboard"})
+
+    def send_local(item):
+        if client.send_clipboard(*item):
+            out.emit("clipboard", source="local", type=item[0], size=len(item[1]),
+                     sha256=binascii.hexlify(clip_digest(*item)).decode("ascii"))
+
+    def send_due():
+        item = client.clip.due()
+        if item is not None:
+            send_local(item)
+
+    def watch_local():
+        # Waits on the tool's change pipe where there is one, else polls it
+        pipe = backend.watch()
+        while not done.is_set():
+            if pipe is not None:
+                if not pipe.readline():
+                    pipe = None  # the watcher died: poll instead
+                    continue
+            elif done.wait(backend.poll_interval):
+                return
+            item = backend.read()
+            if item is None or len(item[1]) > CLIPBOARD_MAX_SIZE:
+                continue
+            item = client.clip.local(*item)
+            if item is not None:
+                send_local(item)
+            elif client.clip.pending is not None:
+                # Held back by the throttle: send the latest once it allows
+                timer = threading.Timer(client.clip.next_due() or 0.0, send_due)
+                timer.daemon = True
+                timer.start()
+
+    try:
+        client.connect()
+    except (OSError, ProtocolError) as e:
+        out.error(f"could not connect to {host}:{port}: {e}")
+        return EXIT_FAILED
+    out.status(f"watching the clipboard of {host}:{port}")
+    if backend is not None:
+        threading.Thread(target=watch_local, daemon=True).start()
+    try:
+        while not done.wait(3600):
+            pass
+    except KeyboardInterrupt:
+        return EXIT_INTERRUPTED
+    finally:
+        client.close()
+        if backend is not None:
+            backend.close()
+    return EXIT_FAILED  # only a lost link ends the watch
+
+
+def build_cli_parser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--json", action="store_true",
+                        help="report events as JSON lines on stdout")
+    common.add_argument("-q", "--quiet", action="store_true", help="no status messages")
+
+    link = argparse.ArgumentParser(add_help=False, parents=[common])
+    link.add_argument("target", type=parse_target, metavar="HOST[:PORT]",
+                      help=f"where vm_server.py listens (port {CLIENT_PORT} by default)")
+    link.add_argument("--heartbeat", type=float, default=5.0,
+                      help="seconds of silence before the link counts as dead (0: off)")
+
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(sys.argv[0]) or "auto_installer.py",
+        description="Real-time copy-paste tool. Without a command the GUI starts.",
+        epilog=f"exit status: {EXIT_OK} done, {EXIT_FAILED} failed (no connection, failed "
+               f"transfer, lost link, unconfirmed lines), {EXIT_USAGE} bad arguments, "
+               f"{EXIT_INTERRUPTED} interrupted")
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+    commands.required = True
+
+    # Listed for --help only: cli_main hands everything after "serve" to vm_server.py
+    commands.add_parser("serve", help="run vm_server.py in this process (serve --help for options)")
+
+    for name, echo, help_text in (
+            ("send", False, "send stdin (or the given words) to the VM line by line"),
+            ("chat", True, "like send, and print the VM's text on stdout")):
+        command = commands.add_parser(name, parents=[link], help=help_text, description=help_text)
+        command.add_argument("text", nargs="*", help="send this instead of reading stdin")
+        command.add_argument("--linger", type=float, default=10.0,
+                             help="at the end, seconds to wait for the VM to confirm "
+                                  "everything arrived (default 10)")
+        command.set_defaults(run=lambda args, out, echo=echo: cli_send(args, out, echo))
+
+    push = commands.add_parser("push-file", parents=[common], help="push files or folders to the VM",
+                               description="Push files or folders to vm_server.py.")
+    push.add_argument("target", type=parse_target, metavar="HOST[:PORT]")
+    push.add_argument("paths", nargs="+", metavar="PATH")
+    push.add_argument("--streams", type=int, default=1, help="parallel streams per file")
+    push.add_argument("--dedup", action="store_true", help="only send chunks the VM lacks")
+    push.add_argument("--raw", action="store_true",
+                      help="plain bytes for a bootstrap `nc -l` instead of vm_server.py")
+    push.set_defaults(run=cli_push_file)
+
+    watch = commands.add_parser("watch-clipboard", parents=[link],
+                                help="print clipboard items from the VM",
+                                description="Print clipboard items copied on the VM: text on "
+                                            "stdout, other types as status lines.")
+    watch.add_argument("--sync", action="store_true",
+                       help="also exchange items with this machine's clipboard "
+                            "(wl-clipboard, xclip, xsel or pbcopy)")
+    watch.add_argument("--save-dir", help="save images and other non-text items here")
+    watch.set_defaults(run=cli_watch_clipboard)
+    return parser
+
+
+def cli_main(argv):
+    """Run one subcommand; returns its exit status"""
+    if argv[:1] == ["serve"]:
+        import copy_paste_server
+
+        return copy_paste_server.main(argv[1:]) or EXIT_OK
+    args = build_cli_parser().parse_args(argv)
+    return args.run(args, CliOutput(getattr(args, "json", False), getattr(args, "quiet", False)))
+
+
 # ============================================
 # MAIN ENTRY POINT
 # ============================================
 
 def main():
     """Main entry point"""
-    if HAS_GUI:
+    metrics_port = os.environ.get("AUTO_INSTALLER_METRICS_PORT")
+    metrics_file = os.environ.get("AUTO_INSTALLER_METRICS_FILE")
+    if metrics_port or metrics_file:
+        enable_metrics(int(metrics_port) if metrics_port else None, metrics_file,
+                       float(os.environ.get("AUTO_INSTALLER_METRICS_INTERVAL", "10")))
+
+    if len(sys.argv) > 1:
+        sys.exit(cli_main(sys.argv[1:]))
+
+    if load_gui():
         try:
-            app = InstallerGUI()
+            # An empty AUTO_INSTALLER_HISTORY turns the history off
+            history_file = os.environ.get("AUTO_INSTALLER_HISTORY", os.path.join(
+                os.path.expanduser("~"), ".copy_paste_history.sqlite3"))
+            app = InstallerGUI(log_file=os.environ.get("AUTO_INSTALLER_LOG"),
+                               log_level=os.environ.get("AUTO_INSTALLER_LOG_LEVEL", "INFO"),
+                               history_file=history_file or None)
             app.run()
         except Exception as e:
             print(f"GUI Error: {e}")
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for the GUI background helpers
+
+Compares the old per-row / per-pixel code with the bulk Pillow versions
+in auto_installer_py at common window sizes. Needs Pillow, not a display.
+
+    python benchmarks/bench_background.py [--repeat N]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from PIL import Image, ImageDraw  # noqa: E402
+
+import auto_installer_py as app  # noqa: E402
+
+app.load_pil()  # the background code needs the module's Pillow imports
+
+SIZES = [(800, 600), (1920, 1080), (2560, 1440), (3840, 2160)]
+
+
+def legacy_gradient(width, height):
+    """The original fallback: one draw.line per pixel row"""
+    image = Image.new('RGB', (width, height))
+    draw = ImageDraw.Draw(image)
+    for y in range(height):
+        ratio = y / height
+        r = int(44 + (52 - 44) * ratio)
+        g = int(62 + (152 - 62) * ratio)
+        b = int(80 + (219 - 80) * ratio)
+        draw.line([(0, y), (width, y)], fill=(r, g, b))
+    return image
+
+
+def legacy_edge_color(img):
+    """The original edge average: getpixel on sampled border pixels"""
+    edge_colors = []
+    step = max(1, img.width // 20)
+    for x in range(0, img.width, step):
+        edge_colors.append(img.getpixel((x, 0)))
+        edge_colors.append(img.getpixel((x, img.height - 1)))
+    for y in range(0, img.height, step):
+        edge_colors.append(img.getpixel((0, y)))
+        edge_colors.append(img.getpixel((img.width - 1, y)))
+    return tuple(sum(c[i] for c in edge_colors) // len(edge_colors) for i in range(3))
+
+
+def legacy_fit(path, width, height):
+    """The original load path: full decode, edge colour, plain LANCZOS resize"""
+    img = Image.open(path).convert('RGB')
+    bg_color = legacy_edge_color(img)
+    scale = min(width / img.width, height / img.height)
+    new_size = (int(img.width * scale), int(img.height * scale))
+    img = img.resize(new_size, Image.Resampling.LANCZOS)
+    canvas = Image.new('RGB', (width, height), bg_color)
+    canvas.paste(img, ((width - new_size[0]) // 2, (height - new_size[1]) // 2))
+    return canvas
+
+
+def current_fit(width, height):
+    return app.render_background(app.load_background_source((width, height)), width, height)
+
+
+def best_of(repeat, fn, *args):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def report(label, old_ms, new_ms):
+    print(f"{label:<34} {old_ms:9.2f} ms {new_ms:9.2f} ms {old_ms / new_ms:8.1f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='runs per case, best is kept')
+    parser.add_argument('--source', default='4000x3000', help='synthetic JPEG size, WxH')
+    args = parser.parse_args(argv)
+
+    print(f"{'case':<34} {'before':>12} {'after':>12} {'speedup':>9}")
+    for width, height in SIZES:
+        report(f"gradient {width}x{height}",
+               best_of(args.repeat, legacy_gradient, width, height),
+               best_of(args.repeat, app._gradient, width, height))
+
+    src_w, src_h = (int(v) for v in args.source.split('x'))
+    photo = app._gradient(src_w, src_h).rotate(7, expand=False)
+    report(f"edge colour {src_w}x{src_h}",
+           best_of(args.repeat, legacy_edge_color, photo),
+           best_of(args.repeat, app.edge_color, photo))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'background.jpg')
+        photo.save(path, quality=90)
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            for width, height in SIZES:
+                report(f"decode + fit {width}x{height}",
+                       best_of(args.repeat, legacy_fit, path, width, height),
+                       best_of(args.repeat, current_fit, width, height))
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+Loopback benchmark for messaging and file transfer
+
+Starts the generated vm_server.py on localhost and drives it with the
+client code in auto_installer_py. Measures messages per second and
+end-to-end latency (one client to another through the server) per message
+size, file transfer MB/s per file size, and CPU seconds and RSS for the
+client and the server in each phase. Needs no display.
+
+    python benchmarks/bench_loopback.py [--output results.json]
+    python benchmarks/bench_loopback.py --baseline results.json [--tolerance 0.25]
+
+With --baseline the run is compared against a saved result and the exit
+status is 1 if any metric got worse by more than the tolerance.
+"""
+
+import argparse
+import base64
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import auto_installer_py as app  # noqa: E402
+from copy_paste_protocol import FRAME_TEXT, Connection  # noqa: E402
+
+MESSAGE_SIZES = '16,256,4K,64K,1M'
+FILE_SIZES = '1K,1M,64M,256M'
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+# Metrics where a smaller number is better; everything else is a rate
+LOWER_IS_BETTER = ('_ms', 'cpu_s', 'rss_mb', 'seconds')
+# Reported, but a single outlier decides them, so they never fail a comparison
+NOT_GATED = ('latency_max_ms',)
+
+
+def parse_size(text):
+    text = text.strip().upper().rstrip('B')
+    if text[-1:] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def size_label(n):
+    for unit in ('G', 'M', 'K'):
+        if n >= UNITS[unit] and n % UNITS[unit] == 0:
+            return f"{n // UNITS[unit]}{unit}B"
+    return f"{n}B"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def process_usage(pid=None):
+    """(CPU seconds, RSS in MB) of a process; this one if pid is None"""
+    if pid is None:
+        cpu = time.process_time()
+        pid = os.getpid()
+    else:
+        cpu = None
+    rss = None
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        if cpu is None:
+            cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        rss = int(fields[21]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError, AttributeError):
+        try:
+            import psutil
+            proc = psutil.Process(pid)
+            times = proc.cpu_times()
+            cpu = times.user + times.system if cpu is None else cpu
+            rss = proc.memory_info().rss / (1024 * 1024)
+        except Exception:
+            pass
+    return cpu, rss
+
+
+class Usage:
+    """CPU and RSS of both sides over one phase"""
+
+    def __init__(self, server_pid):
+        self.server_pid = server_pid
+
+    def __enter__(self):
+        self.client = process_usage()
+        self.server = process_usage(self.server_pid)
+        self.result = {}
+        return self
+
+    def __exit__(self, *exc):
+        for side, pid, start in (('client', None, self.client),
+                                 ('server', self.server_pid, self.server)):
+            cpu, rss = process_usage(pid)
+            if cpu is not None and start[0] is not None:
+                self.result[f"{side}_cpu_s"] = round(cpu - start[0], 4)
+            if rss is not None:
+                self.result[f"{side}_rss_mb"] = round(rss, 1)
+
+
+def start_server(workdir, port):
+    script = os.path.join(workdir, 'vm_server.py')
+    with open(script, 'w') as f:
+        f.write(app.get_vm_server_code())
+    recv_dir = os.path.join(workdir, 'recv')
+    os.makedirs(recv_dir)
+    proc = subprocess.Popen([sys.executable, script, '--host', '127.0.0.1', '--port', str(port),
+                             '--no-stdin', '--recv-dir', recv_dir],
+                            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return proc, recv_dir
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError('vm_server.py did not start')
+
+
+def open_client(port, codecs):
+    sock = socket.create_connection(('127.0.0.1', port), timeout=10)
+    sock.settimeout(None)
+    conn = Connection(sock, 'frame', codecs=codecs)
+    conn.handshake(hello={'client': 'bench'})
+    return conn
+
+
+def wait_text(conn, pending):
+    """Read until one TEXT frame arrives; extra frames are kept in pending"""
+    while not pending:
+        events = conn.receive()
+        if events is None:
+            raise RuntimeError('server closed the link')
+        pending.extend(e for e in events if e[0] == FRAME_TEXT)
+    return pending.pop(0)
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def bench_messages(port, server_pid, size, count, codecs):
+    sender, receiver = open_client(port, codecs), open_client(port, codecs)
+    # Random base64 text: realistic for pastes and not trivially compressible
+    text = base64.b64encode(os.urandom(size))[:size].decode('ascii')
+    pending = []
+    try:
+        latencies = []
+        with Usage(server_pid) as usage:
+            for _ in range(count):
+                start = time.perf_counter()
+                sender.send_text(text)
+                wait_text(receiver, pending)
+                latencies.append((time.perf_counter() - start) * 1000)
+
+            # Pipelined: the sender never waits, the receiver counts
+            start = time.perf_counter()
+            writer = threading.Thread(target=lambda: [sender.send_text(text) for _ in range(count)])
+            writer.start()
+            for _ in range(count):
+                wait_text(receiver, pending)
+            elapsed = time.perf_counter() - start
+            writer.join()
+    finally:
+        sender.close()
+        receiver.close()
+
+    result = {
+        'msgs_per_s': round(count / elapsed, 1),
+        'mb_per_s': round(count * size / elapsed / (1024 * 1024), 2),
+        'latency_p50_ms': round(percentile(latencies, 0.5), 3),
+        'latency_p90_ms': round(percentile(latencies, 0.9), 3),
+        'latency_p99_ms': round(percentile(latencies, 0.99), 3),
+        'latency_max_ms': round(max(latencies), 3),
+    }
+    result.update(usage.result)
+    return result
+
+
+def make_file(path, size):
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as f:
+        left = size
+        while left:
+            f.write(block[:min(left, len(block))])
+            left -= min(left, len(block))
+
+
+def bench_transfer(port, server_pid, workdir, recv_dir, size, streams):
+    path = os.path.join(workdir, f"bench-{size}.bin")
+    make_file(path, size)
+    try:
+        with Usage(server_pid) as usage:
+            start = time.perf_counter()
+            ok, msg = app.send_file_chunked('127.0.0.1', port, path, streams=streams)
+            elapsed = time.perf_counter() - start
+        if not ok:
+            raise RuntimeError(f"transfer of {size_label(size)} failed: {msg}")
+    finally:
+        os.remove(path)
+        received = os.path.join(recv_dir, os.path.basename(path))
+        if os.path.exists(received):
+            os.remove(received)
+    result = {'seconds': round(elapsed, 4), 'mb_per_s': round(size / elapsed / (1024 * 1024), 2)}
+    result.update(usage.result)
+    return result
+
+
+def best_of(repeat, fn, *args):
+    """Run fn repeat times and keep the best value of every metric"""
+    runs = [fn(*args) for _ in range(repeat)]
+    pick = lambda name: min if name.endswith(LOWER_IS_BETTER) else max  # noqa: E731
+    return {name: pick(name)(run[name] for run in runs if name in run) for name in runs[0]}
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + '.'))
+        elif isinstance(value, (int, float)):
+            flat[name] = value
+    return flat
+
+
+def compare(current, baseline, tolerance):
+    """Print a table against the baseline; returns the regressed metric names"""
+    now, then = flatten(current['results']), flatten(baseline['results'])
+    regressions = []
+    print(f"\n{'metric':<44} {'baseline':>12} {'current':>12} {'change':>9}")
+    for name in sorted(set(now) & set(then)):
+        if name.endswith(('cpu_s', 'seconds')) and then[name] < 0.05:
+            continue  # too short to compare meaningfully
+        old, new = then[name], now[name]
+        change = (new - old) / old if old else 0.0
+        worse = change > tolerance if name.endswith(LOWER_IS_BETTER) else change < -tolerance
+        worse = worse and not name.endswith(NOT_GATED)
+        if worse:
+            regressions.append(name)
+        print(f"{name:<44} {old:12.3f} {new:12.3f} {change:+8.1%}{'  REGRESSION' if worse else ''}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--message-sizes', default=MESSAGE_SIZES,
+                        help=f"comma-separated, e.g. 16,4K,1M (default {MESSAGE_SIZES})")
+    parser.add_argument('--messages', type=int, default=2000,
+                        help='messages per size; capped to 64 MB of traffic per size')
+    parser.add_argument('--file-sizes', default=FILE_SIZES,
+                        help=f"comma-separated, up to several GB (default {FILE_SIZES})")
+    parser.add_argument('--streams', type=int, default=1, help='parallel streams per transfer')
+    parser.add_argument('--codec', default='none', choices=['none', 'zlib', 'lzma'],
+                        help='compression to negotiate for messages (default none)')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='compare against a previously saved --output file')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per case, the best value of each metric is kept')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative change before a metric counts as a regression')
+    args = parser.parse_args(argv)
+
+    results = {'messages': {}, 'transfer': {}}
+    with tempfile.TemporaryDirectory() as workdir:
+        port = free_port()
+        server, recv_dir = start_server(workdir, port)
+        try:
+            print(f"{'messages':<10} {'msgs/s':>10} {'MB/s':>8} {'p50 ms':>8} {'p99 ms':>8} "
+                  f"{'max ms':>8}")
+            for size in (parse_size(s) for s in args.message_sizes.split(',')):
+                count = max(20, min(args.messages, 64 * 1024 * 1024 // size))
+                r = best_of(args.repeat, bench_messages, port, server.pid, size, count,
+                            [args.codec])
+                results['messages'][size_label(size)] = r
+                print(f"{size_label(size):<10} {r['msgs_per_s']:10.0f} {r['mb_per_s']:8.1f} "
+                      f"{r['latency_p50_ms']:8.3f} {r['latency_p99_ms']:8.3f} "
+                      f"{r['latency_max_ms']:8.3f}")
+
+            print(f"\n{'transfer':<10} {'MB/s':>10} {'seconds':>8} {'cli CPU':>8} {'srv CPU':>8}")
+            for size in (parse_size(s) for s in args.file_sizes.split(',')):
+                r = best_of(args.repeat, bench_transfer, port, server.pid, workdir, recv_dir,
+                            size, args.streams)
+                results['transfer'][size_label(size)] = r
+                print(f"{size_label(size):<10} {r['mb_per_s']:10.1f} {r['seconds']:8.3f} "
+                      f"{r.get('client_cpu_s', float('nan')):8.3f} "
+                      f"{r.get('server_cpu_s', float('nan')):8.3f}")
+        finally:
+            server.terminate()
+            server.wait()
+
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'args': {k: v for k, v in vars(args).items() if k not in ('output', 'baseline')},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} metric(s) regressed by more than {args.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark for auto_installer_py
+
+Imports the module in a fresh interpreter under `python -X importtime`
+and times the command line (`--help`) from a cold process. Reports the
+import time, the modules that cost the most, and the wall time of the
+interpreter alone next to the CLI. Fails if importing the module pulls
+in tkinter or Pillow, or reads from stdin (it used to prompt to install
+Pillow at import time). Needs no display.
+
+    python benchmarks/bench_startup.py [--output results.json] [--budget-ms 100]
+    python benchmarks/bench_startup.py --baseline results.json [--tolerance 0.25]
+
+With --baseline the run is compared against a saved result and the exit
+status is 1 if any metric got worse by more than the tolerance, if the
+import takes longer than --budget-ms, or if a GUI module was imported.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+ROOT = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+MODULE = 'auto_installer_py'
+
+# Only the GUI may import these; the CLI and `import auto_installer_py` must not
+GUI_MODULES = ('tkinter', 'PIL', '_tkinter')
+
+
+def run(args, stdin=subprocess.DEVNULL, timeout=60):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    return subprocess.run([sys.executable] + args, cwd=ROOT, env=env, stdin=stdin,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True, timeout=timeout)
+
+
+def parse_importtime(text):
+    """[(name, self_us, cumulative_us, depth)] from -X importtime output"""
+    rows = []
+    for line in text.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3:
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), int(fields[0]), int(fields[1]), depth))
+    return rows
+
+
+def measure_import():
+    """One cold import: (import ms, self ms, rows)"""
+    result = run(['-X', 'importtime', '-c', 'import ' + MODULE])
+    if result.returncode != 0:
+        raise RuntimeError(f"import {MODULE} failed:\n{result.stderr}")
+    rows = parse_importtime(result.stderr)
+    for name, self_us, cumulative_us, depth in rows:
+        if name == MODULE:
+            return cumulative_us / 1000, self_us / 1000, rows
+    raise RuntimeError(f"{MODULE} missing from the -X importtime report")
+
+
+def measure_wall(args):
+    start = time.perf_counter()
+    result = run(args)
+    elapsed = (time.perf_counter() - start) * 1000
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(args)} exited {result.returncode}:\n{result.stderr}")
+    return elapsed
+
+
+def median(values):
+    ordered = sorted(values)
+    return ordered[len(ordered) // 2]
+
+
+def top_modules(rows, count):
+    """The most expensive modules by self time, summed over every run"""
+    totals = {}
+    for name, self_us, _, _ in rows:
+        totals[name] = totals.get(name, 0) + self_us
+    return sorted(totals.items(), key=lambda item: -item[1])[:count]
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + '.'))
+        elif isinstance(value, (int, float)):
+            flat[name] = value
+    return flat
+
+
+def compare(current, baseline, tolerance):
+    """Print a table against the baseline; returns the regressed metric names"""
+    now, then = flatten(current['results']), flatten(baseline['results'])
+    regressions = []
+    print(f"\n{'metric':<32} {'baseline':>10} {'current':>10} {'change':>9}")
+    for name in sorted(set(now) & set(then)):
+        old, new = then[name], now[name]
+        change = (new - old) / old if old else 0.0
+        worse = change > tolerance  # every metric here is a time
+        if worse:
+            regressions.append(name)
+        print(f"{name:<32} {old:10.2f} {new:10.2f} {change:+8.1%}{'  REGRESSION' if worse else ''}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='cold starts per measurement, the median is kept')
+    parser.add_argument('--top', type=int, default=15,
+                        help='how many of the slowest modules to list')
+    parser.add_argument('--budget-ms', type=float, default=100.0,
+                        help='fail if importing the module takes longer (default 100)')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='compare against a previously saved --output file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative change before a metric counts as a regression')
+    args = parser.parse_args(argv)
+
+    # The first run compiles and caches bytecode; time only warm caches
+    measure_import()
+    imports, selfs, rows = [], [], []
+    for _ in range(args.repeat):
+        total, own, run_rows = measure_import()
+        imports.append(total)
+        selfs.append(own)
+        rows.extend(run_rows)
+    loaded = {name for name, _, _, _ in rows}
+    gui = sorted(name for name in loaded if name.split('.')[0] in GUI_MODULES)
+
+    wall = {
+        'interpreter_ms': ['-c', 'pass'],
+        'import_ms': ['-c', 'import ' + MODULE],
+        'cli_help_ms': ['-m', MODULE, '--help'],
+        'cli_send_help_ms': ['-m', MODULE, 'send', '--help'],
+        'script_help_ms': [MODULE + '.py', '--help'],
+    }
+    results = {
+        'import': {'import_ms': round(median(imports), 2),
+                   'module_self_ms': round(median(selfs), 2)},
+        'wall': {},
+    }
+    for name, cmd in wall.items():
+        results['wall'][name] = round(median([measure_wall(cmd) for _ in range(args.repeat)]), 2)
+
+    print(f"import {MODULE}: {results['import']['import_ms']:.1f} ms "
+          f"({results['import']['module_self_ms']:.1f} ms in the module itself, "
+          f"median of {args.repeat})")
+    print(f"\n{'slowest modules (self)':<40} {'ms':>8}")
+    for name, self_us in top_modules(rows, args.top):
+        print(f"{name:<40} {self_us / 1000 / args.repeat:8.2f}")
+    print(f"\n{'cold process (wall)':<40} {'ms':>8}")
+    for name, value in results['wall'].items():
+        print(f"{name:<40} {value:8.1f}")
+
+    failures = []
+    if gui:
+        failures.append(f"importing {MODULE} loaded GUI modules: {', '.join(gui)}")
+    if results['import']['import_ms'] > args.budget_ms:
+        failures.append(f"import took {results['import']['import_ms']:.1f} ms, "
+                        f"over the {args.budget_ms:.0f} ms budget")
+
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'args': {k: v for k, v in vars(args).items() if k not in ('output', 'baseline')},
+        'results': results,
+        'gui_modules': gui,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            failures.append(f"{len(regressions)} metric(s) regressed by more than "
+                            f"{args.tolerance:.0%}")
+    if failures:
+        print()
+        for failure in failures:
+            print(failure)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,382 @@
+# ---- headless chat client: shared by auto_installer.py and chat_client.py ----
+# Keep this module Python 2.7 and 3.x compatible (no f-strings, no annotations).
+
+import argparse
+import binascii
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+# ---- protocol import ----
+# chat_client.py carries the protocol inline, and bundle_source() drops this block
+from copy_paste_protocol import (
+    ClipboardAssembler, ClipboardState, Connection, FLAG_NONE, FLAG_PARTIAL, FRAME_ACK,
+    FRAME_CLIPBOARD, FRAME_PONG, FRAME_TEXT, METRICS, PY2, ProtocolError, RECV_BUFFER_SIZE, ReplayBuffer, SEQ,
+    StreamDecoder, clipboard_pieces, split_sequenced, text_decoder, to_bytes)
+# ---- end of protocol import ----
+
+CLIENT_HOST = '127.0.0.1'
+CLIENT_PORT = 4444
+
+
+def write_stream(stream, text):
+    if PY2:
+        text = to_bytes(text)
+    stream.write(text)
+    stream.flush()
+
+
+class ChatClient(object):
+    # Chat link to vm_server.py without polling: a reader thread sleeps in
+    # recv() until the VM sends something, heartbeats wait on an Event and
+    # the caller sends from its own thread. The GUI chat drives one of
+    # these too. Sessions are resumed after a reconnect, so lines sent while
+    # the link is down are resent once it is back.
+
+    def __init__(self, host=CLIENT_HOST, port=CLIENT_PORT, on_text=None, on_status=None,
+                 on_closed=None, on_clipboard=None, on_pong=None, heartbeat=5.0,
+                 ping_interval=None, backoff_min=0.05, backoff_max=2.0, framing='auto',
+                 hello=None):
+        self.host = host
+        self.port = port
+        # on_text(text, partial) for every piece of text from the VM,
+        # on_status(text) for link events, on_closed() once the link is gone
+        # and, if given, on_clipboard(header, data) for every clipboard item
+        # and on_pong(payload) for every answer to a heartbeat PING. All of
+        # them are called from the reader thread.
+        self.on_text = on_text or self.print_text
+        self.on_status = on_status or self.print_status
+        self.on_closed = on_closed
+        self.on_clipboard = on_clipboard
+        self.on_pong = on_pong
+        # A link silent for `heartbeat` seconds is dead; PINGs go out every
+        # ping_interval, by default four times per window
+        self.heartbeat = heartbeat
+        self.ping_interval = ping_interval or heartbeat / 4.0
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.framing = framing
+        self.hello = hello or {}  # extra HELLO fields
+        self.session_id = binascii.hexlify(os.urandom(8)).decode('ascii')
+        self.replay = ReplayBuffer()
+        self.received = 0
+        self.resumable = False
+        self.conn = None
+        self.connected = False
+        self.running = False
+        self.last_seen = 0.0
+        self.send_lock = threading.Lock()
+        self.acked = threading.Condition()
+        self.stopped = threading.Event()
+        self.reader = None
+        self.text = text_decoder()
+        self.sent = 0  # messages and bytes handed to send()
+        self.sent_bytes = 0
+        self.clip = ClipboardState()
+        self.clip_in = None  # ClipboardAssembler of the current link
+        self.clip_ids = 0
+
+    @staticmethod
+    def print_text(text, partial):
+        write_stream(sys.stdout, text if partial else text + '\n')
+
+    @staticmethod
+    def print_status(text):
+        write_stream(sys.stderr, '[*] %s\n' % text)
+
+    def open_link(self, timeout):
+        sock = socket.create_connection((self.host, self.port), timeout=timeout)
+        sock.settimeout(None)
+        conn = Connection(sock, self.framing)
+        hello = {'client': 'chat_client', 'session': self.session_id, 'ack': self.received}
+        if self.heartbeat:
+            hello['heartbeat'] = self.heartbeat
+        if self.on_clipboard is not None:
+            hello['clipboard'] = True
+        hello.update(self.hello)
+        conn.handshake(hello=hello)
+        return conn
+
+    def attach(self, conn):
+        # Make conn the live link and resend what the server has not seen;
+        # -> number of our lines evicted from the replay buffer before that
+        with self.send_lock:
+            self.resumable = 'session' in conn.peer_info
+            lost = 0
+            if self.resumable:
+                if not conn.peer_info.get('resumed'):
+                    self.received = 0  # a new session (e.g. the server restarted)
+                resend, lost = self.replay.resume(int(conn.peer_info.get('ack', 0)))
+                for seq, flags, data in resend:
+                    conn.send_text(data, bool(flags & FLAG_PARTIAL), seq)
+            self.conn = conn
+            # Items cut off with the previous link are dropped with its assembler
+            self.clip_in = ClipboardAssembler(accept=lambda header: self.clip.remote(header['digest']))
+            self.last_seen = time.time()
+            self.connected = True
+        return lost + conn.peer_info.get('lost', 0)
+
+    def connect(self, timeout=10):
+        # Raises socket.error or ProtocolError if the first link fails
+        conn = self.open_link(timeout)
+        self.running = True
+        self.attach(conn)
+        self.reader = threading.Thread(target=self._receive, name='chat-reader')
+        self.reader.daemon = True
+        self.reader.start()
+        if self.heartbeat and conn.framed:
+            t = threading.Thread(target=self._heartbeat, name='chat-heartbeat')
+            t.daemon = True
+            t.start()
+        return conn
+
+    def send(self, text, partial=False):
+        # Sends one line (or a piece of one); False once the link is gone.
+        # Blocks while the socket is full, so a fast producer is held back.
+        with self.send_lock:
+            if not self.running:
+                return False
+            if self.resumable:
+                seq = self.replay.add(to_bytes(text), FLAG_PARTIAL if partial else FLAG_NONE)
+                if self.connected:
+                    try:
+                        self.conn.send_text(text, partial, seq)
+                    except (socket.error, OSError):
+                        pass  # kept for the resend once the reader reconnects
+            elif self.connected:
+                try:
+                    self.conn.send_text(text, partial)
+                except (socket.error, OSError):
+                    return False
+            else:
+                return False
+        self.sent += 1
+        self.sent_bytes += len(text)
+        METRICS.inc('messages_out_total')
+        return True
+
+    def send_clipboard(self, ctype, data):
+        # Streams one item in pieces, so chat can interleave; False if the
+        # link is down. Items are not replayed: a newer copy supersedes them.
+        with self.send_lock:
+            self.clip_ids += 1
+            stream_id = self.clip_ids
+        for payload, flags in clipboard_pieces(stream_id, ctype, data):
+            with self.send_lock:
+                if not self.connected or not self.conn.framed:
+                    return False
+                try:
+                    payload, compressed = self.conn.compressor.compress(payload)
+                    self.conn.send_frame(FRAME_CLIPBOARD, payload, flags | compressed)
+                except (socket.error, OSError):
+                    return False  # the reader notices the broken link and reconnects
+        METRICS.inc('clipboard_out_total')
+        return True
+
+    def flush(self, timeout=None):
+        # Waits until the VM acknowledged every line; False on timeout or
+        # when the link went away first. Instant on links without sessions.
+        deadline = None if timeout is None else time.time() + timeout
+        with self.acked:
+            while len(self.replay) and self.running:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.acked.wait(remaining)
+        return not len(self.replay)
+
+    def close(self, timeout=2.0):
+        with self.send_lock:
+            was_running, self.running = self.running, False
+            self.connected = False
+            conn = self.conn
+        if conn is not None:
+            try:
+                # Let what we sent drain before the reader sees the server hang up
+                conn.sock.shutdown(socket.SHUT_WR)
+            except (socket.error, OSError):
+                pass
+            if was_running and self.reader is not None and \
+                    self.reader is not threading.current_thread():
+                self.reader.join(timeout)
+            conn.close()
+        self.stopped.set()
+
+    def _receive(self):
+        conn = self.conn
+        while self.running:
+            try:
+                self._read_link(conn)
+                reason = 'VM disconnected'
+            except (socket.error, OSError, ProtocolError) as e:
+                reason = 'link error: %s' % e
+            with self.send_lock:
+                if not self.running:
+                    break
+                self.connected = False
+            conn.close()
+            if not self.resumable:
+                self.on_status(reason)
+                break
+            self.on_status(reason + ', reconnecting')
+            conn = self._reconnect()
+            if conn is None:
+                break
+        self.running = False
+        self.stopped.set()
+        with self.acked:
+            self.acked.notify_all()
+        if self.on_closed is not None:
+            self.on_closed()
+
+    def _read_link(self, conn):
+        while self.running:
+            events = conn.receive()
+            if events is None:
+                return
+            self.last_seen = time.time()
+            last = self.received
+            for ftype, flags, payload in events:
+                if ftype == FRAME_TEXT:
+                    seq, payload = split_sequenced(flags, payload)
+                    if seq is None and conn.peer_info.get('resumed'):
+                        continue  # sent before our HELLO; the replay resends it numbered
+                    if seq is not None:
+                        if seq <= self.received:
+                            continue  # resent after a reconnect, already passed on
+                        self.received = seq
+                    METRICS.inc('messages_in_total')
+                    partial = bool(flags & FLAG_PARTIAL)
+                    self.on_text(self.text.decode(payload, not partial), partial)
+                elif ftype == FRAME_ACK:
+                    self.replay.ack(SEQ.unpack_from(payload)[0])
+                    with self.acked:
+                        self.acked.notify_all()
+                elif ftype == FRAME_CLIPBOARD and self.on_clipboard is not None:
+                    item = self.clip_in.feed(flags, payload)
+                    if item is not None:
+                        METRICS.inc('clipboard_in_total')
+                        self.on_clipboard(*item)
+                elif ftype == FRAME_PONG and self.on_pong is not None:
+                    self.on_pong(payload)
+            if self.received > last:
+                conn.send_frame(FRAME_ACK, SEQ.pack(self.received))
+
+    def _heartbeat(self):
+        # Servers that confirmed the window drop us after that much silence;
+        # ping every ping_interval and give up on a link silent for all of it
+        while not self.stopped.wait(self.ping_interval):
+            conn = self.conn
+            if not self.connected or not conn.framed:
+                continue
+            silent = time.time() - self.last_seen
+            if conn.peer_info.get('heartbeat') and silent > self.heartbeat:
+                self.on_status('no reply from the VM for %.1fs' % silent)
+                METRICS.inc('heartbeat_timeouts_total')
+                conn.abort()  # the reader sees EOF and reconnects
+                continue
+            try:
+                conn.ping()
+            except (socket.error, OSError):
+                pass  # the reader notices the broken link too
+
+    def _reconnect(self):
+        # Jittered exponential backoff until the link is back or we close
+        delay = self.backoff_min
+        started = time.time()
+        while self.running:
+            try:
+                conn = self.open_link(max(delay, 1.0))
+                if not conn.framed:
+                    conn.close()
+                    raise ProtocolError('no greeting')
+            except (socket.error, OSError, ProtocolError):
+                if self.stopped.wait(delay * random.uniform(0.5, 1.5)):
+                    return None
+                delay = min(delay * 2, self.backoff_max)
+                continue
+            if not self.running:
+                conn.close()
+                return None
+            lost = self.attach(conn)
+            METRICS.inc('reconnects_total')
+            METRICS.observe('reconnect_seconds', time.time() - started)
+            self.on_status('reconnected after %.0f ms' % ((time.time() - started) * 1000))
+            if not self.resumable:
+                self.on_status('server did not resume the session; lines may have been lost')
+            if lost:
+                self.on_status('%d line(s) were dropped from the replay buffer' % lost)
+            return conn
+        return None
+
+
+def send_stream(client, fd):
+    # Sends everything read from fd line by line; a line longer than
+    # MAX_LINE_SIZE goes in pieces. Blocking reads, bounded memory.
+    # -> False if the link went away before EOF
+    lines = StreamDecoder(upgrade=False)
+    while True:
+        data = os.read(fd, RECV_BUFFER_SIZE)
+        if not data:
+            # Send an unterminated last line too
+            events = lines.feed(b'\n') if lines.buffered() else []
+        else:
+            events = lines.feed(data)
+        for ftype, flags, line in events:
+            if not client.send(line, bool(flags & FLAG_PARTIAL)):
+                return False
+        if not data:
+            return True
+
+
+def stream_input(client, done, fd=0, linger=10.0):
+    # Sends fd until EOF from a thread of its own, so a link lost for good
+    # (on_closed sets done) ends the wait even while no input comes;
+    # -> True once everything sent was acknowledged within linger seconds
+    sent = []
+    reader = threading.Thread(target=lambda: (sent.append(send_stream(client, fd)), done.set()))
+    reader.daemon = True
+    reader.start()
+    while not done.wait(3600):
+        pass
+    return bool(sent and sent[0]) and client.flush(linger)
+
+
+def client_main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Headless chat client for vm_server.py: lines on stdin go to the VM, '
+                    'text from the VM goes to stdout')
+    parser.add_argument('host', nargs='?', default=CLIENT_HOST)
+    parser.add_argument('port', nargs='?', type=int, default=CLIENT_PORT)
+    parser.add_argument('--heartbeat', type=float, default=5.0,
+                        help='seconds of silence before the link counts as dead (0: off)')
+    parser.add_argument('--linger', type=float, default=10.0,
+                        help='at end of input, seconds to wait for the VM to confirm '
+                             'everything arrived (default 10)')
+    parser.add_argument('--quiet', action='store_true', help='no status lines on stderr')
+    args = parser.parse_args(argv)
+
+    done = threading.Event()
+    client = ChatClient(args.host, args.port, heartbeat=args.heartbeat, on_closed=done.set,
+                        on_status=(lambda text: None) if args.quiet else None)
+    try:
+        conn = client.connect()
+    except (socket.error, OSError, ProtocolError) as e:
+        write_stream(sys.stderr, 'Could not connect to %s:%d: %s\n' % (args.host, args.port, e))
+        return 1
+    if conn.framed:
+        client.on_status('connected to %s:%d, compression: %s'
+                         % (args.host, args.port, conn.compressor.codec))
+    else:
+        client.on_status('connected to %s:%d in newline mode' % (args.host, args.port))
+
+    try:
+        ok = stream_input(client, done, linger=args.linger)
+    except KeyboardInterrupt:
+        client.close()
+        return 130
+    client.close()
+    return 0 if ok else 1
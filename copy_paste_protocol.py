@@ -0,0 +1,1209 @@
+# ---- wire protocol: shared by auto_installer.py and every generated script ----
+# Keep this module Python 2.7 and 3.x compatible (no f-strings, no annotations).
+
+import binascii
+import bisect
+import codecs
+import hashlib
+import json
+import os
+import re
+import socket
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import deque
+
+try:
+    import lzma
+except ImportError:  # Python 2
+    lzma = None
+
+PY2 = sys.version_info[0] == 2
+
+text_type = type(u'')  # unicode on Python 2, str on 3
+
+PROTOCOL_VERSION = 1
+
+# Frame layout: magic, version, type, flags, payload length, payload.
+# 0xC0 never starts valid UTF-8, so the very first byte a peer sends tells
+# a framed client apart from a plain `nc` peer typing text.
+FRAME_MAGIC = b'\xc0\xde'
+FRAME_MAGIC_BYTE = bytearray(FRAME_MAGIC)[0]
+FRAME_HEADER = struct.Struct('!2sBBBI')
+MAX_FRAME_SIZE = 256 * 1024 * 1024
+RECV_BUFFER_SIZE = 256 * 1024
+# Newline-mode text without a newline is handed on in pieces of this size
+# (flagged FLAG_PARTIAL) instead of being buffered until the line ends
+MAX_LINE_SIZE = 4 * 1024 * 1024
+
+# Servers greet every peer with one readable line: plain `nc` clients just
+# see a banner, framed clients learn that they may switch to frames.
+GREETING_PREFIX = b'#copy-paste/'
+
+FRAME_HELLO = 0
+FRAME_TEXT = 1
+FRAME_DATA = 2
+FRAME_FILE_OFFER = 3
+FRAME_FILE_ACCEPT = 4
+FRAME_FILE_CHUNK = 5
+FRAME_FILE_END = 6
+FRAME_FILE_STATUS = 7
+FRAME_DIR_BEGIN = 8
+FRAME_DIR_DATA = 9
+FRAME_DIR_END = 10
+FRAME_DIR_STATUS = 11
+FRAME_ERROR = 15
+FRAME_DEDUP_QUERY = 16
+FRAME_DEDUP_MISSING = 17
+FRAME_DEDUP_CHUNK = 18
+FRAME_DEDUP_COMMIT = 19
+FRAME_DEDUP_STATUS = 20
+FRAME_ACK = 21
+FRAME_PING = 22
+FRAME_PONG = 23
+FRAME_CLIPBOARD = 24
+
+FLAG_NONE = 0
+FLAG_COMPRESSED = 0x01
+FLAG_PARTIAL = 0x02  # TEXT only: the line continues in the next TEXT event
+FLAG_SEQUENCED = 0x04  # TEXT only: payload starts with a SEQ number
+FLAG_FIRST = 0x08  # CLIPBOARD only: first piece of an item, carries its header
+
+# Resumable chat sessions: a client names a session in its HELLO, and both
+# ends then number their TEXT frames. ACK frames carry the highest number
+# received; unacknowledged messages stay in a bounded replay buffer and are
+# resent after a reconnect. A detached session is kept for SESSION_TTL.
+SEQ = struct.Struct('!Q')
+REPLAY_MAX_ITEMS = 10000
+REPLAY_MAX_BYTES = 16 * 1024 * 1024
+SESSION_TTL = 600
+
+# Heartbeats: a client sends PING (an opaque token) and the other end echoes
+# it in a PONG followed by a SEQ with the bytes it still has queued for that
+# client. A client that asks for a 'heartbeat' window in its HELLO is
+# dropped by the server once it has been silent for that long.
+HEARTBEAT_MIN_WINDOW = 1.0
+
+# Clipboard sync: CLIPBOARD frames carry the new clipboard content to peers
+# that set 'clipboard' in their HELLO. Content is identified by the sha256
+# of its type and bytes, so unchanged content and echoes of what the other
+# end just sent are never resent, and local changes closer together than
+# CLIPBOARD_MIN_INTERVAL are coalesced into one send of the latest content.
+#
+# An item is sent as CLIPBOARD_PIECE sized frames, each starting with a
+# CLIP_ID stream id; pieces of different items may interleave. The first
+# piece (FLAG_FIRST) continues with a length-prefixed JSON header (type,
+# size, sha256) and every piece but the last has FLAG_PARTIAL.
+CLIPBOARD_MIN_INTERVAL = 0.05
+CLIPBOARD_POLL_INTERVAL = 0.08
+CLIPBOARD_PIECE = 256 * 1024
+CLIPBOARD_MAX_SIZE = 64 * 1024 * 1024
+CLIP_ID = struct.Struct('!I')
+TEXT_TYPES = ('text/plain', 'text/html')
+
+# Payloads below COMPRESS_MIN_SIZE are never compressed, and compressed
+# output larger than COMPRESS_MAX_RATIO of the input is thrown away.
+COMPRESS_MIN_SIZE = 256
+COMPRESS_MAX_RATIO = 0.9
+COMPRESS_PIECE = 64 * 1024
+
+# Chunked file transfer: the sender offers a manifest (size plus one sha256
+# per chunk), the receiver answers with the chunk ranges it still needs.
+FILE_CHUNK_SIZE = 1024 * 1024
+CHUNK_INDEX = struct.Struct('!I')
+
+# Directory pushes are one tar-like stream carried in DIR_DATA frames: each
+# entry is a length-prefixed JSON header (path, type, mode, mtime, size)
+# followed by `size` bytes of file content.
+ENTRY_HEADER = struct.Struct('!I')
+MAX_ENTRY_HEADER = 64 * 1024
+
+# Deduplicated pushes: the receiver keeps a store of content-defined chunks
+# keyed by sha256. DEDUP_QUERY carries digests, DEDUP_MISSING answers with
+# one 0/1 byte per digest, DEDUP_CHUNK is digest + data, and DEDUP_COMMIT is
+# a length-prefixed JSON header followed by the file's digests in order.
+DIGEST_SIZE = 32
+
+# Chat and clipboard history: one SQLite database per end, in WAL mode so
+# searches never wait for the writer. Writes are queued and committed in
+# batches of up to HISTORY_BATCH by a background thread; text is indexed
+# with FTS5 (FTS4 on older SQLite, a plain LIKE scan without either).
+HISTORY_BATCH = 1000
+HISTORY_RESULTS = 50
+
+
+class ProtocolError(Exception):
+    '''Peer sent bytes that do not follow the protocol'''
+
+
+def to_bytes(value):
+    if isinstance(value, text_type):
+        return value.encode('utf-8')
+    return value
+
+
+def to_text(value):
+    if isinstance(value, text_type):
+        return value
+    return bytes(value).decode('utf-8', 'replace')
+
+
+def text_decoder():
+    # Incremental UTF-8 decoder: characters split across pieces of one line
+    # are kept until the rest arrives instead of being replaced
+    return codecs.getincrementaldecoder('utf-8')('replace')
+
+
+def encode_frame(ftype, payload=b'', flags=FLAG_NONE):
+    header = FRAME_HEADER.pack(FRAME_MAGIC, PROTOCOL_VERSION, ftype, flags, len(payload))
+    return header + bytes(payload)
+
+
+def encode_json(obj):
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def decode_json(payload):
+    return json.loads(to_text(payload))
+
+
+def file_manifest(path, chunk_size=FILE_CHUNK_SIZE):
+    # Hash the file chunk by chunk through one reused buffer
+    hashes = []
+    size = 0
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    with open(path, 'rb') as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            hashes.append(hashlib.sha256(view[:n]).hexdigest())
+            size += n
+    digest = hashlib.sha256(encode_json([os.path.basename(path), size, chunk_size, hashes]))
+    return {'id': digest.hexdigest()[:16], 'name': os.path.basename(path),
+            'size': size, 'chunk_size': chunk_size, 'hashes': hashes}
+
+
+def sendfile(sock, f, offset, count):
+    # Zero-copy where the OS has sendfile(), otherwise reads go through one
+    # reused buffer. Returns the number of bytes sent.
+    if hasattr(sock, 'sendfile') and hasattr(os, 'sendfile'):
+        return sock.sendfile(f, offset, count)
+    buf = bytearray(min(count, 256 * 1024))
+    view = memoryview(buf)
+    f.seek(offset)
+    remaining = count
+    while remaining:
+        n = f.readinto(buf if remaining >= len(buf) else view[:remaining])
+        if not n:
+            break
+        sock.sendall(view[:n])
+        remaining -= n
+    return count - remaining
+
+
+def missing_ranges(have, start, end):
+    # [[first, last + 1], ...] for every run of zero flags in have[start:end]
+    ranges = []
+    i = start
+    while i < end:
+        if have[i]:
+            i += 1
+            continue
+        j = i
+        while j < end and not have[j]:
+            j += 1
+        ranges.append([i, j])
+        i = j
+    return ranges
+
+
+def as_bytes(data):
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return bytes(data)
+
+
+if PY2:
+    # Python 2 codecs only take str/buffer, not bytearray or memoryview
+    codec_input = as_bytes
+else:
+    def codec_input(data):
+        return data
+
+
+def _cpu_clock():
+    for name in ('thread_time', 'process_time', 'clock'):
+        clock = getattr(time, name, None)
+        if clock is not None:
+            return clock
+    return time.time
+
+cpu_time = _cpu_clock()
+
+
+def _codec_table():
+    codecs = {'zlib': (lambda level: zlib.compressobj(6 if level is None else level),
+                       zlib.decompressobj)}
+    if lzma is not None:
+        codecs['lzma'] = (lambda level: lzma.LZMACompressor(preset=1 if level is None else level),
+                          lzma.LZMADecompressor)
+    return codecs
+
+CODECS = _codec_table()
+
+
+def available_codecs():
+    return sorted(CODECS) + ['none']
+
+
+def choose_codec(offered):
+    # First codec in the client's preference list that we can speak
+    for codec in offered or ():
+        if codec == 'none' or codec in CODECS:
+            return codec
+    return 'none'
+
+
+class CompressionStats(object):
+    # Per-message compression records, kept so the thresholds can be tuned
+
+    def __init__(self, keep=1000):
+        self.records = deque(maxlen=keep)
+        self.messages = 0
+        self.compressed = 0
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.cpu_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, direction, codec, raw, wire, cpu_seconds):
+        with self._lock:
+            self.records.append({'direction': direction, 'codec': codec, 'raw': raw,
+                                 'wire': wire, 'ratio': float(wire) / raw if raw else 1.0,
+                                 'cpu': cpu_seconds})
+            self.messages += 1
+            if wire != raw:
+                self.compressed += 1
+            self.raw_bytes += raw
+            self.wire_bytes += wire
+            self.cpu_seconds += cpu_seconds
+
+    def summary(self):
+        with self._lock:
+            ratio = float(self.wire_bytes) / self.raw_bytes if self.raw_bytes else 1.0
+            return {'messages': self.messages, 'compressed': self.compressed,
+                    'raw_bytes': self.raw_bytes, 'wire_bytes': self.wire_bytes,
+                    'ratio': round(ratio, 3), 'cpu_seconds': round(self.cpu_seconds, 4)}
+
+
+# Metrics: counters, gauges and fixed-bucket histograms, exported in the
+# Prometheus text format over HTTP and/or as JSON snapshots to a file. Until
+# enable_metrics() is called METRICS is switched off and its methods return
+# at once, so instrumented code costs one call when metrics are off. It is
+# switched on in place, never replaced, so `from copy_paste_protocol import
+# METRICS` always sees the live object.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+THROUGHPUT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)  # MB/s
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        # -> [(upper bound, observations <= bound)], ending with +Inf
+        total, out = 0, []
+        for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+            total += n
+            out.append((bound, total))
+        return out
+
+
+class Metrics(object):
+    def __init__(self, prefix='copy_paste', enabled=True):
+        self.prefix = prefix
+        self.enabled = enabled
+        self._counters = {}
+        self._gauges = {}  # name -> number or zero-argument callable
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        # value may be a callable, read at export time; None removes it
+        if not self.enabled:
+            return
+        with self._lock:
+            if value is None:
+                self._gauges.pop(name, None)
+            else:
+                self._gauges[name] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS):
+        if not self.enabled:
+            return
+        with self._lock:
+            h = self._histograms.get(name)
+            if h is None:
+                h = self._histograms[name] = Histogram(buckets)
+            h.observe(value)
+
+    def _gauge_values(self, gauges):
+        values = {}
+        for name, value in gauges.items():
+            try:
+                values[name] = value() if callable(value) else value
+            except Exception:
+                pass  # the object behind it went away
+        return values
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = dict((name, {'buckets': h.cumulative(), 'sum': h.sum, 'count': h.count})
+                              for name, h in self._histograms.items())
+        for h in histograms.values():
+            h['buckets'] = [['+Inf' if b == float('inf') else b, n] for b, n in h['buckets']]
+        return {'time': time.time(), 'counters': counters,
+                'gauges': self._gauge_values(gauges), 'histograms': histograms}
+
+    def prometheus(self):
+        snap = self.snapshot()
+        p = self.prefix
+        lines = []
+        for name, value in sorted(snap['counters'].items()):
+            lines += ['# TYPE %s_%s counter' % (p, name), '%s_%s %s' % (p, name, value)]
+        for name, value in sorted(snap['gauges'].items()):
+            lines += ['# TYPE %s_%s gauge' % (p, name), '%s_%s %s' % (p, name, value)]
+        for name, h in sorted(snap['histograms'].items()):
+            lines.append('# TYPE %s_%s histogram' % (p, name))
+            for bound, n in h['buckets']:
+                lines.append('%s_%s_bucket{le="%s"} %d' % (p, name, bound, n))
+            lines += ['%s_%s_sum %s' % (p, name, h['sum']), '%s_%s_count %d' % (p, name, h['count'])]
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics(enabled=False)
+
+
+def enable_metrics(port=None, path=None, interval=10.0, host='127.0.0.1'):
+    # Switch collection on and export on http://host:port/metrics (and
+    # /metrics.json) and/or to path every interval seconds
+    METRICS.enabled = True
+    if port is not None:
+        serve_metrics(METRICS, port, host)
+    if path:
+        t = threading.Thread(target=_write_snapshots, args=(METRICS, path, interval))
+        t.daemon = True
+        t.start()
+    return METRICS
+
+
+def serve_metrics(metrics, port, host='127.0.0.1'):
+    # Imported here so the HTTP modules are only loaded when exporting
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+    except ImportError:  # Python 2
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, ctype = metrics.prometheus().encode('utf-8'), 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body, ctype = encode_json(metrics.snapshot()), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = HTTPServer((host, port), Handler)
+    t = threading.Thread(target=httpd.serve_forever)
+    t.daemon = True
+    t.start()
+    return httpd
+
+
+def _write_snapshots(metrics, path, interval):
+    while True:
+        time.sleep(interval)
+        tmp = path + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(encode_json(metrics.snapshot()) + b'\n')
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            pass  # try again next interval
+
+
+class Compressor(object):
+    # Negotiated per-link codec. Data is fed through streaming compressor
+    # objects piece by piece; small payloads are sent as they are, and a
+    # cheap probe of the first piece skips data that will not shrink.
+
+    def __init__(self, codec='none', level=None, min_size=COMPRESS_MIN_SIZE,
+                 max_ratio=COMPRESS_MAX_RATIO, stats=None):
+        self.codec = codec if codec in CODECS else 'none'
+        self.level = level
+        self.min_size = min_size
+        self.max_ratio = max_ratio
+        self.stats = stats if stats is not None else CompressionStats()
+
+    def compress_parts(self, parts):
+        # Returns (parts to send, flags)
+        raw = sum(len(p) for p in parts)
+        if self.codec == 'none' or raw < self.min_size:
+            return parts, FLAG_NONE
+        started = cpu_time()
+        if raw > 2 * COMPRESS_PIECE:
+            sample = b''.join(as_bytes(p[:COMPRESS_PIECE]) for p in parts)[:COMPRESS_PIECE]
+            if len(zlib.compress(sample, 1)) > len(sample) * self.max_ratio:
+                self.stats.record('out', self.codec, raw, raw, cpu_time() - started)
+                return parts, FLAG_NONE
+        c = CODECS[self.codec][0](self.level)
+        out = []
+        for part in parts:
+            for i in range(0, len(part), COMPRESS_PIECE):
+                piece = c.compress(codec_input(part[i:i + COMPRESS_PIECE]))
+                if piece:
+                    out.append(piece)
+        out.append(c.flush())
+        wire = sum(len(p) for p in out)
+        if wire > raw * self.max_ratio:
+            self.stats.record('out', self.codec, raw, raw, cpu_time() - started)
+            return parts, FLAG_NONE
+        self.stats.record('out', self.codec, raw, wire, cpu_time() - started)
+        return out, FLAG_COMPRESSED
+
+    def compress(self, data):
+        parts, flags = self.compress_parts([data])
+        return b''.join(as_bytes(p) for p in parts), flags
+
+    def decompress(self, payload, limit=MAX_FRAME_SIZE):
+        if self.codec == 'none':
+            raise ProtocolError('compressed frame on a link without a codec')
+        started = cpu_time()
+        d = CODECS[self.codec][1]()
+        out = []
+        total = 0
+        try:
+            # Small input pieces bound how far one step can expand
+            for i in range(0, len(payload), 16384):
+                piece = d.decompress(codec_input(payload[i:i + 16384]))
+                total += len(piece)
+                if total > limit:
+                    raise ProtocolError('decompressed frame exceeds limit')
+                out.append(piece)
+            if hasattr(d, 'flush'):
+                out.append(d.flush())
+        except (zlib.error, EOFError, ValueError) as e:
+            raise ProtocolError('corrupt compressed frame: %s' % e)
+        except Exception as e:
+            if lzma is not None and isinstance(e, lzma.LZMAError):
+                raise ProtocolError('corrupt compressed frame: %s' % e)
+            raise
+        data = b''.join(out)
+        self.stats.record('in', self.codec, len(data), len(payload), cpu_time() - started)
+        return data
+
+    def inflate(self, events):
+        # Decompresses flagged (type, flags, payload) events in place
+        for i, (ftype, flags, payload) in enumerate(events):
+            if flags & FLAG_COMPRESSED:
+                events[i] = (ftype, flags & ~FLAG_COMPRESSED, self.decompress(payload))
+        return events
+
+
+class ReplayBuffer(object):
+    # Messages sent on a resumable session that the peer has not yet
+    # acknowledged, oldest first. Past the limits the oldest are evicted,
+    # and resume() reports how many of those the peer never saw.
+
+    def __init__(self, max_items=REPLAY_MAX_ITEMS, max_bytes=REPLAY_MAX_BYTES):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.next_seq = 1
+        self._items = deque()  # (seq, flags, data)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def pending_bytes(self):
+        return self._bytes
+
+    def add(self, data, flags=FLAG_NONE):
+        with self._lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            self._items.append((seq, flags, data))
+            self._bytes += len(data)
+            while len(self._items) > self.max_items or self._bytes > self.max_bytes:
+                self._bytes -= len(self._items.popleft()[2])
+            return seq
+
+    def ack(self, seq):
+        with self._lock:
+            items = self._items
+            while items and items[0][0] <= seq:
+                self._bytes -= len(items.popleft()[2])
+
+    def resume(self, acked):
+        # -> (messages to resend, number evicted before the peer saw them)
+        self.ack(acked)
+        with self._lock:
+            first = self._items[0][0] if self._items else self.next_seq
+            return list(self._items), max(0, first - acked - 1)
+
+
+def clip_digest(ctype, data):
+    return hashlib.sha256(to_bytes(ctype) + b'\0' + data).digest()
+
+
+def clipboard_pieces(stream_id, ctype, data, piece=CLIPBOARD_PIECE):
+    # Yields (payload, flags) for one item, before compression. Pieces are
+    # cut from a memoryview of data as they are asked for, so only the one
+    # being sent is ever copied.
+    header = encode_json({'type': ctype, 'size': len(data),
+                          'sha256': binascii.hexlify(clip_digest(ctype, data)).decode('ascii')})
+    prefix = CLIP_ID.pack(stream_id)
+    view = memoryview(data)
+    for start in range(0, max(len(data), 1), piece):
+        chunk = codec_input(view[start:start + piece])
+        flags = FLAG_PARTIAL if start + piece < len(data) else FLAG_NONE
+        if start == 0:
+            yield prefix + ENTRY_HEADER.pack(len(header)) + header + chunk, flags | FLAG_FIRST
+        else:
+            yield prefix + chunk, flags
+
+
+def parse_clipboard_piece(flags, payload):
+    # -> (stream id, header dict or None, data, last piece?)
+    stream_id = CLIP_ID.unpack_from(payload)[0]
+    offset = CLIP_ID.size
+    header = None
+    if flags & FLAG_FIRST:
+        length = ENTRY_HEADER.unpack_from(payload, offset)[0]
+        offset += ENTRY_HEADER.size
+        header = decode_json(payload[offset:offset + length])
+        header['digest'] = binascii.unhexlify(header['sha256'])
+        offset += length
+    return stream_id, header, payload[offset:], not flags & FLAG_PARTIAL
+
+
+class ClipboardAssembler(object):
+    # Collects the pieces of incoming clipboard items. accept(header) is
+    # asked at the first piece; the rest of a refused item is skipped
+    # without being buffered.
+
+    def __init__(self, accept=None, max_size=CLIPBOARD_MAX_SIZE):
+        self.accept = accept
+        self.max_size = max_size
+        self.items = {}  # stream id -> (header, bytearray) or None if skipped
+
+    def feed(self, flags, payload):
+        # -> (header, data) once an item is complete, else None
+        stream_id, header, data, last = parse_clipboard_piece(flags, payload)
+        if header is not None:
+            wanted = int(header['size']) <= self.max_size and (
+                self.accept is None or self.accept(header))
+            self.items[stream_id] = (header, bytearray()) if wanted else None
+        item = self.items.get(stream_id)
+        if item is not None:
+            if len(item[1]) + len(data) > self.max_size:
+                raise ProtocolError('clipboard item larger than announced')
+            item[1].extend(data)
+        if last:
+            self.items.pop(stream_id, None)
+            if item is not None:
+                header, data = item[0], bytes(item[1])
+                # A sender that went away mid-item ends it early; drop that
+                if len(data) == int(header['size']) and \
+                        clip_digest(header['type'], data) == header['digest']:
+                    return header, data
+        return None
+
+
+class ClipboardState(object):
+    # Dedup, echo suppression and throttling for one end of clipboard sync.
+    # `current` is the digest of the content both ends are known to hold.
+
+    def __init__(self, min_interval=CLIPBOARD_MIN_INTERVAL):
+        self.min_interval = min_interval
+        self.current = None
+        self.pending = None  # (digest, type, data) held back by the throttle
+        self.last_sent = 0.0
+        self._lock = threading.Lock()
+
+    def local(self, ctype, data, digest=None):
+        # The local clipboard now holds data; returns (type, data) if it is
+        # to be sent right away, None if it is unchanged or held back.
+        # digest is clip_digest(ctype, data) if the caller already has it.
+        h = digest or clip_digest(ctype, data)
+        now = time.time()
+        with self._lock:
+            if h == self.current:
+                self.pending = None
+                return None
+            if now - self.last_sent < self.min_interval:
+                self.pending = (h, ctype, data)
+                return None
+            self.current, self.pending, self.last_sent = h, None, now
+            return ctype, data
+
+    def due(self):
+        # The latest held-back (type, data) once the throttle allows it
+        with self._lock:
+            if self.pending is None or time.time() - self.last_sent < self.min_interval:
+                return None
+            (self.current, ctype, data), self.pending = self.pending, None
+            self.last_sent = time.time()
+            return ctype, data
+
+    def next_due(self):
+        # Seconds until due() can return something, None if nothing waits
+        if self.pending is None:
+            return None
+        return max(0.0, self.last_sent + self.min_interval - time.time())
+
+    def remote(self, h):
+        # An item with digest h arrived from the other end; True if new here
+        with self._lock:
+            if h == self.current:
+                return False
+            self.current, self.pending = h, None
+            return True
+
+
+class HistoryStore(object):
+    # Persistent, searchable log of chat messages and clipboard items.
+    # add() only queues, so it is safe on network and UI threads; search()
+    # and get() read through their own connection.
+
+    def __init__(self, path, batch=HISTORY_BATCH):
+        import sqlite3  # only loaded when history is kept
+        self.sqlite3 = sqlite3
+        self.path = path
+        self.batch = batch
+        self._queue = deque()
+        self._wake = threading.Event()
+        self._closed = False
+        self._read_lock = threading.Lock()
+        self._reader = self._connect()
+        self.fts = self._create_schema(self._reader)
+        METRICS.gauge('history_queue', lambda: len(self._queue))
+        self._thread = threading.Thread(target=self._write_loop, name='history-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _connect(self):
+        db = self.sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def _create_schema(self, db):
+        # -> 'fts5', 'fts4' or None, whichever full text index this SQLite has
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY, '
+                       'ts REAL, source TEXT, kind TEXT, ctype TEXT, text TEXT, data BLOB)')
+            found = db.execute("SELECT sql FROM sqlite_master WHERE name = 'entries_fts'").fetchone()
+            if found:
+                return 'fts5' if 'fts5' in found[0].lower() else 'fts4'
+            for fts, create in (
+                    ('fts5', "CREATE VIRTUAL TABLE entries_fts USING fts5(text, content='entries', "
+                             "content_rowid='id', prefix='2 3')"),
+                    ('fts4', "CREATE VIRTUAL TABLE entries_fts USING fts4(content='entries', text, "
+                             "prefix='2,3')")):
+                try:
+                    db.execute(create)
+                except self.sqlite3.OperationalError:
+                    continue
+                db.execute('CREATE TRIGGER entries_ai AFTER INSERT ON entries BEGIN '
+                           'INSERT INTO entries_fts(rowid, text) VALUES (new.id, new.text); END')
+                # Index whatever was logged before an index was available
+                db.execute('INSERT INTO entries_fts(rowid, text) SELECT id, text FROM entries')
+                return fts
+        return None
+
+    def add(self, source, kind, text, ctype='text/plain', data=None):
+        # kind is 'chat' or 'clipboard'; data holds the bytes of non-text items
+        if self._closed:
+            return
+        if data is not None:
+            data = self.sqlite3.Binary(data)
+        self._queue.append((time.time(), to_text(source), kind, ctype, to_text(text), data))
+        self._wake.set()
+
+    def add_clipboard(self, source, ctype, data):
+        # Text items are stored (and indexed) as text, others as bytes
+        if ctype in TEXT_TYPES:
+            self.add(source, 'clipboard', data, ctype)
+        else:
+            self.add(source, 'clipboard', 'clipboard %s, %d bytes' % (ctype, len(data)), ctype, data)
+
+    def _write_loop(self):
+        db = self._connect()
+        try:
+            while True:
+                self._wake.wait()
+                self._wake.clear()
+                while self._queue:
+                    rows = []
+                    while self._queue and len(rows) < self.batch:
+                        rows.append(self._queue.popleft())
+                    start = time.time()
+                    try:
+                        with db:
+                            db.executemany('INSERT INTO entries (ts, source, kind, ctype, text, data) '
+                                           'VALUES (?, ?, ?, ?, ?, ?)', rows)
+                    except self.sqlite3.Error as e:
+                        sys.stderr.write('history: dropped %d entries: %s\n' % (len(rows), e))
+                        continue
+                    METRICS.inc('history_entries_total', len(rows))
+                    METRICS.observe('history_commit_seconds', time.time() - start)
+                if self._closed:
+                    return
+        finally:
+            db.close()
+
+    def match_expression(self, query):
+        # Every word of the query, as a prefix, in any order
+        words = re.findall(r'\w+', to_text(query), re.UNICODE)
+        return ' '.join(w.lower() + '*' for w in words)
+
+    def search(self, query, limit=HISTORY_RESULTS):
+        # -> newest first [(id, ts, source, kind, ctype, text)] matching query;
+        # an empty query lists the latest entries
+        columns = 'SELECT id, ts, source, kind, ctype, text FROM entries '
+        expr = self.match_expression(query) if self.fts else None
+        if not to_text(query).strip():
+            sql, args = columns + 'ORDER BY id DESC LIMIT ?', (limit,)
+        elif expr:
+            # Limit inside the index first: only `limit` rows are ever joined
+            sql = columns + ('WHERE id IN (SELECT rowid FROM entries_fts WHERE entries_fts MATCH ? '
+                             'ORDER BY rowid DESC LIMIT ?) ORDER BY id DESC')
+            args = (expr, limit)
+        elif self.fts:
+            return []  # nothing searchable in the query
+        else:
+            pattern = '%' + to_text(query).replace('\\', '\\\\').replace('%', '\\%') \
+                .replace('_', '\\_') + '%'
+            sql = columns + "WHERE text LIKE ? ESCAPE '\\' ORDER BY id DESC LIMIT ?"
+            args = (pattern, limit)
+        with self._read_lock:
+            return self._reader.execute(sql, args).fetchall()
+
+    def get(self, entry_id):
+        # -> (source, kind, ctype, text, data bytes or None) or None
+        with self._read_lock:
+            row = self._reader.execute('SELECT source, kind, ctype, text, data FROM entries '
+                                       'WHERE id = ?', (entry_id,)).fetchone()
+        if row is None:
+            return None
+        return row[:4] + (bytes(row[4]) if row[4] is not None else None,)
+
+    def close(self, timeout=None):
+        # Commits what is still queued before returning
+        METRICS.gauge('history_queue', None)
+        self._closed = True
+        self._wake.set()
+        self._thread.join(timeout)
+        with self._read_lock:
+            self._reader.close()
+
+
+def split_sequenced(flags, payload):
+    # -> (seq or None, text payload) for a TEXT frame
+    if flags & FLAG_SEQUENCED:
+        return SEQ.unpack_from(payload)[0], payload[SEQ.size:]
+    return None, payload
+
+
+def make_greeting(info):
+    return (GREETING_PREFIX + str(PROTOCOL_VERSION).encode('ascii') + b' ' +
+            encode_json(info) + b'\n')
+
+
+def parse_greeting(line):
+    # Returns the peer's info dict, or None if the line is not a greeting
+    if not line.startswith(GREETING_PREFIX):
+        return None
+    version, _, info = bytes(line[len(GREETING_PREFIX):]).partition(b' ')
+    try:
+        if int(version) != PROTOCOL_VERSION:
+            return None
+        return decode_json(info.strip() or b'{}')
+    except ValueError:
+        return None
+
+
+class StreamDecoder(object):
+    # Incremental decoder over one preallocated receive buffer. recv() fills
+    # it with recv_into and parses in place: frame headers are read with
+    # unpack_from and newlines found with bytearray.find, so nothing is
+    # re-sliced or re-scanned. Frames too big for the buffer are received
+    # straight into their own payload buffer.
+    #
+    # A link starts in newline mode and switches to frames for good once a
+    # line starts with the frame magic; that is how a framed peer upgrades
+    # the link after the greeting. A newline-mode line that grows past
+    # max_line_size is emitted in FLAG_PARTIAL pieces, so an unterminated
+    # paste cannot grow the buffer without bound.
+
+    def __init__(self, framed=False, upgrade=True, bufsize=RECV_BUFFER_SIZE,
+                 max_frame_size=MAX_FRAME_SIZE, max_line_size=MAX_LINE_SIZE):
+        self.framed = framed
+        self.upgrade = upgrade
+        self.max_frame_size = max_frame_size
+        self.max_line_size = max_line_size
+        self._continued = False  # inside a line that was partly emitted
+        self._buf = bytearray(bufsize)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+        self._big = None  # [type, flags, payload bytearray, bytes filled]
+        self.bytes_in = 0
+
+    def buffered(self):
+        return self._end - self._start
+
+    def recv(self, sock):
+        # One recv_into call; returns the completed events, None on EOF
+        big = self._big
+        if big is not None:
+            n = sock.recv_into(memoryview(big[2])[big[3]:])
+            if not n:
+                return None
+            self.bytes_in += n
+            big[3] += n
+            if big[3] < len(big[2]):
+                return []
+            self._big = None
+            return [(big[0], big[1], big[2])]
+        self._make_room()
+        n = sock.recv_into(self._view[self._end:])
+        if not n:
+            return None
+        self.bytes_in += n
+        self._end += n
+        return self._parse()
+
+    def feed(self, data):
+        # Same as recv() for bytes that were read some other way
+        events = []
+        view = memoryview(data)
+        self.bytes_in += len(view)
+        while len(view):
+            big = self._big
+            if big is not None:
+                take = min(len(view), len(big[2]) - big[3])
+                big[2][big[3]:big[3] + take] = view[:take]
+                big[3] += take
+                view = view[take:]
+                if big[3] == len(big[2]):
+                    self._big = None
+                    events.append((big[0], big[1], big[2]))
+                continue
+            self._make_room()
+            take = min(len(view), len(self._buf) - self._end)
+            self._buf[self._end:self._end + take] = view[:take]
+            self._end += take
+            view = view[take:]
+            events.extend(self._parse())
+        return events
+
+    def _make_room(self):
+        if self._end < len(self._buf):
+            return
+        pending = self._end - self._start
+        if pending == len(self._buf):
+            # A line longer than the buffer: grow it
+            self._resize(len(self._buf) * 2)
+        else:
+            self._buf[:pending] = self._buf[self._start:self._end]
+            self._start, self._end = 0, pending
+
+    def _resize(self, size):
+        pending = self._end - self._start
+        buf = bytearray(size)
+        buf[:pending] = self._buf[self._start:self._end]
+        self._buf, self._view = buf, memoryview(buf)
+        self._start, self._end = 0, pending
+
+    def _parse(self):
+        events = []
+        buf = self._buf
+        header_size = FRAME_HEADER.size
+        while self._start < self._end:
+            start = self._start
+            if not self.framed:
+                if self.upgrade and not self._continued and buf[start] == FRAME_MAGIC_BYTE:
+                    self.framed = True
+                    continue
+                nl = buf.find(b'\n', start, self._end)
+                if nl < 0:
+                    if self._end - start >= self.max_line_size:
+                        events.append((FRAME_TEXT, FLAG_PARTIAL, bytes(buf[start:self._end])))
+                        self._start = self._end
+                        self._continued = True
+                    break
+                end = nl - 1 if nl > start and buf[nl - 1] == 13 else nl
+                events.append((FRAME_TEXT, FLAG_NONE, bytes(buf[start:end])))
+                self._start = nl + 1
+                self._continued = False
+                continue
+
+            if self._end - start < header_size:
+                break
+            magic, version, ftype, flags, length = FRAME_HEADER.unpack_from(buf, start)
+            if magic != FRAME_MAGIC:
+                raise ProtocolError('bad frame magic')
+            if version != PROTOCOL_VERSION:
+                raise ProtocolError('unsupported protocol version %d' % version)
+            if length > self.max_frame_size:
+                raise ProtocolError('frame of %d bytes exceeds limit' % length)
+            body = start + header_size
+            if self._end - body >= length:
+                events.append((ftype, flags, bytes(buf[body:body + length])))
+                self._start = body + length
+            elif header_size + length > len(buf):
+                payload = bytearray(length)
+                have = self._end - body
+                payload[:have] = buf[body:self._end]
+                self._big = [ftype, flags, payload, have]
+                self._start = self._end
+            else:
+                break
+        if self._start == self._end:
+            self._start = self._end = 0
+        return events
+
+
+class Connection(object):
+    # Blocking client side of a link. framing is 'auto' (use frames when the
+    # server greets us, newline mode otherwise), 'frame' or 'newline'.
+
+    def __init__(self, sock, framing='auto', codecs=('zlib', 'none'),
+                 compress_level=None, stats=None):
+        self.sock = sock
+        self.framing = framing
+        self.codecs = list(codecs)
+        self.compress_level = compress_level
+        self.compressor = Compressor('none', stats=stats)
+        self.framed = False
+        self.peer_info = {}
+        self._decoder = None
+        self._pending = []
+        self._send_lock = threading.Lock()
+        self.bytes_out = 0
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (socket.error, OSError):
+            pass
+
+    def handshake(self, hello=None, timeout=1.5):
+        if self.framing == 'newline':
+            self._decoder = StreamDecoder(upgrade=False)
+            return False
+
+        line, rest = self._read_greeting(timeout)
+        info = parse_greeting(line) if line is not None else None
+        if info is None:
+            if self.framing == 'frame':
+                raise ProtocolError('peer did not send a protocol greeting')
+            self._decoder = StreamDecoder(upgrade=False)
+            self._pending = self._decoder.feed((line or b'') + rest)
+            return False
+
+        self.peer_info = info
+        self._decoder = StreamDecoder()
+        hello = dict(hello or {})
+        hello.setdefault('codecs', self.codecs)
+        self.send_frame(FRAME_HELLO, encode_json(hello))
+
+        # Until the server has seen our HELLO it talks to us in newline mode;
+        # its HELLO reply is the first frame on the link.
+        pending = self._decoder.feed(rest)
+        old_timeout = self.sock.gettimeout()
+        self.sock.settimeout(timeout)
+        try:
+            while not [e for e in pending if e[0] == FRAME_HELLO]:
+                events = self._decoder.recv(self.sock)
+                if events is None:
+                    raise ProtocolError('connection closed during handshake')
+                pending += events
+        except socket.timeout:
+            raise ProtocolError('peer did not answer HELLO')
+        finally:
+            self.sock.settimeout(old_timeout)
+
+        for i, (ftype, flags, payload) in enumerate(pending):
+            if ftype == FRAME_HELLO:
+                self.peer_info.update(decode_json(payload))
+                del pending[i]
+                break
+        self.compressor = Compressor(self.peer_info.get('codec', 'none'),
+                                     level=self.compress_level, stats=self.compressor.stats)
+        self._pending = self.compressor.inflate(pending)
+        self.framed = True
+        return True
+
+    def _read_greeting(self, timeout):
+        # Returns (first line incl. newline or None, bytes after it)
+        buf = b''
+        old_timeout = self.sock.gettimeout()
+        self.sock.settimeout(timeout)
+        try:
+            while b'\n' not in buf and len(buf) < 65536:
+                data = self.sock.recv(4096)
+                if not data:
+                    break
+                buf += data
+        except socket.timeout:
+            pass
+        finally:
+            self.sock.settimeout(old_timeout)
+        if b'\n' not in buf:
+            return None, buf
+        line, _, rest = buf.partition(b'\n')
+        return line + b'\n', rest
+
+    def send_frame(self, ftype, payload=b'', flags=FLAG_NONE):
+        header = FRAME_HEADER.pack(FRAME_MAGIC, PROTOCOL_VERSION, ftype, flags, len(payload))
+        with self._send_lock:
+            if len(payload) < 65536:
+                self.sock.sendall(header + bytes(payload))
+            else:
+                self.sock.sendall(header)
+                self.sock.sendall(payload)
+            self._sent(len(header) + len(payload))
+
+    def send_frame_parts(self, ftype, parts, flags=FLAG_NONE):
+        length = sum(len(p) for p in parts)
+        header = FRAME_HEADER.pack(FRAME_MAGIC, PROTOCOL_VERSION, ftype, flags, length)
+        with self._send_lock:
+            self.sock.sendall(header)
+            for part in parts:
+                self.sock.sendall(part)
+            self._sent(len(header) + length)
+
+    def send_payload(self, ftype, parts):
+        # Like send_frame_parts, compressed with the negotiated codec;
+        # returns the flags that were used
+        parts, flags = self.compressor.compress_parts(parts)
+        self.send_frame_parts(ftype, parts, flags)
+        return flags
+
+    def send_frame_file(self, ftype, prefix, f, offset, count):
+        # Frame body is prefix + count bytes of f, sent without copying
+        header = FRAME_HEADER.pack(FRAME_MAGIC, PROTOCOL_VERSION, ftype, FLAG_NONE,
+                                   len(prefix) + count)
+        with self._send_lock:
+            self.sock.sendall(header + prefix)
+            if sendfile(self.sock, f, offset, count) != count:
+                raise ProtocolError('file shrank while being sent')
+            self._sent(len(header) + len(prefix) + count)
+
+    def send_text(self, text, partial=False, seq=None):
+        # partial sends a piece of a line; the next send_text continues it.
+        # seq numbers the message on a resumable session (framed links only).
+        data = to_bytes(text)
+        if self.framed:
+            flags = FLAG_PARTIAL if partial else 0
+            if seq is not None:
+                data = SEQ.pack(seq) + data
+                flags |= FLAG_SEQUENCED
+            payload, compressed = self.compressor.compress(data)
+            self.send_frame(FRAME_TEXT, payload, flags | compressed)
+        else:
+            if not partial:
+                data += b'\n'
+            with self._send_lock:
+                self.sock.sendall(data)
+                self._sent(len(data))
+
+    @property
+    def bytes_in(self):
+        return self._decoder.bytes_in if self._decoder is not None else 0
+
+    def _sent(self, nbytes):
+        self.bytes_out += nbytes
+        METRICS.inc('bytes_out_total', nbytes)
+
+    def ping(self):
+        # Heartbeat; the PONG echoes the token so the caller can time it
+        self.send_frame(FRAME_PING, SEQ.pack(int(time.time() * 1e6)))
+
+    def receive(self):
+        # Blocks for the next batch of (type, flags, payload); None on EOF
+        if self._pending:
+            events, self._pending = self._pending, []
+            return events
+        before = self._decoder.bytes_in
+        events = self._decoder.recv(self.sock)
+        METRICS.inc('bytes_in_total', self._decoder.bytes_in - before)
+        if events is None:
+            return None
+        return self.compressor.inflate(events)
+
+    def expect_frame(self, ftype):
+        # Reads until a frame of ftype arrives and returns its payload.
+        # Other traffic (e.g. chat fan-out) is discarded.
+        while True:
+            events = self.receive()
+            if events is None:
+                raise ProtocolError('connection closed by peer')
+            for i, (t, flags, payload) in enumerate(events):
+                if t == ftype:
+                    self._pending = events[i + 1:] + self._pending
+                    return payload
+
+    def expect(self, ftype):
+        # Like expect_frame, for frames that carry JSON
+        return decode_json(self.expect_frame(ftype))
+
+    def abort(self):
+        # Unblocks a receive() running on another thread, unlike close()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except (socket.error, OSError):
+            pass
+
+    def close(self):
+        try:
+            self.sock.close()
+        except (socket.error, OSError):
+            pass
+
+# ---- end of wire protocol ----
@@ -0,0 +1,1468 @@
+# ---- VM server: vm_server.py is this module with the protocol inline ----
+# Keep this module Python 2.7 and 3.x compatible (no f-strings, no annotations).
+
+import argparse
+import binascii
+import errno
+import hashlib
+import os
+import re
+import select
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+
+try:
+    import selectors
+except ImportError:  # Python 2
+    selectors = None
+
+# ---- protocol import ----
+# vm_server.py carries the protocol inline, and bundle_source() drops this block
+from copy_paste_protocol import (
+    CHUNK_INDEX, CLIPBOARD_MAX_SIZE, CLIPBOARD_POLL_INTERVAL, CLIP_ID, ClipboardState,
+    CompressionStats, Compressor, DIGEST_SIZE, ENTRY_HEADER, FLAG_FIRST, FLAG_NONE, FLAG_PARTIAL,
+    FLAG_SEQUENCED, FRAME_ACK, FRAME_CLIPBOARD, FRAME_DEDUP_CHUNK, FRAME_DEDUP_COMMIT,
+    FRAME_DEDUP_MISSING, FRAME_DEDUP_QUERY, FRAME_DEDUP_STATUS, FRAME_DIR_BEGIN, FRAME_DIR_DATA,
+    FRAME_DIR_END, FRAME_DIR_STATUS, FRAME_FILE_ACCEPT, FRAME_FILE_CHUNK, FRAME_FILE_END,
+    FRAME_FILE_OFFER, FRAME_FILE_STATUS, FRAME_HELLO, FRAME_PING, FRAME_PONG, FRAME_TEXT,
+    HEARTBEAT_MIN_WINDOW, HistoryStore, MAX_ENTRY_HEADER, METRICS, PY2, ProtocolError,
+    ReplayBuffer, SEQ, SESSION_TTL, StreamDecoder, THROUGHPUT_BUCKETS, as_bytes, available_codecs,
+    choose_codec, clip_digest, clipboard_pieces, decode_json, enable_metrics, encode_frame,
+    encode_json, make_greeting, missing_ranges, parse_clipboard_piece, split_sequenced,
+    text_decoder, to_bytes, to_text)
+# ---- end of protocol import ----
+
+HOST = '0.0.0.0'
+PORT = 4444
+
+# A peer that stops reading is dropped once this much output is queued for it
+MAX_PEER_BACKLOG = 64 * 1024 * 1024
+
+# Dedup chunks are written on a worker thread; reading from a peer pauses
+# while more than this much of its chunks waits for the disk
+MAX_CHUNK_BACKLOG = 32 * 1024 * 1024
+
+# The dedup chunk store evicts its least recently used chunks beyond this
+# size, but never a chunk a push used in the last CHUNK_STORE_GRACE seconds
+CHUNK_STORE_MAX = 2048 * 1024 * 1024
+CHUNK_STORE_GRACE = 600
+
+# Clipboard tools that take longer than this are killed (an X11 selection
+# owner that never answers would otherwise hang the read for good). While
+# a polled clipboard stays unchanged, the poll interval doubles up to
+# CLIPBOARD_POLL_IDLE.
+CLIPBOARD_TOOL_TIMEOUT = 2.0
+CLIPBOARD_POLL_IDLE = 1.0
+
+# Transfer ids become part of a file name, so only hex digits are accepted
+# (file_manifest sends the first 16 of a sha256)
+TRANSFER_ID = re.compile(r'^[0-9a-f]{1,64}$')
+
+if selectors is not None:
+    EVENT_READ = selectors.EVENT_READ
+    EVENT_WRITE = selectors.EVENT_WRITE
+    make_selector = selectors.DefaultSelector
+else:
+    EVENT_READ = 1
+    EVENT_WRITE = 2
+
+    class _Key(object):
+        def __init__(self, fileobj, events, data):
+            self.fileobj = fileobj
+            self.events = events
+            self.data = data
+
+    class _SelectSelector(object):
+        # Minimal selectors.DefaultSelector stand-in for Python 2
+
+        def __init__(self):
+            self._keys = {}
+
+        def register(self, fileobj, events, data=None):
+            key = _Key(fileobj, events, data)
+            self._keys[fileobj.fileno()] = key
+            return key
+
+        def modify(self, fileobj, events, data=None):
+            return self.register(fileobj, events, data)
+
+        def unregister(self, fileobj):
+            return self._keys.pop(fileobj.fileno(), None)
+
+        def select(self, timeout=None):
+            keys = list(self._keys.values())
+            rlist = [k.fileobj for k in keys if k.events & EVENT_READ]
+            wlist = [k.fileobj for k in keys if k.events & EVENT_WRITE]
+            r, w, _ = select.select(rlist, wlist, [], timeout)
+            ready = {}
+            for f in r:
+                ready[f.fileno()] = ready.get(f.fileno(), 0) | EVENT_READ
+            for f in w:
+                ready[f.fileno()] = ready.get(f.fileno(), 0) | EVENT_WRITE
+            return [(self._keys[fd], mask) for fd, mask in ready.items() if fd in self._keys]
+
+        def close(self):
+            self._keys.clear()
+
+    make_selector = _SelectSelector
+
+
+def write_out(text):
+    if PY2:
+        text = to_bytes(text)
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+
+def would_block(exc):
+    return getattr(exc, 'errno', None) in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+def safe_name(name):
+    name = os.path.basename(to_text(name).replace('\\', '/'))
+    if name in ('', '.', '..'):
+        raise ValueError('invalid file name %r' % name)
+    return name
+
+
+class IncomingFile(object):
+    # Receiving side of a chunked transfer. Chunks are verified against the
+    # manifest and written in place to <name>.<id>.part; after a dropped
+    # link the chunks already on disk are re-verified (verify_existing, on
+    # a worker thread) so the sender only resends what is missing.
+
+    def __init__(self, recv_dir, manifest):
+        self.id = str(manifest['id'])
+        if not TRANSFER_ID.match(self.id):
+            raise ValueError('invalid transfer id %r' % self.id)
+        self.name = safe_name(manifest['name'])
+        self.size = int(manifest['size'])
+        self.chunk_size = int(manifest['chunk_size'])
+        self.hashes = manifest['hashes']
+        if self.size < 0 or self.chunk_size <= 0:
+            raise ValueError('invalid size in manifest')
+        if len(self.hashes) != (self.size + self.chunk_size - 1) // self.chunk_size:
+            raise ValueError('manifest does not match file size')
+        self.path = os.path.join(recv_dir, self.name)
+        self.part_path = '%s.%s.part' % (self.path, self.id)
+        self.have = bytearray(len(self.hashes))
+        self.users = 0
+        self.started = time.time()
+        self.verified = not os.path.exists(self.part_path)
+        self.waiting = []  # peers to accept once verify_existing is done
+        self.f = open(self.part_path, 'w+b' if self.verified else 'r+b')
+        self.f.truncate(self.size)
+
+    def verify_existing(self):
+        # Runs on a worker thread with a handle of its own; the loop writes
+        # no chunk until the peers waiting for it are accepted
+        with open(self.part_path, 'rb') as f:
+            for index, expected in enumerate(self.hashes):
+                data = f.read(self.chunk_length(index))
+                if len(data) == self.chunk_length(index) and hashlib.sha256(data).hexdigest() == expected:
+                    self.have[index] = 1
+
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def received(self):
+        return sum(self.chunk_length(i) for i in range(len(self.have)) if self.have[i])
+
+    def missing(self, start=0, end=None):
+        if end is None:
+            end = len(self.have)
+        return missing_ranges(self.have, max(0, start), min(end, len(self.have)))
+
+    def write_chunk(self, index, data):
+        # Stripes arrive interleaved from parallel streams, so every chunk
+        # is written at its own offset
+        if index >= len(self.hashes) or len(data) != self.chunk_length(index):
+            return False
+        if hashlib.sha256(data).hexdigest() != self.hashes[index]:
+            return False
+        offset = index * self.chunk_size
+        if hasattr(os, 'pwrite'):
+            os.pwrite(self.f.fileno(), data, offset)
+        else:
+            self.f.seek(offset)
+            self.f.write(data)
+        self.have[index] = 1
+        return True
+
+    def complete(self):
+        return all(self.have)
+
+    def finish(self):
+        self.f.close()
+        if os.path.exists(self.path) and os.name == 'nt':
+            os.remove(self.path)
+        os.rename(self.part_path, self.path)
+
+    def close(self):
+        if not self.f.closed:
+            self.f.close()
+
+
+class ChunkStore(object):
+    # Content-addressed store for deduplicated pushes: one file per chunk,
+    # named by its sha256 and fanned out over 256 subdirectories.
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, digest):
+        name = binascii.hexlify(digest).decode('ascii')
+        return os.path.join(self.root, name[:2], name[2:])
+
+    def has(self, digest):
+        # Touches the chunk: its mtime is when a push last used it (see prune)
+        try:
+            os.utime(self.path(digest), None)
+            return True
+        except OSError:
+            return False
+
+    def put(self, digest, data):
+        # Runs on worker threads, one per pushing peer: the temporary name
+        # is per thread, and a directory another thread made is no error
+        if hashlib.sha256(data).digest() != digest:
+            return False
+        path = self.path(digest)
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                if not os.path.isdir(parent):
+                    raise
+        tmp = '%s.%d.tmp' % (path, threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp, path)
+        return True
+
+    def assemble(self, recipe, dest, size):
+        # Concatenate chunks into dest; runs on a worker thread
+        with open(dest + '.part', 'wb') as out:
+            for digest in recipe:
+                with open(self.path(digest), 'rb') as f:
+                    out.write(f.read())
+            written = out.tell()
+        if written != size:
+            os.remove(dest + '.part')
+            raise ValueError('assembled %d bytes, expected %d' % (written, size))
+        if os.name == 'nt' and os.path.exists(dest):
+            os.remove(dest)
+        os.rename(dest + '.part', dest)
+
+    def prune(self, max_bytes, grace=CHUNK_STORE_GRACE):
+        # Evict the least recently used chunks until the store holds at most
+        # max_bytes; runs on a worker thread. -> (chunks removed, bytes freed)
+        chunks = []
+        total = 0
+        if not os.path.isdir(self.root):
+            return 0, 0
+        for sub in os.listdir(self.root):
+            parent = os.path.join(self.root, sub)
+            if not os.path.isdir(parent):
+                continue
+            for name in os.listdir(parent):
+                path = os.path.join(parent, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue  # removed meanwhile
+                chunks.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        removed = freed = 0
+        cutoff = time.time() - grace
+        for mtime, size, path in sorted(chunks):
+            if total - freed <= max_bytes or mtime > cutoff:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            removed += 1
+            freed += size
+        return removed, freed
+
+
+def split_digests(data):
+    return [as_bytes(data[i:i + DIGEST_SIZE]) for i in range(0, len(data), DIGEST_SIZE)]
+
+
+class IncomingArchive(object):
+    # Extracts a directory push while it streams in; nothing is staged in a
+    # temporary archive. Files are written to <name>.part and renamed once
+    # complete, then get their mode and mtime back. Nothing is ever written
+    # through a symlink: links must resolve inside the tree, and no entry
+    # may have a link among its parents, so links cannot be chained out.
+
+    def __init__(self, recv_dir, name):
+        self.root = os.path.join(recv_dir, safe_name(name))
+        if os.path.islink(self.root):
+            raise ValueError('%s is a symlink' % self.root)
+        self.files = 0
+        self.dirs = 0
+        self.bytes = 0
+        self.errors = []
+        self._header = bytearray()
+        self._need = ENTRY_HEADER.size
+        self._state = 'length'
+        self._file = None
+        self._entry = None
+        self._remaining = 0
+        self._dir_meta = []
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+    def _resolve(self, rel):
+        parts = [p for p in to_text(rel).replace('\\', '/').split('/') if p not in ('', '.')]
+        if not parts or '..' in parts:
+            raise ValueError('unsafe path %r' % rel)
+        path = self.root
+        for part in parts[:-1]:
+            path = os.path.join(path, part)
+            if os.path.islink(path):
+                raise ValueError('unsafe path %r: %s is a symlink' % (rel, part))
+        return os.path.join(path, parts[-1])
+
+    def _inside(self, path):
+        root = os.path.realpath(self.root)
+        path = os.path.realpath(path)
+        return path == root or path.startswith(os.path.join(root, ''))
+
+    def feed(self, data):
+        view = memoryview(data)
+        pos = 0
+        while pos < len(view):
+            if self._state == 'data':
+                take = min(self._remaining, len(view) - pos)
+                if self._file is not None:
+                    self._file.write(view[pos:pos + take])
+                pos += take
+                self._remaining -= take
+                self.bytes += take
+                if not self._remaining:
+                    self._finish_file()
+                continue
+
+            take = min(self._need - len(self._header), len(view) - pos)
+            self._header += view[pos:pos + take]
+            pos += take
+            if len(self._header) < self._need:
+                break
+            header, self._header = bytes(self._header), bytearray()
+            if self._state == 'length':
+                self._need = ENTRY_HEADER.unpack(header)[0]
+                if self._need > MAX_ENTRY_HEADER:
+                    raise ProtocolError('archive entry header too large')
+                self._state = 'header'
+            else:
+                self._need = ENTRY_HEADER.size
+                self._state = 'length'
+                self._start_entry(decode_json(header))
+
+    def _start_entry(self, entry):
+        kind = entry.get('type')
+        try:
+            path = self._resolve(entry.get('path', ''))
+        except ValueError as e:
+            self.errors.append(str(e))
+            path = None
+        if kind == 'file':
+            self._entry = (path, entry)
+            self._remaining = int(entry.get('size', 0))
+            self._file = None
+            if path is not None:
+                try:
+                    parent = os.path.dirname(path)
+                    if not os.path.isdir(parent):
+                        os.makedirs(parent)
+                    flags = (os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                             getattr(os, 'O_NOFOLLOW', 0) | getattr(os, 'O_BINARY', 0))
+                    self._file = os.fdopen(os.open(path + '.part', flags, 0o666), 'wb')
+                except (IOError, OSError) as e:
+                    self.errors.append('%s: %s' % (entry.get('path'), e))
+            if self._remaining:
+                self._state = 'data'
+            else:
+                self._finish_file()
+        elif path is None:
+            return
+        elif os.path.islink(path) and kind != 'symlink':
+            self.errors.append('%s: is a symlink' % entry.get('path'))
+        elif kind == 'dir':
+            try:
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                self.dirs += 1
+                self._dir_meta.append((path, entry))
+            except OSError as e:
+                self.errors.append('%s: %s' % (entry.get('path'), e))
+        elif kind == 'symlink':
+            self._make_symlink(path, entry)
+
+    def _make_symlink(self, path, entry):
+        target = to_text(entry.get('target', ''))
+        if not hasattr(os, 'symlink') or os.path.isabs(target) or \
+                not self._inside(os.path.join(os.path.dirname(path), target)):
+            self.errors.append('%s: skipped symlink to %s' % (entry['path'], target))
+            return
+        try:
+            if os.path.lexists(path):
+                os.remove(path)
+            os.symlink(target, path)
+        except OSError as e:
+            self.errors.append('%s: %s' % (entry['path'], e))
+
+    def _finish_file(self):
+        path, entry = self._entry
+        self._state = 'length'
+        self._entry = None
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        try:
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(path + '.part', path)
+            self._apply_meta(path, entry)
+            self.files += 1
+        except OSError as e:
+            self.errors.append('%s: %s' % (entry.get('path'), e))
+
+    def _apply_meta(self, path, entry):
+        if 'mode' in entry:
+            os.chmod(path, int(entry['mode']) & 0o7777)
+        if 'mtime' in entry:
+            os.utime(path, (entry['mtime'], entry['mtime']))
+
+    def finish(self):
+        if self._file is not None or self._state != 'length' or self._header:
+            self.errors.append('archive ended in the middle of an entry')
+            self.close()
+        # Deepest directories first, after their contents stopped changing
+        for path, entry in reversed(self._dir_meta):
+            if os.path.islink(path):
+                continue  # replaced by a link since; chmod would follow it
+            try:
+                self._apply_meta(path, entry)
+            except OSError as e:
+                self.errors.append('%s: %s' % (entry.get('path'), e))
+        return {'root': self.root, 'files': self.files, 'dirs': self.dirs,
+                'bytes': self.bytes, 'errors': self.errors[:50]}
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def which(name):
+    for d in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(d, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+# Clipboard targets we read, best first, and the type each is sent as
+CLIPBOARD_TARGETS = [('image/png', 'image/png'), ('image/jpeg', 'image/jpeg'),
+                     ('text/html', 'text/html'), ('text/plain;charset=utf-8', 'text/plain'),
+                     ('UTF8_STRING', 'text/plain'), ('text/plain', 'text/plain'),
+                     ('STRING', 'text/plain')]
+
+
+class CommandClipboard(object):
+    # The VM's clipboard through command-line tools. With a watch command
+    # (wl-paste --watch) changes are signalled on a pipe the event loop
+    # waits on; otherwise the server polls, starting every poll_interval.
+    # A poll runs stamp_cmd first (the X11 selection TIMESTAMP) and only
+    # reads the content when the stamp changed or there is none. Tools that
+    # take a type (type_flag) move images and HTML as well as text; the
+    # others only text/plain. Every call blocks, so the server makes them
+    # from worker threads.
+
+    def __init__(self, name, read_cmd, write_cmd, types_cmd=None, type_flag=None,
+                 watch_cmd=None, stamp_cmd=None, poll_interval=CLIPBOARD_POLL_INTERVAL,
+                 timeout=CLIPBOARD_TOOL_TIMEOUT):
+        self.name = name
+        self.read_cmd = read_cmd
+        self.write_cmd = write_cmd
+        self.types_cmd = types_cmd
+        self.type_flag = type_flag
+        self.watch_cmd = watch_cmd
+        self.stamp_cmd = stamp_cmd
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.watcher = None
+        self._stamp = None
+        self._devnull = open(os.devnull, 'wb')
+
+    def _communicate(self, p, data=None):
+        # communicate() with no timeout on Python 2: kill the tool on expiry
+        timer = threading.Timer(self.timeout, self._kill, (p,))
+        timer.start()
+        try:
+            return p.communicate(data)[0]
+        finally:
+            timer.cancel()
+
+    @staticmethod
+    def _kill(p):
+        try:
+            p.kill()
+        except OSError:
+            pass  # exited meanwhile
+
+    def _run(self, cmd):
+        try:
+            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=self._devnull)
+        except OSError:
+            return None
+        out = self._communicate(p)
+        return out if p.returncode == 0 and out else None
+
+    def changed(self):
+        # Cheap check before a full read: False only if the stamp says the
+        # clipboard has the same owner as at the last call
+        if self.stamp_cmd is None:
+            return True
+        stamp, self._stamp = self._stamp, self._run(self.stamp_cmd)
+        return self._stamp is None or self._stamp != stamp
+
+    def read(self):
+        # Current content as (type, bytes); None when empty or unsupported
+        if self.types_cmd is None:
+            data = self._run(self.read_cmd)
+            return ('text/plain', data) if data is not None else None
+        offered = (self._run(self.types_cmd) or b'').decode('utf-8', 'replace').split()
+        for target, ctype in CLIPBOARD_TARGETS:
+            if target in offered:
+                data = self._run(self.read_cmd + [self.type_flag, target])
+                return (ctype, data) if data is not None else None
+        return None
+
+    def write(self, ctype, data):
+        # stdout must not be a pipe: xclip and wl-copy stay in the background
+        # to serve the selection and would keep it open
+        if self.type_flag is not None:
+            cmd = self.write_cmd + [self.type_flag, ctype]
+        elif ctype == 'text/plain':
+            cmd = self.write_cmd
+        else:
+            raise ValueError('%s cannot hold %s' % (self.name, ctype))
+        p = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                             stdout=self._devnull, stderr=self._devnull)
+        self._communicate(p, data)
+
+    def watch(self):
+        # Pipe that becomes readable on every change, or None to poll
+        if self.watch_cmd is None:
+            return None
+        try:
+            self.watcher = subprocess.Popen(self.watch_cmd, stdout=subprocess.PIPE,
+                                            stderr=self._devnull)
+        except OSError:
+            return None
+        return self.watcher.stdout
+
+    def close(self):
+        if self.watcher is not None and self.watcher.poll() is None:
+            self.watcher.terminate()
+        self._devnull.close()
+
+
+def detect_clipboard():
+    # First clipboard tool that works in this session, or None
+    if os.environ.get('WAYLAND_DISPLAY') and which('wl-paste') and which('wl-copy'):
+        return CommandClipboard('wl-clipboard', ['wl-paste', '--no-newline'], ['wl-copy'],
+                                types_cmd=['wl-paste', '--list-types'], type_flag='--type',
+                                watch_cmd=['wl-paste', '--watch', 'echo'])
+    if os.environ.get('DISPLAY'):
+        if which('xclip'):
+            return CommandClipboard('xclip', ['xclip', '-selection', 'clipboard', '-o'],
+                                    ['xclip', '-selection', 'clipboard', '-i'],
+                                    types_cmd=['xclip', '-selection', 'clipboard', '-o',
+                                               '-t', 'TARGETS'],
+                                    stamp_cmd=['xclip', '-selection', 'clipboard', '-o',
+                                               '-t', 'TIMESTAMP'],
+                                    type_flag='-t')
+        if which('xsel'):
+            return CommandClipboard('xsel', ['xsel', '--clipboard', '--output'],
+                                    ['xsel', '--clipboard', '--input'])
+    if sys.platform == 'darwin' and which('pbpaste'):
+        return CommandClipboard('pbpaste', ['pbpaste'], ['pbcopy'])
+    return None
+
+
+class Peer(object):
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.name = '%s:%d' % addr[:2]
+        # Small per-peer buffer keeps hundreds of idle peers cheap; big
+        # frames are received into their own payload buffer anyway
+        self.decoder = StreamDecoder(bufsize=32 * 1024)
+        self.outbuf = bytearray()
+        self.outpos = 0
+        self.hello = {}
+        self.transfer = None
+        self.archive = None
+        self.compressor = Compressor('none')
+        self.text = text_decoder()
+        self.text_continued = False
+        self.session = None
+        self.clip_in = {}  # stream id -> relay state of an incoming clipboard item
+        self.heartbeat = None  # silence window in seconds, if asked for
+        self.last_seen = time.time()
+        self.events = 0  # what the selector waits for on sock
+        self.paused = False  # not read from until its dedup chunks are written
+        self.chunks = deque()  # (digest, data) dedup chunks waiting for the disk
+        self.chunk_bytes = 0
+        self.storing = False  # a worker is writing a batch of chunks
+        self.commit = None  # a DEDUP_COMMIT that waits for those chunks
+
+    def wants_chat(self):
+        return self.hello.get('role', 'chat') == 'chat'
+
+    def wants_clipboard(self):
+        return bool(self.hello.get('clipboard')) and self.decoder.framed
+
+    def encode_text(self, data, partial=False, seq=None):
+        if self.decoder.framed:
+            flags = FLAG_PARTIAL if partial else 0
+            if seq is not None:
+                data = SEQ.pack(seq) + data
+                flags |= FLAG_SEQUENCED
+            payload, compressed = self.compressor.compress(data)
+            return encode_frame(FRAME_TEXT, payload, flags | compressed)
+        return data if partial else data + b'\n'
+
+
+class Session(object):
+    # Outlives a peer's connection, so a client that reconnects resumes
+    # where it left off: `replay` holds what it has not acknowledged and
+    # `received` is the last sequence number it sent us.
+
+    def __init__(self, sid):
+        self.id = sid
+        self.replay = ReplayBuffer()
+        self.received = 0
+        self.acked = 0
+        self.peer = None
+        self.detached = time.time()
+
+
+class Server(object):
+    # Single-threaded, readiness-driven server: epoll/kqueue via selectors
+    # where available, so idle peers cost nothing and there is no polling.
+
+    def __init__(self, host=HOST, port=PORT, use_stdin=True, recv_dir='.', clipboard=None,
+                 history=None, chunk_store_max=CHUNK_STORE_MAX):
+        self.host = host
+        self.port = port
+        self.use_stdin = use_stdin and sys.stdin is not None and os.name != 'nt'
+        self.recv_dir = recv_dir
+        self.sel = make_selector()
+        self.peers = {}
+        self.sessions = {}
+        self.watched = set()  # peers with a heartbeat window
+        self.transfers = {}
+        self.compression_stats = CompressionStats()
+        self.chunk_store = ChunkStore(os.path.join(recv_dir, '.chunk-store'))
+        self.chunk_store_max = chunk_store_max
+        self._pruning = False
+        self._calls = deque()
+        self._wakeup = None
+        self.listener = None
+        self._stdin_lines = StreamDecoder(upgrade=False)
+        # clipboard is a CommandClipboard, or None to only relay between peers
+        self.clipboard = clipboard
+        self.clip = ClipboardState()
+        self._clip_poll = None  # next poll time when the backend cannot watch
+        self._clip_delay = 0.0  # current poll interval, longer while nothing changes
+        self._clip_reading = False  # a read is running on a worker thread
+        self._clip_reread = False  # the watcher signalled again meanwhile
+        self._clip_seen = None  # digest of the last content read
+        self._clip_writes = 0  # writes in flight; reads meanwhile may see old content
+        self._clip_ids = 0
+        # history is a HistoryStore that chat and clipboard items are logged to
+        self.history = history
+        METRICS.gauge('peers', lambda: len(self.peers))
+        METRICS.gauge('sessions', lambda: len(self.sessions))
+        METRICS.gauge('transfers', lambda: len(self.transfers))
+        METRICS.gauge('queued_bytes', lambda: sum(len(p.outbuf) - p.outpos
+                                                  for p in list(self.peers.values())))
+
+    def start(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((self.host, self.port))
+        s.listen(128)
+        s.setblocking(False)
+        self.listener = s
+        self.port = s.getsockname()[1]
+        self.sel.register(s, EVENT_READ, self._accept)
+        if hasattr(socket, 'socketpair'):
+            self._wakeup = socket.socketpair()
+            for sock in self._wakeup:
+                sock.setblocking(False)
+            self.sel.register(self._wakeup[0], EVENT_READ, self._run_calls)
+        if self.clipboard is not None:
+            pipe = self.clipboard.watch()
+            if pipe is not None:
+                self.sel.register(pipe, EVENT_READ, self._clipboard_changed)
+            else:
+                self._clip_poll = 0
+        if self.use_stdin:
+            try:
+                self.sel.register(sys.stdin, EVENT_READ, self._read_stdin)
+            except (OSError, IOError, ValueError):
+                # Not pollable, e.g. /dev/null or a regular file under epoll
+                self.use_stdin = False
+
+    def serve_forever(self):
+        next_sweep = 0
+        while True:
+            # Only wake up on a timer while something needs one: heartbeat
+            # windows, a clipboard that has to be polled, a held-back copy
+            timers = [self.clip.next_due()]
+            if self.watched:
+                timers.append(max(0, next_sweep - time.time()))
+            if self._clip_poll is not None and not self._clip_reading:
+                timers.append(max(0, self._clip_poll - time.time()))
+            timers = [t for t in timers if t is not None]
+            events = self.sel.select(min(timers) if timers else None)
+            started = time.time() if METRICS.enabled else 0
+            for key, mask in events:
+                key.data(key.fileobj, mask)
+            if started:
+                METRICS.observe('dispatch_seconds', time.time() - started)
+            if self.watched and time.time() >= next_sweep:
+                next_sweep = time.time() + HEARTBEAT_MIN_WINDOW / 2
+                self._sweep_heartbeats()
+            if self._clip_poll is not None and not self._clip_reading and \
+                    time.time() >= self._clip_poll:
+                self._read_clipboard(poll=True)
+            item = self.clip.due()
+            if item is not None:
+                self._send_clipboard(*item)
+
+    def _sweep_heartbeats(self):
+        now = time.time()
+        for peer in list(self.watched):
+            if now - peer.last_seen > peer.heartbeat:
+                METRICS.inc('heartbeat_timeouts_total')
+                self._drop(peer, 'missed heartbeats for %.1fs' % (now - peer.last_seen))
+
+    def close(self):
+        for peer in list(self.peers.values()):
+            self._drop(peer, None)
+        if self.clipboard is not None:
+            self.clipboard.close()
+        if self.history is not None:
+            self.history.close()
+        if self.listener is not None:
+            self.listener.close()
+        if self._wakeup is not None:
+            for sock in self._wakeup:
+                sock.close()
+        self.sel.close()
+
+    def call_soon_threadsafe(self, fn, *args):
+        # Schedule fn(*args) on the event loop thread
+        self._calls.append((fn, args))
+        try:
+            self._wakeup[1].send(b'\0')
+        except (socket.error, OSError):
+            pass  # buffer full: a wakeup is already pending
+
+    def run_in_thread(self, work, done):
+        # Run work() off the loop, then done(result, error) back on it; used
+        # for slow disk jobs so chat traffic keeps flowing meanwhile
+        if self._wakeup is None:
+            try:
+                done(work(), None)
+            except Exception as e:
+                done(None, e)
+            return
+
+        def runner():
+            try:
+                result, error = work(), None
+            except Exception as e:
+                result, error = None, e
+            self.call_soon_threadsafe(done, result, error)
+
+        t = threading.Thread(target=runner)
+        t.daemon = True
+        t.start()
+
+    def _run_calls(self, sock, mask):
+        try:
+            while sock.recv(4096):
+                pass
+        except (socket.error, OSError):
+            pass
+        while self._calls:
+            fn, args = self._calls.popleft()
+            try:
+                fn(*args)
+            except Exception as e:
+                # A failed callback must not take the loop and every peer down
+                write_out('Error in %s: %s\n' % (getattr(fn, '__name__', 'callback'), e))
+
+    def _accept(self, listener, mask):
+        while True:
+            try:
+                sock, addr = listener.accept()
+            except (socket.error, OSError) as e:
+                if would_block(e):
+                    return
+                raise
+            sock.setblocking(False)
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except (socket.error, OSError):
+                pass
+            peer = Peer(sock, addr)
+            self.peers[sock.fileno()] = peer
+            self._update_events(peer)
+            write_out('[+] %s connected (%d peers)\n' % (peer.name, len(self.peers)))
+            self._queue(peer, make_greeting({'server': 'vm_server', 'codecs': available_codecs()}))
+
+    def _peer_io(self, sock, mask):
+        peer = self.peers.get(sock.fileno())
+        if peer is None:
+            return
+        if mask & EVENT_WRITE:
+            self._flush(peer)
+        if mask & EVENT_READ and sock.fileno() in self.peers:
+            self._read(peer)
+
+    def _read(self, peer):
+        before = peer.decoder.bytes_in
+        try:
+            frames = peer.decoder.recv(peer.sock)
+            METRICS.inc('bytes_in_total', peer.decoder.bytes_in - before)
+            if frames is None:
+                self._drop(peer, 'closed')
+                return
+            peer.last_seen = time.time()
+            frames = peer.compressor.inflate(frames)
+        except (socket.error, OSError) as e:
+            if not would_block(e):
+                self._drop(peer, str(e))
+            return
+        except ProtocolError as e:
+            self._drop(peer, str(e))
+            return
+        for ftype, flags, payload in frames:
+            try:
+                self._handle(peer, ftype, flags, payload)
+            except (ProtocolError, ValueError, KeyError, TypeError, struct.error) as e:
+                self._drop(peer, 'protocol error: %s' % e)
+                return
+        session = peer.session
+        if session is not None and session.acked < session.received and session.peer is peer:
+            # One cumulative ACK per read, not one per message
+            session.acked = session.received
+            self._queue(peer, encode_frame(FRAME_ACK, SEQ.pack(session.received)))
+
+    def _handle(self, peer, ftype, flags, payload):
+        if ftype == FRAME_HELLO:
+            try:
+                peer.hello = decode_json(payload)
+            except ValueError:
+                peer.hello = {}
+            codec = choose_codec(peer.hello.get('codecs'))
+            peer.compressor = Compressor(codec, stats=self.compression_stats)
+            reply = {'server': 'vm_server', 'codec': codec}
+            if peer.hello.get('heartbeat'):
+                peer.heartbeat = max(float(peer.hello['heartbeat']), HEARTBEAT_MIN_WINDOW)
+                self.watched.add(peer)
+                reply['heartbeat'] = peer.heartbeat
+            resend = []
+            if peer.hello.get('session') and peer.decoder.framed:
+                resend = self._attach_session(peer, reply)
+            self.send_json(peer, FRAME_HELLO, reply)
+            for seq, flags, data in resend:
+                self._queue(peer, peer.encode_text(data, bool(flags & FLAG_PARTIAL), seq))
+        elif ftype == FRAME_ACK:
+            if peer.session is not None:
+                peer.session.replay.ack(SEQ.unpack_from(payload)[0])
+        elif ftype == FRAME_PING:
+            backlog = len(peer.outbuf) - peer.outpos
+            self._queue(peer, encode_frame(FRAME_PONG, payload + SEQ.pack(backlog)))
+        elif ftype == FRAME_TEXT:
+            seq, payload = split_sequenced(flags, payload)
+            if seq is not None and peer.session is not None:
+                if seq <= peer.session.received:
+                    return  # already delivered before the reconnect
+                peer.session.received = seq
+            METRICS.inc('messages_in_total')
+            partial = bool(flags & FLAG_PARTIAL)
+            text = peer.text.decode(payload, not partial)
+            if self.history is not None and text:
+                self.history.add(peer.name, 'chat', text)
+            if not peer.text_continued:
+                text = '[%s] %s' % (peer.name, text)
+            peer.text_continued = partial
+            write_out(text if partial else text + '\n')
+            self.broadcast(payload, exclude=peer, partial=partial)
+        elif ftype == FRAME_CLIPBOARD:
+            self._clipboard_from(peer, flags, payload)
+        elif ftype == FRAME_FILE_OFFER:
+            self._file_offer(peer, decode_json(payload))
+        elif ftype == FRAME_FILE_CHUNK:
+            if peer.transfer is not None and peer.transfer.verified:
+                index = CHUNK_INDEX.unpack_from(payload)[0]
+                peer.transfer.write_chunk(index, memoryview(payload)[CHUNK_INDEX.size:])
+        elif ftype == FRAME_FILE_END:
+            self._file_end(peer)
+        elif ftype == FRAME_DIR_BEGIN:
+            self._dir_begin(peer, decode_json(payload))
+        elif ftype == FRAME_DIR_DATA:
+            if peer.archive is not None:
+                peer.archive.feed(payload)
+        elif ftype == FRAME_DIR_END:
+            self._dir_end(peer)
+        elif ftype == FRAME_DEDUP_QUERY:
+            missing = bytearray(not self.chunk_store.has(d) for d in split_digests(payload))
+            self._queue(peer, encode_frame(FRAME_DEDUP_MISSING, missing))
+        elif ftype == FRAME_DEDUP_CHUNK:
+            # Copied: the payload may be a view of the peer's receive buffer
+            data = as_bytes(payload[DIGEST_SIZE:])
+            peer.chunks.append((as_bytes(payload[:DIGEST_SIZE]), data))
+            peer.chunk_bytes += len(data)
+            self._store_chunks(peer)
+        elif ftype == FRAME_DEDUP_COMMIT:
+            if peer.storing:
+                peer.commit = as_bytes(payload)  # once the chunks before it are written
+            else:
+                self._dedup_commit(peer, payload)
+
+    def send_json(self, peer, ftype, obj):
+        self._queue(peer, encode_frame(ftype, encode_json(obj)))
+
+    def _file_offer(self, peer, offer):
+        self._release_transfer(peer)
+        try:
+            t = self.transfers.get(offer['id'])
+            if t is None:
+                t = IncomingFile(self.recv_dir, offer)
+                self.transfers[t.id] = t
+                if not t.verified:
+                    # Re-hashing a multi-GB .part file would stall every peer
+                    self.run_in_thread(t.verify_existing,
+                                       lambda result, error: self._file_verified(t, error))
+        except (KeyError, TypeError, ValueError, IOError, OSError) as e:
+            self.send_json(peer, FRAME_FILE_ACCEPT, {'error': str(e)})
+            return
+        t.users += 1
+        peer.transfer = t
+        peer.transfer_range = offer.get('range') or (0, len(t.hashes))
+        if t.verified:
+            self._file_accept(peer)
+        else:
+            t.waiting.append(peer)
+
+    def _file_verified(self, t, error):
+        if error is not None:
+            write_out('Could not re-verify %s, receiving it again: %s\n' % (t.part_path, error))
+            t.have[:] = bytearray(len(t.have))
+        t.verified = True
+        waiting, t.waiting = t.waiting, []
+        for peer in waiting:
+            if peer.transfer is t:  # not dropped or moved on meanwhile
+                self._file_accept(peer)
+
+    def _file_accept(self, peer):
+        t = peer.transfer
+        start, end = peer.transfer_range
+        write_out('[%s] receiving %s (%d bytes, %d already here)\n'
+                  % (peer.name, t.name, t.size, t.received()))
+        self.send_json(peer, FRAME_FILE_ACCEPT, {'id': t.id, 'missing': t.missing(start, end)})
+
+    def _file_end(self, peer):
+        t = peer.transfer
+        if t is None:
+            self.send_json(peer, FRAME_FILE_STATUS, {'error': 'no transfer in progress'})
+            return
+        start, end = peer.transfer_range
+        status = {'id': t.id, 'missing': t.missing(start, end), 'complete': t.complete()}
+        if status['complete'] and t.id in self.transfers:
+            del self.transfers[t.id]
+            try:
+                t.finish()
+            except (IOError, OSError) as e:
+                status = {'id': t.id, 'error': str(e)}
+            else:
+                write_out('[%s] received %s\n' % (peer.name, t.path))
+                METRICS.inc('files_received_total')
+                METRICS.observe('transfer_mbps', t.size / (1024.0 * 1024) /
+                                max(time.time() - t.started, 1e-6), THROUGHPUT_BUCKETS)
+        self.send_json(peer, FRAME_FILE_STATUS, status)
+
+    def _dir_begin(self, peer, info):
+        if peer.archive is not None:
+            peer.archive.close()
+        try:
+            peer.archive = IncomingArchive(self.recv_dir, info.get('name', ''))
+        except (ValueError, OSError) as e:
+            peer.archive = None
+            self.send_json(peer, FRAME_DIR_STATUS, {'error': str(e)})
+            return
+        write_out('[%s] receiving directory %s\n' % (peer.name, peer.archive.root))
+
+    def _dir_end(self, peer):
+        archive, peer.archive = peer.archive, None
+        if archive is None:
+            self.send_json(peer, FRAME_DIR_STATUS, {'error': 'no directory transfer in progress'})
+            return
+        status = archive.finish()
+        write_out('[%s] received %s: %d files, %d dirs, %d bytes, %d errors\n'
+                  % (peer.name, archive.root, status['files'], status['dirs'],
+                     status['bytes'], len(status['errors'])))
+        self.send_json(peer, FRAME_DIR_STATUS, status)
+
+    def _attach_session(self, peer, reply):
+        # Bind peer to its (possibly resumed) session; returns what to resend
+        now = time.time()
+        for sid, old in list(self.sessions.items()):
+            if old.peer is None and now - old.detached > SESSION_TTL:
+                del self.sessions[sid]
+        sid = to_text(peer.hello['session'])[:64]
+        session = self.sessions.get(sid)
+        resumed = session is not None
+        if session is None:
+            session = self.sessions[sid] = Session(sid)
+        elif session.peer is not None:
+            self._drop(session.peer, 'replaced by a resumed connection')
+        session.peer = peer
+        session.acked = session.received
+        peer.session = session
+        resend, lost = session.replay.resume(int(peer.hello.get('ack', 0)))
+        reply.update(session=sid, resumed=resumed, ack=session.received, lost=lost)
+        if resumed:
+            METRICS.inc('sessions_resumed_total')
+            write_out('[%s] resumed session, resending %d message(s)\n' % (peer.name, len(resend)))
+        return resend
+
+    def _clipboard_changed(self, pipe, mask):
+        if pipe is not None:
+            if not os.read(pipe.fileno(), 4096):
+                # The watcher died (e.g. the session ended): fall back to polling
+                self.sel.unregister(pipe)
+                self._clip_poll = 0
+                return
+        if self._clip_reading:
+            self._clip_reread = True
+        elif not self._clip_writes:
+            self._read_clipboard()
+
+    def _read_clipboard(self, poll=False):
+        # The tools and the hash run on a worker thread, so a big image or
+        # a tool that hangs never stalls the peers; a poll only reads the
+        # content once the cheap changed() check says so
+        def work():
+            if poll and not self.clipboard.changed():
+                return None
+            item = self.clipboard.read()
+            if item is None or len(item[1]) > CLIPBOARD_MAX_SIZE:
+                return None
+            return item + (clip_digest(*item),)
+
+        def done(result, error):
+            self._clip_reading = False
+            if error is not None:
+                write_out('[!] could not read the clipboard: %s\n' % error)
+            changed = result is not None and result[2] != self._clip_seen
+            if changed:
+                self._clip_seen = result[2]
+                # Skipped while a write runs: the content read may predate it
+                item = None if self._clip_writes else self.clip.local(*result)
+                if item is not None:
+                    if self.history is not None:
+                        self.history.add_clipboard('vm', *item)
+                    self._send_clipboard(*item)
+            if self._clip_poll is not None:
+                interval = self.clipboard.poll_interval
+                self._clip_delay = interval if changed else \
+                    min(max(self._clip_delay, interval) * 2, CLIPBOARD_POLL_IDLE)
+                self._clip_poll = time.time() + self._clip_delay
+            elif self._clip_reread:
+                self._clip_reread = False
+                self._clipboard_changed(None, 0)
+
+        if self._clip_writes:
+            if poll:
+                self._clip_poll = time.time() + self.clipboard.poll_interval
+            return
+        self._clip_reading = True
+        self.run_in_thread(work, done)
+
+    def _clipboard_from(self, peer, flags, payload):
+        # Pieces are relayed to the other peers as they arrive, under an id
+        # of our own; only a clipboard write needs the whole item
+        stream_id, header, data, last = parse_clipboard_piece(flags, payload)
+        if header is not None:
+            size = int(header['size'])
+            if size > CLIPBOARD_MAX_SIZE or not self.clip.remote(header['digest']):
+                # Too big, or what the VM already has (e.g. our own copy echoed back)
+                peer.clip_in[stream_id] = None
+            else:
+                METRICS.inc('clipboard_in_total')
+                write_out('[%s] clipboard updated (%s, %d bytes)\n'
+                          % (peer.name, header['type'], size))
+                del header['digest']
+                self._clip_ids += 1
+                targets = [p for p in self.peers.values() if p is not peer and p.wants_clipboard()]
+                keep = self.clipboard is not None or self.history is not None
+                peer.clip_in[stream_id] = {
+                    'header': header, 'id': self._clip_ids, 'targets': targets,
+                    'buf': bytearray() if keep else None}
+        state = peer.clip_in.get(stream_id)
+        if state is None:
+            if last:
+                peer.clip_in.pop(stream_id, None)
+            return
+        piece = CLIP_ID.pack(state['id'])
+        if header is not None:
+            encoded = encode_json(state['header'])
+            piece += ENTRY_HEADER.pack(len(encoded)) + encoded
+        piece += data
+        out_flags = (FLAG_NONE if last else FLAG_PARTIAL) | (flags & FLAG_FIRST)
+        self._queue_clipboard(state['targets'], piece, out_flags)
+        if state['buf'] is not None:
+            if len(state['buf']) + len(data) > CLIPBOARD_MAX_SIZE:
+                raise ProtocolError('clipboard item larger than announced')
+            state['buf'] += data
+        if last:
+            del peer.clip_in[stream_id]
+            if state['buf'] is not None:
+                ctype, data = state['header']['type'], bytes(state['buf'])
+                if self.history is not None:
+                    self.history.add_clipboard(peer.name, ctype, data)
+                if self.clipboard is not None:
+                    self._write_clipboard(ctype, data)
+
+    def _write_clipboard(self, ctype, data):
+        def done(result, error):
+            self._clip_writes -= 1
+            if error is not None:
+                write_out('[!] could not set the clipboard: %s\n' % error)
+        self._clip_writes += 1
+        self.run_in_thread(lambda: self.clipboard.write(ctype, data), done)
+
+    def _send_clipboard(self, ctype, data):
+        self._clip_ids += 1
+        targets = [p for p in self.peers.values() if p.wants_clipboard()]
+        for payload, flags in clipboard_pieces(self._clip_ids, ctype, data):
+            self._queue_clipboard(targets, payload, flags)
+
+    def _queue_clipboard(self, targets, payload, flags):
+        # Compress once per codec; peers that left meanwhile are skipped
+        encoded = {}
+        for peer in targets:
+            if self.peers.get(peer.sock.fileno()) is not peer:
+                continue
+            codec = peer.compressor.codec
+            if codec not in encoded:
+                data, compressed = peer.compressor.compress(payload)
+                encoded[codec] = encode_frame(FRAME_CLIPBOARD, data, flags | compressed)
+            self._queue(peer, encoded[codec])
+        if flags & FLAG_FIRST:
+            METRICS.inc('clipboard_out_total', len(targets))
+
+    def _dedup_commit(self, peer, payload):
+        length = ENTRY_HEADER.unpack_from(payload)[0]
+        body = ENTRY_HEADER.size + length
+        info = decode_json(payload[ENTRY_HEADER.size:body])
+        recipe = split_digests(payload[body:])
+        dest = os.path.join(self.recv_dir, safe_name(info['name']))
+        absent = [d for d in set(recipe) if not self.chunk_store.has(d)]
+        if absent:
+            self.send_json(peer, FRAME_DEDUP_STATUS, {'error': '%d chunks missing' % len(absent)})
+            return
+
+        def done(result, error):
+            if error is None:
+                try:
+                    if 'mode' in info:
+                        os.chmod(dest, int(info['mode']) & 0o7777)
+                    if 'mtime' in info:
+                        os.utime(dest, (float(info['mtime']), float(info['mtime'])))
+                except (OSError, TypeError, ValueError) as e:
+                    error = e
+            if error is not None:
+                # The sender waits for this status, so errors go back in it too
+                write_out('[%s] could not assemble %s: %s\n' % (peer.name, dest, error))
+                self.send_json(peer, FRAME_DEDUP_STATUS, {'error': str(error)})
+                return
+            write_out('[%s] assembled %s from %d chunks\n' % (peer.name, dest, len(recipe)))
+            self.send_json(peer, FRAME_DEDUP_STATUS, {'path': dest, 'chunks': len(recipe)})
+            self._prune_chunks()
+
+        self.run_in_thread(lambda: self.chunk_store.assemble(recipe, dest, int(info['size'])), done)
+
+    def _store_chunks(self, peer):
+        # Hash and write the peer's queued chunks a batch at a time on a
+        # worker thread, in arrival order, so a DEDUP_COMMIT queued behind
+        # them only runs once they are in the store
+        if peer.storing:
+            if peer.chunk_bytes > MAX_CHUNK_BACKLOG and not peer.paused:
+                peer.paused = True
+                self._update_events(peer)
+            return
+        batch, peer.chunks = peer.chunks, deque()
+        peer.storing = True
+
+        def work():
+            return sum(not self.chunk_store.put(digest, data) for digest, data in batch)
+
+        def done(corrupt, error):
+            peer.storing = False
+            peer.chunk_bytes -= sum(len(data) for digest, data in batch)
+            if error is not None:
+                write_out('[%s] could not store dedup chunks: %s\n' % (peer.name, error))
+            elif corrupt:
+                write_out('[%s] dropped %d corrupt dedup chunk(s)\n' % (peer.name, corrupt))
+            if self.peers.get(peer.sock.fileno()) is not peer:
+                return  # gone meanwhile
+            if peer.chunks:
+                self._store_chunks(peer)
+                return
+            if peer.paused:
+                peer.paused = False
+                self._update_events(peer)
+            if peer.commit is not None:
+                payload, peer.commit = peer.commit, None
+                self._dedup_commit(peer, payload)
+
+        self.run_in_thread(work, done)
+
+    def _update_events(self, peer):
+        # Readable unless paused, writable while output is queued
+        events = (0 if peer.paused else EVENT_READ) | \
+            (EVENT_WRITE if len(peer.outbuf) > peer.outpos else 0)
+        if events == peer.events:
+            return
+        if not events:
+            self.sel.unregister(peer.sock)
+        elif peer.events:
+            self.sel.modify(peer.sock, events, self._peer_io)
+        else:
+            self.sel.register(peer.sock, events, self._peer_io)
+        peer.events = events
+
+    def _prune_chunks(self):
+        if self._pruning or self.chunk_store_max is None:
+            return
+        self._pruning = True
+
+        def done(result, error):
+            self._pruning = False
+            if error is not None:
+                write_out('Could not prune the chunk store: %s\n' % error)
+            elif result[0]:
+                write_out('Chunk store: evicted %d chunks (%d bytes)\n' % result)
+
+        self.run_in_thread(lambda: self.chunk_store.prune(self.chunk_store_max), done)
+
+    def _release_transfer(self, peer):
+        t = peer.transfer
+        peer.transfer = None
+        if t is None:
+            return
+        t.users -= 1
+        if t.users <= 0 and self.transfers.get(t.id) is t:
+            # Keep the verified .part file on disk for a later resume
+            del self.transfers[t.id]
+            t.close()
+
+    def broadcast(self, data, exclude=None, partial=False):
+        # Encode (and compress) once per distinct link setting, not per peer;
+        # session peers get their own sequence numbers, so they are encoded
+        # individually
+        encoded = {}
+        sent = 0
+        flags = FLAG_PARTIAL if partial else FLAG_NONE
+        # Detached sessions first: a failed send below detaches its session
+        # too, after the message is already in that session's buffer
+        for session in self.sessions.values():
+            if session.peer is None:
+                session.replay.add(data, flags)
+        for peer in list(self.peers.values()):
+            if peer is exclude or not peer.wants_chat():
+                continue
+            sent += 1
+            if peer.session is not None:
+                seq = peer.session.replay.add(data, flags)
+                self._queue(peer, peer.encode_text(data, partial, seq))
+                continue
+            key = (peer.decoder.framed, peer.compressor.codec)
+            if key not in encoded:
+                encoded[key] = peer.encode_text(data, partial)
+            self._queue(peer, encoded[key])
+        METRICS.inc('messages_out_total', sent)
+
+    def _queue(self, peer, data):
+        METRICS.inc('bytes_out_total', len(data))
+        if not peer.outbuf:
+            try:
+                sent = peer.sock.send(data)
+            except (socket.error, OSError) as e:
+                if not would_block(e):
+                    self._drop(peer, str(e))
+                    return
+                sent = 0
+            if sent == len(data):
+                return
+            data = memoryview(data)[sent:]
+        peer.outbuf += data
+        self._update_events(peer)
+        if len(peer.outbuf) - peer.outpos > MAX_PEER_BACKLOG:
+            self._drop(peer, 'too slow, output backlog exceeded')
+
+    def _flush(self, peer):
+        # Sends from a moving offset; the buffer is only compacted once the
+        # consumed head is large, instead of shifting it on every send
+        try:
+            sent = peer.sock.send(memoryview(peer.outbuf)[peer.outpos:])
+        except (socket.error, OSError) as e:
+            if not would_block(e):
+                self._drop(peer, str(e))
+            return
+        peer.outpos += sent
+        if peer.outpos == len(peer.outbuf):
+            del peer.outbuf[:]
+            peer.outpos = 0
+            self._update_events(peer)
+        elif peer.outpos > 1024 * 1024 and peer.outpos * 2 > len(peer.outbuf):
+            del peer.outbuf[:peer.outpos]
+            peer.outpos = 0
+
+    def _drop(self, peer, reason):
+        fd = peer.sock.fileno()
+        if self.peers.pop(fd, None) is None:
+            return
+        self._release_transfer(peer)
+        if peer.archive is not None:
+            peer.archive.close()
+            peer.archive = None
+        try:
+            self.sel.unregister(peer.sock)
+        except (KeyError, ValueError):
+            pass
+        peer.sock.close()
+        self.watched.discard(peer)
+        for state in peer.clip_in.values():
+            if state is not None:
+                # End the relayed items; receivers drop them as incomplete
+                self._queue_clipboard(state['targets'], CLIP_ID.pack(state['id']), FLAG_NONE)
+        if peer.session is not None and peer.session.peer is peer:
+            peer.session.peer = None
+            peer.session.detached = time.time()
+        if reason:
+            write_out('[-] %s disconnected: %s (%d peers)\n' % (peer.name, reason, len(self.peers)))
+
+    def _read_stdin(self, stdin, mask):
+        data = os.read(stdin.fileno(), 65536)
+        if not data:
+            # Keep serving peers when stdin is closed (e.g. run as a service)
+            self.sel.unregister(stdin)
+            return
+        for ftype, flags, line in self._stdin_lines.feed(data):
+            if self.history is not None and line:
+                self.history.add('vm', 'chat', to_text(line))
+            self.broadcast(line, partial=bool(flags & FLAG_PARTIAL))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Real-time clipboard sync server')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--no-stdin', action='store_true',
+                        help='do not forward lines typed on this terminal')
+    parser.add_argument('--recv-dir', default='.',
+                        help='where files pushed from the host are stored')
+    parser.add_argument('--clipboard', action='store_true',
+                        help='sync the VM clipboard (needs wl-clipboard, xclip, xsel or pbcopy)')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve Prometheus metrics on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--metrics-file',
+                        help='write a JSON metrics snapshot to this file periodically')
+    parser.add_argument('--metrics-interval', type=float, default=10.0,
+                        help='seconds between JSON snapshots (default 10)')
+    parser.add_argument('--history', metavar='FILE',
+                        help='keep a searchable SQLite log of chat and clipboard items')
+    parser.add_argument('--search', metavar='QUERY',
+                        help='print the --history entries matching QUERY and exit')
+    parser.add_argument('--chunk-store-mb', type=int, default=CHUNK_STORE_MAX // (1024 * 1024),
+                        help='size cap of the dedup chunk store in RECV_DIR/.chunk-store; least '
+                             'recently used chunks are evicted beyond it (default %(default)d)')
+    parser.add_argument('--prune-chunk-store', action='store_true',
+                        help='evict chunks down to --chunk-store-mb now and exit '
+                             '(--chunk-store-mb 0 empties the store)')
+    args = parser.parse_args(argv)
+    chunk_store_max = max(0, args.chunk_store_mb) * 1024 * 1024
+
+    if args.prune_chunk_store:
+        store = ChunkStore(os.path.join(args.recv_dir, '.chunk-store'))
+        removed, freed = store.prune(chunk_store_max, grace=0)
+        write_out('Evicted %d chunks (%d bytes) from %s\n' % (removed, freed, store.root))
+        return
+
+    history = HistoryStore(args.history) if args.history else None
+    if args.search is not None:
+        if history is None:
+            parser.error('--search needs --history')
+        for entry_id, ts, source, kind, ctype, text in reversed(history.search(args.search)):
+            stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts))
+            write_out('%s [%s] %s: %s\n' % (stamp, source, kind, text.replace('\n', ' ')))
+        history.close()
+        return
+
+    if args.metrics_port is not None or args.metrics_file:
+        enable_metrics(args.metrics_port, args.metrics_file, args.metrics_interval)
+
+    clipboard = None
+    if args.clipboard:
+        clipboard = detect_clipboard()
+        if clipboard is None:
+            write_out('No clipboard tool found; clipboard contents are only relayed between hosts.\n')
+        else:
+            write_out('Syncing the clipboard through %s.\n' % clipboard.name)
+    server = Server(args.host, args.port, use_stdin=not args.no_stdin,
+                    recv_dir=args.recv_dir, clipboard=clipboard, history=history,
+                    chunk_store_max=chunk_store_max)
+    server.start()
+    write_out('Listening on %s:%d, waiting for connections...\n' % (args.host, server.port))
+    write_out('Type anything and press Enter to send to every connected host.\n')
+    write_out('Incoming text will appear automatically.\n\n')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        write_out('\nShutting down.\n')
+    finally:
+        server.close()
+        stats = server.compression_stats.summary()
+        if stats['messages']:
+            write_out('Compression: %(messages)d messages, %(raw_bytes)d -> %(wire_bytes)d bytes '
+                      '(ratio %(ratio).3f, %(cpu_seconds).3fs CPU)\n' % stats)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,23 @@
+import os
+import sys
+import threading
+
+import pytest
+
+ROOT = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, ROOT)
+
+from copy_paste_server import Server  # noqa: E402
+
+
+@pytest.fixture
+def server(tmp_path):
+    """A Server on a free localhost port, receiving into tmp_path/recv"""
+    recv = tmp_path / 'recv'
+    recv.mkdir()
+    srv = Server('127.0.0.1', 0, use_stdin=False, recv_dir=str(recv))
+    srv.start()
+    t = threading.Thread(target=srv.serve_forever)
+    t.daemon = True
+    t.start()
+    return srv
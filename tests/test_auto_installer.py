@@ -0,0 +1,127 @@
+"""Host side pieces of auto_installer_py that run without a display"""
+
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+from collections import deque
+
+import auto_installer_py as app
+from conftest import ROOT
+
+
+class FakeStore(object):
+    def __init__(self):
+        self.rows = []
+
+    def add(self, source, kind, text):
+        self.rows.append((source, kind, text))
+
+
+def test_long_vm_line_is_shown_and_stored_once():
+    # The reader thread's half of LiveChatClient, without its window
+    chat = app.LiveChatClient.__new__(app.LiveChatClient)
+    chat.vm_line, chat.incoming, chat.store = [], deque(), FakeStore()
+
+    chat.on_vm_text('a long line ', True)
+    chat.on_vm_text('  split in pieces', True)
+    assert not chat.incoming
+    chat.on_vm_text(' énds here  \n', False)
+    chat.on_vm_text('   ', False)
+
+    line = 'a long line   split in pieces énds here  '
+    assert list(chat.incoming) == [('vm', line)]
+    assert chat.store.rows == [('vm', 'chat', line)]
+
+
+def test_one_byte_edit_changes_at_most_two_chunks():
+    rng = random.Random(7)
+    data = bytes(bytearray(rng.getrandbits(8) for _ in range(512 * 1024)))
+    sizes = dict(min_size=2048, avg_size=8192, max_size=32768, block_size=64 * 1024)
+
+    def chunks(data):
+        found = list(app.cdc_chunks(io.BytesIO(data), **sizes))
+        assert [offset for offset, _, _ in found] == \
+            [sum(length for _, length, _ in found[:i]) for i in range(len(found))]
+        assert sum(length for _, length, _ in found) == len(data)
+        return found
+
+    before = chunks(data)
+    assert len(before) > 20
+    old = set(digest for _, _, digest in before)
+    for at in (0, 1000, len(data) // 2, len(data) - 1):
+        for edited in (data[:at] + bytes(bytearray([data[at] ^ 1])) + data[at + 1:],
+                       data[:at] + b'!' + data[at:]):
+            new = [digest for _, _, digest in chunks(edited) if digest not in old]
+            assert 1 <= len(new) <= 2, at
+
+
+def test_scrollback_pages_at_both_ends():
+    store = app.ScrollbackStore()
+    try:
+        store.extend(1.0, [('me', 'line %d' % i) for i in range(8)])
+        store.extend(2.0, [('vm', 'last'), ('me', 'image', 42)])
+        assert len(store) == 10
+        assert store.page(-5, 2) == [(1.0, 'me', 'line 0'), (1.0, 'me', 'line 1')]
+        assert store.page(8, 50) == [(2.0, 'vm', 'last'), (2.0, 'me', 'image', 42)]
+        assert store.page(10, 12) == [] and store.page(3, 3) == []
+        assert [m[2] for m in store.page(0, len(store))][:3] == ['line 0', 'line 1', 'line 2']
+
+        store.clear()
+        assert len(store) == 0 and store.page(0, 10) == []
+        store.extend(3.0, [('vm', 'after clear')])
+        assert store.page(0, 10) == [(3.0, 'vm', 'after clear')]
+    finally:
+        store.close()
+
+
+def cli(*args):
+    """Run the CLI in a fresh interpreter -> (exit status, JSON events or stdout, stderr)"""
+    result = subprocess.run([sys.executable, '-m', 'auto_installer_py'] + list(args), cwd=ROOT,
+                            env=dict(os.environ, PYTHONPATH=ROOT), stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True, timeout=60)
+    out = result.stdout
+    if '--json' in args:
+        out = [json.loads(line) for line in out.splitlines()]
+    return result.returncode, out, result.stderr
+
+
+def test_cli_exit_codes_and_json_output(server, tmp_path):
+    target = '127.0.0.1:%d' % server.port
+    path = tmp_path / 'notes.txt'
+    path.write_bytes(b'pushed from the CLI\n')
+
+    status, out, _ = cli('push-file', '--json', target, str(path))
+    assert status == app.EXIT_OK
+    pushed = [e for e in out if e['event'] == 'pushed']
+    assert [(e['path'], e['ok'], e['bytes']) for e in pushed] == [(str(path), True, 20)]
+    assert (tmp_path / 'recv' / 'notes.txt').read_bytes() == b'pushed from the CLI\n'
+
+    missing = str(tmp_path / 'missing.txt')
+    status, out, _ = cli('push-file', '--json', target, missing)
+    assert status == app.EXIT_FAILED
+    assert [e['event'] for e in out] == ['pushed', 'error']
+
+    status, out, _ = cli('send', '--json', '-q', target, 'hello', 'vm')
+    assert status == app.EXIT_OK
+    assert [(e['event'], e['messages'], e['acknowledged']) for e in out] == [('sent', 1, True)]
+
+    with socket.socket() as unused:
+        unused.bind(('127.0.0.1', 0))
+        closed = '127.0.0.1:%d' % unused.getsockname()[1]
+    status, out, _ = cli('send', '--json', closed, 'hi')
+    assert status == app.EXIT_FAILED
+    assert out[-1]['event'] == 'error'
+
+    # Without --json stdout only carries data; status and errors go to stderr
+    status, out, err = cli('push-file', target, missing)
+    assert (status, out) == (app.EXIT_FAILED, '')
+    assert err.startswith('Error: missing.txt')
+
+    status, _, err = cli('push-file', '--streams', 'many', target, str(path))
+    assert status == app.EXIT_USAGE
+    assert 'invalid int value' in err
@@ -0,0 +1,133 @@
+"""Clipboard sync: the VM server's clipboard polling and the host's watcher"""
+
+import os
+import threading
+import time
+
+import pytest
+
+import auto_installer_py as app
+from copy_paste_client import ChatClient
+from copy_paste_server import CommandClipboard, Server
+
+
+class FakeClipboard(object):
+    """A polled clipboard backend whose reads can be held up"""
+
+    poll_interval = 0.01
+
+    def __init__(self, content=None):
+        self.content = content
+        self.stamp_changed = True
+        self.release = threading.Event()
+        self.release.set()
+        self.checks = self.reads = 0
+
+    def watch(self):
+        return None
+
+    def changed(self):
+        self.checks += 1
+        return self.stamp_changed
+
+    def read(self):
+        self.reads += 1
+        self.release.wait(5)
+        return self.content
+
+    def write(self, ctype, data):
+        self.content = (ctype, data)
+
+    def close(self):
+        self.release.set()
+
+
+def serve(clipboard, tmp_path):
+    srv = Server('127.0.0.1', 0, use_stdin=False, recv_dir=str(tmp_path), clipboard=clipboard)
+    srv.start()
+    t = threading.Thread(target=srv.serve_forever)
+    t.daemon = True
+    t.start()
+    return srv
+
+
+def test_hung_clipboard_read_does_not_stall_the_server(tmp_path):
+    clipboard = FakeClipboard(('text/plain', b'copied on the VM'))
+    clipboard.release.clear()
+    srv = serve(clipboard, tmp_path)
+    received, pongs = [], []
+    client = ChatClient('127.0.0.1', srv.port, on_status=lambda text: None,
+                        on_clipboard=lambda header, data: received.append(data),
+                        on_pong=pongs.append, heartbeat=2.0, ping_interval=0.02)
+    try:
+        client.connect(timeout=5)
+        deadline = time.time() + 5
+        while not pongs and time.time() < deadline:
+            time.sleep(0.01)
+        assert pongs and clipboard.reads == 1 and not received
+        clipboard.release.set()
+        deadline = time.time() + 5
+        while not received and time.time() < deadline:
+            time.sleep(0.01)
+        assert received == [b'copied on the VM']
+    finally:
+        client.close()
+
+
+def test_unchanged_clipboard_is_polled_less_often(tmp_path):
+    clipboard = FakeClipboard(('text/plain', b'same'))
+    clipboard.stamp_changed = False
+    serve(clipboard, tmp_path)
+    time.sleep(0.5)
+    # Every 10 ms without backoff; 20, 40, 80, ... ms with it
+    assert 3 <= clipboard.checks <= 8
+    assert clipboard.reads == 0
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='needs sleep(1)')
+def test_clipboard_tool_that_hangs_is_killed():
+    clipboard = CommandClipboard('test', ['sleep', '10'], ['true'], timeout=0.2)
+    started = time.time()
+    assert clipboard.read() is None
+    assert time.time() - started < 5
+    clipboard.close()
+
+
+class FakeWidget(object):
+    def __init__(self):
+        self.delays = []
+
+    def after(self, ms, func):
+        self.delays.append(ms)
+
+    def winfo_exists(self):
+        return True
+
+
+class TextClipboard(object):
+    """A backend with no change count, like Tk's off Windows"""
+
+    def __init__(self, text):
+        self.text = text
+
+    def change_count(self):
+        return None
+
+    def get(self):
+        return self.text
+
+    def set(self, text):
+        self.text = text
+
+
+def test_clipboard_watcher_backs_off_while_unchanged():
+    widget, backend, seen = FakeWidget(), TextClipboard('old'), []
+    watcher = app.ClipboardWatcher(widget, seen.append, backend=backend,
+                                   interval_ms=50, max_interval_ms=400)
+    for _ in range(5):
+        watcher.poll()
+    assert widget.delays == [50, 100, 200, 400, 400, 400]
+    backend.text = 'new'
+    watcher.poll()
+    assert seen == ['new']
+    assert widget.delays[-1] == 50
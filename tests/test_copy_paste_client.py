@@ -0,0 +1,63 @@
+"""ChatClient against a live copy_paste_server: the link the GUI chat drives"""
+
+import threading
+import time
+
+from copy_paste_client import ChatClient
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def drop_peers(server):
+    """Cut every link from the server side, as a network drop would"""
+    done = threading.Event()
+
+    def drop():
+        for peer in list(server.peers.values()):
+            server._drop(peer, 'test')
+        done.set()
+
+    server.call_soon_threadsafe(drop)
+    assert done.wait(5)
+
+
+def test_reconnect_resumes_the_session(server):
+    lines, statuses, pongs = [], [], []
+    client = ChatClient('127.0.0.1', server.port, on_text=lambda text, partial: lines.append(text),
+                        on_status=statuses.append, on_pong=pongs.append,
+                        heartbeat=2.0, ping_interval=0.05, backoff_min=0.01, backoff_max=0.05)
+    client.connect(timeout=5)
+    try:
+        server.call_soon_threadsafe(server.broadcast, b'one')
+        assert wait_for(lambda: lines == ['one'])
+        assert wait_for(lambda: pongs)
+
+        drop_peers(server)
+        # Sent while the link is down: held in the session for the resend
+        server.call_soon_threadsafe(server.broadcast, b'two')
+        assert wait_for(lambda: any(s.startswith('reconnected') for s in statuses))
+        assert wait_for(lambda: lines == ['one', 'two'])
+        assert client.connected and client.resumable
+        assert client.send('after the drop')
+        assert client.flush(5)
+    finally:
+        client.close()
+    assert not client.running
+
+
+def test_closed_link_without_session_ends_the_client(server):
+    closed = threading.Event()
+    client = ChatClient('127.0.0.1', server.port, on_status=lambda text: None,
+                        on_closed=closed.set, heartbeat=0, framing='newline')
+    client.connect(timeout=5)
+    drop_peers(server)
+    assert closed.wait(5)
+    assert not client.running and not client.send('too late')
+    client.close()
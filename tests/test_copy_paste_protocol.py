@@ -0,0 +1,229 @@
+"""Wire protocol building blocks in copy_paste_protocol"""
+
+import os
+import socket
+import sqlite3
+import time
+
+import pytest
+
+from copy_paste_protocol import (
+    CODECS, FLAG_COMPRESSED, FLAG_NONE, FLAG_PARTIAL, FRAME_HELLO, FRAME_PING, FRAME_TEXT,
+    METRICS, ClipboardAssembler, ClipboardState, Compressor, Connection, HistoryStore,
+    StreamDecoder, choose_codec, clip_digest, clipboard_pieces, encode_frame, encode_json,
+    make_greeting, text_decoder)
+
+
+def frames(*events):
+    return b''.join(encode_frame(ftype, payload, flags) for ftype, flags, payload in events)
+
+
+def test_frames_split_at_every_byte_boundary():
+    events = [(FRAME_TEXT, FLAG_NONE, b'first'), (FRAME_PING, FLAG_NONE, b''),
+              (FRAME_TEXT, FLAG_PARTIAL, b'x' * 300)]
+    data = frames(*events)
+    for cut in range(len(data) + 1):
+        decoder = StreamDecoder(framed=True, bufsize=64)
+        got = decoder.feed(data[:cut]) + decoder.feed(data[cut:])
+        assert [(t, f, bytes(p)) for t, f, p in got] == events, cut
+        assert decoder.buffered() == 0
+
+
+def test_newline_link_upgrades_to_frames():
+    decoder = StreamDecoder()
+    data = (make_greeting({'server': 'test'}) + b'plain line\r\n' +
+            frames((FRAME_HELLO, FLAG_NONE, encode_json({'codec': 'none'})),
+                   (FRAME_TEXT, FLAG_NONE, b'framed')))
+    events = []
+    for i in range(len(data)):
+        events += decoder.feed(data[i:i + 1])
+    assert decoder.framed
+    assert [(t, bytes(p)) for t, f, p in events][1:] == [
+        (FRAME_TEXT, b'plain line'), (FRAME_HELLO, b'{"codec":"none"}'), (FRAME_TEXT, b'framed')]
+
+
+def test_utf8_character_split_across_reads():
+    text = u'h\u00e9llo \u20ac\U0001f600 w\u00f6rld'
+    data = text.encode('utf-8')
+    for cut in range(1, len(data)):
+        # Small max_line_size: the line comes out in FLAG_PARTIAL pieces
+        decoder = StreamDecoder(upgrade=False, max_line_size=cut)
+        utf8 = text_decoder()
+        pieces = decoder.feed(data[:cut]) + decoder.feed(data[cut:] + b'\n')
+        assert pieces[0][1] & FLAG_PARTIAL and not pieces[-1][1] & FLAG_PARTIAL
+        assert u''.join(utf8.decode(p) for t, f, p in pieces) == text, cut
+
+
+@pytest.mark.parametrize('codec', ['zlib', 'lzma'])
+def test_compressor_round_trip(codec):
+    if codec not in CODECS:
+        pytest.skip('%s is not available' % codec)
+    compressor = Compressor(codec)
+    data = b'the same words over and over ' * 2000
+    payload, flags = compressor.compress(data)
+    assert flags & FLAG_COMPRESSED and len(payload) < len(data)
+    assert compressor.decompress(payload) == data
+
+    # Small or incompressible payloads go out as they are
+    assert compressor.compress(b'short') == (b'short', FLAG_NONE)
+    noise = os.urandom(4096)
+    assert compressor.compress(noise) == (noise, FLAG_NONE)
+
+
+def test_codec_negotiation_falls_back_to_none(server):
+    assert choose_codec(['brotli', 'zstd']) == 'none'
+    assert choose_codec(['brotli', 'zlib', 'none']) == 'zlib'
+    assert choose_codec(None) == 'none'
+    assert Compressor('brotli').codec == 'none'
+
+    for offered, codec in ((['brotli'], 'none'), (['brotli', 'zlib'], 'zlib')):
+        conn = Connection(socket.create_connection(('127.0.0.1', server.port), timeout=5),
+                          codecs=offered)
+        try:
+            assert conn.handshake()
+            assert conn.compressor.codec == codec
+        finally:
+            conn.close()
+
+
+def test_clipboard_state_dedup_and_echo_suppression():
+    state = ClipboardState(min_interval=0)
+    assert state.local('text/plain', b'one') == ('text/plain', b'one')
+    assert state.local('text/plain', b'one') is None  # unchanged
+
+    # An item from the other end is new once; when it then shows up in the
+    # local clipboard it is not sent back
+    h = clip_digest('text/plain', b'two')
+    assert state.remote(h)
+    assert not state.remote(h)
+    assert state.local('text/plain', b'two') is None
+    assert state.local('text/plain', b'three') == ('text/plain', b'three')
+
+
+def test_clipboard_state_coalesces_throttled_copies():
+    state = ClipboardState(min_interval=0.2)
+    assert state.local('text/plain', b'one') == ('text/plain', b'one')
+    assert state.local('text/plain', b'two') is None
+    assert state.local('text/plain', b'three') is None
+    assert state.due() is None
+    assert 0 < state.next_due() <= 0.2
+
+    time.sleep(state.next_due() + 0.01)
+    assert state.due() == ('text/plain', b'three')  # only the latest
+    assert state.due() is None and state.next_due() is None
+
+    # Copying back what was already sent cancels a held-back item
+    state.last_sent = 0
+    assert state.local('text/plain', b'four') == ('text/plain', b'four')
+    assert state.local('text/plain', b'five') is None
+    assert state.local('text/plain', b'four') is None
+    assert state.pending is None
+
+
+def test_clipboard_assembler_reassembles_interleaved_items():
+    image = bytes(bytearray(range(256))) * 40
+    text = u'caf\u00e9 '.encode('utf-8') * 500
+    big = list(clipboard_pieces(1, 'image/png', image, piece=1000))
+    small = list(clipboard_pieces(2, 'text/plain', text, piece=700))
+    refused = list(clipboard_pieces(3, 'application/x-secret', b'?' * 3000, piece=1000))
+    assert len(big) > len(small) > 1
+
+    assembler = ClipboardAssembler(accept=lambda header: header['type'] != 'application/x-secret')
+    done = []
+    for i in range(max(len(big), len(small), len(refused))):
+        for pieces in (big, refused, small):
+            if i < len(pieces):
+                item = assembler.feed(pieces[i][1], pieces[i][0])
+                if item is not None:
+                    done.append((item[0]['type'], item[1]))
+    assert done == [('text/plain', text), ('image/png', image)]
+    assert not assembler.items
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def fill(store):
+    for text in (u'apt-get install "build-essential"', u'50% done (step_2)',
+                 u'C:\\Users\\me', u'NEAR the end: x OR y', u'caf\u00e9 au lait'):
+        store.add('vm', 'chat', text)
+    assert wait_for(lambda: len(store.search('')) == 5)
+
+
+def texts(rows):
+    return [row[5] for row in rows]
+
+
+def test_history_search_with_fts_special_characters(tmp_path):
+    store = HistoryStore(str(tmp_path / 'history.sqlite3'))
+    try:
+        if store.fts is None:
+            pytest.skip('this SQLite has no full text index')
+        fill(store)
+        assert texts(store.search('build-ess')) == [u'apt-get install "build-essential"']
+        assert texts(store.search('"build')) == [u'apt-get install "build-essential"']
+        assert texts(store.search('NEAR(')) == [u'NEAR the end: x OR y']
+        assert texts(store.search('x OR y')) == [u'NEAR the end: x OR y']
+        assert texts(store.search('caf\u00e9')) == [u'caf\u00e9 au lait']
+        assert store.search('"*(-)') == []
+        assert len(store.search('', limit=2)) == 2
+    finally:
+        store.close()
+
+
+class NoFtsConnection(object):
+    """A sqlite3 connection on which the listed FTS modules are missing"""
+
+    def __init__(self, db, missing):
+        self.db = db
+        self.missing = missing
+
+    def execute(self, sql, *args):
+        if any('USING %s(' % fts in sql for fts in self.missing):
+            raise sqlite3.OperationalError('no such module')
+        return self.db.execute(sql, *args)
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    def __enter__(self):
+        return self.db.__enter__()
+
+    def __exit__(self, *exc):
+        return self.db.__exit__(*exc)
+
+
+@pytest.mark.parametrize('missing, fts', [(('fts5',), 'fts4'), (('fts5', 'fts4'), None)])
+def test_history_search_without_fts5(tmp_path, monkeypatch, missing, fts):
+    connect = HistoryStore._connect
+    monkeypatch.setattr(HistoryStore, '_connect',
+                        lambda self: NoFtsConnection(connect(self), missing))
+    store = HistoryStore(str(tmp_path / 'history.sqlite3'))
+    try:
+        assert store.fts == fts
+        fill(store)
+        assert texts(store.search('install build')) == (
+            [u'apt-get install "build-essential"'] if fts else [])
+        assert texts(store.search('caf')) == [u'caf\u00e9 au lait']
+        assert texts(store.search('C:\\Users')) == [u'C:\\Users\\me']
+        if fts is None:
+            # LIKE wildcards in the query are matched literally
+            assert texts(store.search('50%')) == [u'50% done (step_2)']
+            assert texts(store.search('p_2')) == [u'50% done (step_2)']
+            assert store.search('5_%') == []
+    finally:
+        store.close()
+
+
+def test_history_store_close_drops_its_gauge(tmp_path, monkeypatch):
+    monkeypatch.setattr(METRICS, 'enabled', True)
+    store = HistoryStore(str(tmp_path / 'history.sqlite3'))
+    assert 'history_queue' in METRICS.snapshot()['gauges']
+    store.close()
+    assert 'history_queue' not in METRICS.snapshot()['gauges']
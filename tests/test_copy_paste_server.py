@@ -0,0 +1,196 @@
+"""Receiving side of file and directory pushes in copy_paste_server"""
+
+import hashlib
+import os
+
+import pytest
+
+import auto_installer_py as app
+from copy_paste_protocol import ENTRY_HEADER, encode_json
+from copy_paste_server import ChunkStore, IncomingArchive, IncomingFile
+
+
+def manifest_for(data, chunk_size=4, transfer_id='00ff'):
+    hashes = [hashlib.sha256(data[i:i + chunk_size]).hexdigest()
+              for i in range(0, len(data), chunk_size)]
+    return {'id': transfer_id, 'name': 'file.bin', 'size': len(data),
+            'chunk_size': chunk_size, 'hashes': hashes}
+
+
+@pytest.mark.parametrize('transfer_id', ['x/../../../tmp/pwn', '..', 'ABC', '', 'a' * 65])
+def test_incoming_file_rejects_bad_ids(tmp_path, transfer_id):
+    with pytest.raises(ValueError):
+        IncomingFile(str(tmp_path), manifest_for(b'data', transfer_id=transfer_id))
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_incoming_file_rejects_zero_chunk_size(tmp_path):
+    with pytest.raises(ValueError):
+        IncomingFile(str(tmp_path), dict(manifest_for(b'data'), chunk_size=0))
+
+
+def test_incoming_file_resumes_from_verified_chunks(tmp_path):
+    data = b'0123456789abcdef!'
+    manifest = manifest_for(data)
+    with open(str(tmp_path / 'file.bin.00ff.part'), 'wb') as f:
+        f.write(data[:8] + b'XXXX')  # two good chunks, one corrupt
+
+    t = IncomingFile(str(tmp_path), manifest)
+    assert not t.verified
+    t.verify_existing()
+    assert t.missing() == [[2, 5]]
+    for index in range(2, 5):
+        start = index * 4
+        assert t.write_chunk(index, data[start:start + 4])
+    assert t.complete()
+    t.finish()
+    with open(str(tmp_path / 'file.bin'), 'rb') as f:
+        assert f.read() == data
+
+
+def archive(*entries):
+    """Encode (entry, data) pairs the way ArchiveStream sends them"""
+    out = b''
+    for entry, data in entries:
+        header = encode_json(entry)
+        out += ENTRY_HEADER.pack(len(header)) + header + data
+    return out
+
+
+needs_symlinks = pytest.mark.skipif(not hasattr(os, 'symlink') or os.name == 'nt',
+                                    reason='needs POSIX symlinks')
+
+
+@needs_symlinks
+def test_archive_rejects_chained_symlinks(tmp_path):
+    recv = tmp_path / 'recv'
+    recv.mkdir()
+    a = IncomingArchive(str(recv), 'tree')
+    # l1 -> . is harmless alone; l1/l2 -> .. looks like "." textually, but
+    # on disk l2 would point above the tree, and l2/evil would escape it
+    a.feed(archive(({'type': 'symlink', 'path': 'l1', 'target': '.'}, b''),
+                   ({'type': 'symlink', 'path': 'l1/l2', 'target': '..'}, b''),
+                   ({'type': 'symlink', 'path': 'l3', 'target': '..'}, b''),
+                   ({'type': 'file', 'path': 'l2/evil', 'size': 4}, b'evil'),
+                   ({'type': 'file', 'path': 'l1/evil', 'size': 4}, b'evil')))
+    status = a.finish()
+
+    assert not os.path.lexists(str(recv / 'l2'))
+    assert not os.path.islink(str(recv / 'tree' / 'l2'))
+    assert not os.path.lexists(str(recv / 'tree' / 'l3'))
+    assert not os.path.exists(str(recv / 'evil'))
+    assert not os.path.exists(str(tmp_path / 'evil'))
+    # l2/evil lands in a real directory inside the tree; l1/evil is refused
+    assert os.path.isfile(str(recv / 'tree' / 'l2' / 'evil'))
+    assert not os.path.exists(str(recv / 'tree' / 'evil'))
+    assert status['files'] == 1
+    assert len(status['errors']) == 3
+
+
+@needs_symlinks
+def test_archive_never_writes_through_a_symlink(tmp_path):
+    outside = tmp_path / 'outside'
+    outside.mkdir()
+    recv = tmp_path / 'recv'
+    (recv / 'tree').mkdir(parents=True)
+    # Left over from an earlier push, or planted by another tool
+    os.symlink(str(outside), str(recv / 'tree' / 'sub'))
+    os.symlink(str(outside / 'x.part'), str(recv / 'tree' / 'x.part'))
+
+    a = IncomingArchive(str(recv), 'tree')
+    a.feed(archive(({'type': 'dir', 'path': 'sub', 'mode': 0o777}, b''),
+                   ({'type': 'file', 'path': 'sub/f', 'size': 1}, b'f'),
+                   ({'type': 'file', 'path': 'x', 'size': 1}, b'x')))
+    status = a.finish()
+
+    assert os.listdir(str(outside)) == []
+    assert status['files'] == 0
+
+
+@needs_symlinks
+def test_archive_keeps_links_inside_the_tree(tmp_path):
+    a = IncomingArchive(str(tmp_path), 'tree')
+    a.feed(archive(({'type': 'dir', 'path': 'docs'}, b''),
+                   ({'type': 'file', 'path': 'docs/a.txt', 'size': 2}, b'hi'),
+                   ({'type': 'symlink', 'path': 'docs/b.txt', 'target': 'a.txt'}, b''),
+                   ({'type': 'symlink', 'path': 'top', 'target': 'docs/../docs'}, b'')))
+    status = a.finish()
+
+    assert status['errors'] == []
+    assert status['files'] == 1
+    assert os.readlink(str(tmp_path / 'tree' / 'docs' / 'b.txt')) == 'a.txt'
+    with open(str(tmp_path / 'tree' / 'top' / 'b.txt'), 'rb') as f:
+        assert f.read() == b'hi'
+
+
+def test_dedup_commit_failure_keeps_the_server_running(server, tmp_path, monkeypatch):
+    path = tmp_path / 'data.bin'
+    path.write_bytes(os.urandom(3 * 1024 * 1024))
+
+    def read_only(*args):
+        raise OSError(30, 'Read-only file system')
+
+    with monkeypatch.context() as m:
+        m.setattr(os, 'chmod', read_only)
+        ok, message = app.send_file_dedup('127.0.0.1', server.port, str(path))
+    assert not ok
+    assert 'Read-only' in message
+
+    ok, message = app.send_file_dedup('127.0.0.1', server.port, str(path))
+    assert ok, message
+    assert (tmp_path / 'recv' / 'data.bin').read_bytes() == path.read_bytes()
+
+
+def test_chunk_store_prune_evicts_least_recently_used(tmp_path):
+    store = ChunkStore(str(tmp_path / 'store'))
+    chunks = [os.urandom(1000) for _ in range(3)]
+    digests = [hashlib.sha256(c).digest() for c in chunks]
+    for age, (digest, data) in zip((300, 200, 100), zip(digests, chunks)):
+        assert store.put(digest, data)
+        os.utime(store.path(digest), (0, 1e9 - age))
+    store.has(digests[0])  # used again: now the newest
+
+    assert store.prune(2500, grace=0) == (1, 1000)
+    assert [store.has(d) for d in digests] == [True, False, True]
+    # Chunks used within the grace period stay, even over the cap
+    assert store.prune(0, grace=3600) == (0, 0)
+    assert store.prune(0, grace=0) == (2, 2000)
+
+
+def test_dedup_push_keeps_mode_and_mtime(server, tmp_path):
+    path = tmp_path / 'tool.sh'
+    path.write_bytes(os.urandom(2 * 1024 * 1024))
+    os.chmod(str(path), 0o751)
+    os.utime(str(path), (1e9, 1e9))
+
+    ok, message = app.send_file_dedup('127.0.0.1', server.port, str(path))
+    assert ok, message
+    pushed = os.stat(str(tmp_path / 'recv' / 'tool.sh'))
+    assert pushed.st_mtime == 1e9
+    if os.name == 'posix':
+        assert pushed.st_mode & 0o7777 == 0o751
+
+
+def test_dedup_push_through_a_full_chunk_backlog(server, tmp_path, monkeypatch):
+    # Reading from the sender pauses while its chunks wait for the disk
+    import copy_paste_server
+    monkeypatch.setattr(copy_paste_server, 'MAX_CHUNK_BACKLOG', 64 * 1024)
+    path = tmp_path / 'big.bin'
+    path.write_bytes(os.urandom(8 * 1024 * 1024))
+
+    ok, message = app.send_file_dedup('127.0.0.1', server.port, str(path))
+    assert ok, message
+    assert (tmp_path / 'recv' / 'big.bin').read_bytes() == path.read_bytes()
+
+
+def test_striped_push_over_several_streams(server, tmp_path):
+    path = tmp_path / 'striped.bin'
+    path.write_bytes(os.urandom(1024 * 1024 + 17))
+    lines = []
+
+    ok, message = app.send_file_chunked('127.0.0.1', server.port, str(path),
+                                        chunk_size=64 * 1024, progress=lines.append, streams=4)
+    assert ok, message
+    received = (tmp_path / 'recv' / 'striped.bin').read_bytes()
+    assert hashlib.sha256(received).digest() == hashlib.sha256(path.read_bytes()).digest()
+    assert lines
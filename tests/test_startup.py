@@ -0,0 +1,59 @@
+"""Startup: importing auto_installer_py and running the CLI stay fast and quiet
+
+Each check runs a fresh interpreter under `python -X importtime`, so
+modules this test process already imported do not hide anything.
+"""
+
+import os
+import subprocess
+import sys
+
+from conftest import ROOT
+
+# Only the GUI and the history may load these
+LAZY_MODULES = ('tkinter', '_tkinter', 'PIL', 'sqlite3')
+# Generous for slow CI machines; a desktop imports the module in about 35 ms
+BUDGET_MS = float(os.environ.get('AUTO_INSTALLER_IMPORT_BUDGET_MS', '250'))
+
+
+def importtime(*args):
+    """-> (exit status, stdout, {module: (self us, cumulative us)})"""
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + list(args), cwd=ROOT,
+                            env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, universal_newlines=True, timeout=60)
+    modules = {}
+    for line in result.stderr.splitlines():
+        fields = line[len('import time:'):].split('|')
+        if line.startswith('import time:') and len(fields) == 3 and fields[0].strip().isdigit():
+            modules[fields[2].strip()] = (int(fields[0]), int(fields[1]))
+    return result.returncode, result.stdout, modules
+
+
+def loaded_lazy_modules(modules):
+    return sorted(name for name in modules if name.split('.')[0] in LAZY_MODULES)
+
+
+def test_import_is_quiet_and_loads_no_optional_modules():
+    status, stdout, modules = importtime('-c', 'import auto_installer_py')
+    assert status == 0
+    assert stdout == ''  # no prompt, nothing read from stdin
+    assert 'auto_installer_py' in modules
+    assert loaded_lazy_modules(modules) == []
+
+
+def test_cli_loads_no_optional_modules():
+    status, stdout, modules = importtime('-m', 'auto_installer_py', 'send', '--help')
+    assert status == 0
+    assert 'usage:' in stdout
+    assert loaded_lazy_modules(modules) == []
+
+
+def test_import_time_budget():
+    # Best of three runs, so one slow run on a busy machine does not fail it
+    times = []
+    for _ in range(3):
+        status, _, modules = importtime('-c', 'import auto_installer_py')
+        assert status == 0
+        times.append(modules['auto_installer_py'][1] / 1000)
+    assert min(times) < BUDGET_MS, 'import took %.1f ms, budget %.0f ms' % (min(times), BUDGET_MS)